@@ -0,0 +1,139 @@
+"""
+ChatHistory のインデックス有無によるクエリコストの比較
+
+    python benchmarks/bench_chat_history_indexes.py [行数] [ユーザ数]
+
+一時ファイルの SQLite に counseling_linebot_chathistory と同じ構造のテーブルを作り，
+_get_history / session_detail / chat_history_status / risk_level_detection_async が発行するクエリを
+インデックス追加前後で計測する（EXPLAIN QUERY PLAN も表示する）
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+
+NUM_ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+NUM_USERS = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+REPEAT = 50
+
+TABLE = "counseling_linebot_chathistory"
+
+
+def create_table(conn):
+    conn.execute(f"""
+        CREATE TABLE {TABLE} (
+            id integer NOT NULL PRIMARY KEY AUTOINCREMENT,
+            user_id varchar(255) NOT NULL,
+            speaker varchar(255) NOT NULL,
+            message text NOT NULL,
+            post_time datetime NOT NULL,
+            finished integer NOT NULL,
+            session_id varchar(255) NOT NULL
+        )
+    """)
+    conn.execute("CREATE TABLE counseling_linebot_session (user_id varchar(255) NOT NULL PRIMARY KEY, last_start_id bigint NULL)")
+
+
+def populate(conn):
+    """
+    ユーザごとに [START] -> user/assistant の交互の発話 -> [END] のセッションを繰り返すデータを作る
+    """
+    rng = random.Random(0)
+    users = [f"U{i:032x}" for i in range(NUM_USERS)]
+    state = {u: None for u in users}   # user_id -> 現在の session_id
+    base = datetime(2025, 1, 1)
+    rows = []
+    for i in range(NUM_ROWS):
+        user_id = rng.choice(users)
+        post_time = (base + timedelta(seconds=i)).isoformat(sep=" ")
+        session_id = state[user_id]
+        if session_id is None:
+            session_id = f"{user_id}-{i}"
+            state[user_id] = session_id
+            rows.append((user_id, "user", "[START]", post_time, 1, session_id))
+        elif rng.random() < 0.02:
+            state[user_id] = None
+            rows.append((user_id, "assistant", "[END]", post_time, 1, session_id))
+        else:
+            speaker = "user" if rng.random() < 0.5 else "assistant"
+            rows.append((user_id, speaker, "こんにちは。最近よく眠れていません。", post_time, 0, session_id))
+
+        if len(rows) >= 50_000:
+            conn.executemany(f"INSERT INTO {TABLE} (user_id, speaker, message, post_time, finished, session_id) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            rows.clear()
+    if rows:
+        conn.executemany(f"INSERT INTO {TABLE} (user_id, speaker, message, post_time, finished, session_id) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    conn.execute(f"""
+        INSERT INTO counseling_linebot_session (user_id, last_start_id)
+        SELECT user_id, MAX(id) FROM {TABLE} WHERE message = '[START]' GROUP BY user_id
+    """)
+    conn.commit()
+    return users
+
+
+def queries(conn, user_id):
+    session_id, last_start_id = conn.execute(f"""
+        SELECT h.session_id, s.last_start_id FROM counseling_linebot_session s
+        JOIN {TABLE} h ON h.id = s.last_start_id WHERE s.user_id = ?
+    """, (user_id,)).fetchone() or ("", 0)
+
+    return {
+        # CounselorBot._get_history / context_cache._load_rows
+        "get_history": (f"SELECT speaker, message, finished, session_id FROM {TABLE} WHERE user_id = ? ORDER BY id DESC LIMIT 500", (user_id,)),
+        # monitor.views.chat_history_status
+        "latest_id": (f"SELECT id FROM {TABLE} WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user_id,)),
+        # monitor.views.session_detail（従来: [START] の検索）
+        "last_start_scan": (f"SELECT id, post_time FROM {TABLE} WHERE user_id = ? AND message = '[START]' ORDER BY post_time DESC LIMIT 1", (user_id,)),
+        # monitor.views.session_detail（Session.last_start_id を使う場合）
+        "logs_after_start": (f"SELECT * FROM {TABLE} WHERE user_id = ? AND id > ? ORDER BY post_time", (user_id, last_start_id)),
+        # risk_level_detection_async
+        "session_logs": (f"SELECT speaker, message FROM {TABLE} WHERE user_id = ? AND session_id = ? ORDER BY post_time", (user_id, session_id)),
+    }
+
+
+def run(conn, users, label):
+    rng = random.Random(1)
+    sample = [rng.choice(users) for _ in range(REPEAT)]
+
+    print(f"\n===== {label} =====")
+    for name in queries(conn, sample[0]):
+        sql, params = queries(conn, sample[0])[name]
+        plan = " / ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+        start = time.perf_counter()
+        for user_id in sample:
+            sql, params = queries(conn, user_id)[name]
+            conn.execute(sql, params).fetchall()
+        elapsed = (time.perf_counter() - start) / REPEAT
+        print(f"{name:18s} {elapsed * 1000:9.3f} ms/query   plan: {plan}")
+
+
+def main():
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    conn = sqlite3.connect(path)
+    create_table(conn)
+
+    start = time.perf_counter()
+    users = populate(conn)
+    print(f"rows: {NUM_ROWS}, users: {NUM_USERS}, populate: {time.perf_counter() - start:.1f}s, db: {path}")
+
+    run(conn, users, "before (PK only)")
+
+    start = time.perf_counter()
+    conn.execute(f'CREATE INDEX "chat_user_id_idx" ON {TABLE} ("user_id", "id")')
+    conn.execute(f'CREATE INDEX "chat_user_session_time_idx" ON {TABLE} ("user_id", "session_id", "post_time")')
+    conn.execute("ANALYZE")
+    print(f"\ncreate indexes: {time.perf_counter() - start:.1f}s")
+
+    run(conn, users, "after (user_id, id) / (user_id, session_id, post_time)")
+
+    conn.close()
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
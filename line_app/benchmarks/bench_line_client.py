@@ -0,0 +1,82 @@
+"""
+メッセージ送信ごとに ApiClient を作る場合と，共有の LineClient（接続プールを再利用）の比較
+
+    python benchmarks/bench_line_client.py [メッセージ数] [遅延(秒)] [スレッド数]
+
+line_app ディレクトリで実行する（config/main.yaml を読み込むため）
+benchmarks/mock_line_api.py のモックサーバに push を送って1通あたりの時間を計測する
+モックサーバは平文の HTTP なので，TLS ハンドシェイクを省略できる分の効果は含まれない（実際の LINE API ではさらに差が大きくなる）
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "line_app.settings")
+
+import django
+django.setup()
+
+from linebot.v3.messaging import ApiClient, MessagingApi, PushMessageRequest, TextMessage
+
+from counseling_linebot.utils.line_client import LineClient, create_configuration
+from counseling_linebot.utils.metrics import LatencyStats
+from benchmarks.mock_line_api import start_mock_server
+
+
+NUM_MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.005
+NUM_THREADS = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+
+def run(label, send, concurrency):
+    stats = LatencyStats()
+    users = [f"U{i:032x}" for i in range(NUM_MESSAGES)]
+
+    def timed_send(user_id):
+        start = time.perf_counter()
+        send(user_id)
+        stats.add(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        for user_id in users:
+            timed_send(user_id)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed_send, users))
+    elapsed = time.perf_counter() - start
+    snapshot = stats.snapshot()
+    print(
+        f"{label:<28} threads: {concurrency:>2}, total: {elapsed:6.2f}s, "
+        f"p50: {snapshot['p50'] * 1000:6.2f}ms, p95: {snapshot['p95'] * 1000:6.2f}ms, {NUM_MESSAGES / elapsed:7.1f} msg/s"
+    )
+
+
+def main():
+    server, state = start_mock_server(latency=LATENCY)
+    configuration = create_configuration(access_token="dummy", host=f"http://127.0.0.1:{server.server_port}")
+    messages = [TextMessage(text="ベンチマーク")]
+    print(f"messages: {NUM_MESSAGES}, latency: {LATENCY}s")
+
+    # 変更前の方法: 送信ごとに ApiClient（接続プール）を作り，送信後に閉じる
+    def send_per_message(user_id):
+        with ApiClient(configuration) as api_client:
+            MessagingApi(api_client).push_message_with_http_info(PushMessageRequest(to=user_id, messages=messages))
+
+    line_client = LineClient(configuration)
+
+    def send_shared(user_id):
+        line_client.push(user_id, messages)
+
+    for concurrency in (1, NUM_THREADS):
+        run("ApiClient per message", send_per_message, concurrency)
+        run("shared LineClient", send_shared, concurrency)
+
+    print(f"mock: {state.stats()}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
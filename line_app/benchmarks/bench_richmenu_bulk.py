@@ -0,0 +1,63 @@
+"""
+リッチメニューの1人ずつの適用と一括適用（bulk/link）の比較
+
+    python benchmarks/bench_richmenu_bulk.py [ユーザ数] [遅延(秒)] [エラー率]
+
+line_app ディレクトリで実行する（config/main.yaml を読み込むため）
+benchmarks/mock_line_api.py のモックサーバを起動し，RICHMENU_HTTP.API_ENDPOINT をモックサーバに向けて計測する
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "line_app.settings")
+
+import django
+django.setup()
+
+from counseling_linebot.utils import richmenu
+from benchmarks.mock_line_api import start_mock_server
+
+
+NUM_USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000
+LATENCY = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+ERROR_RATE = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+PER_USER_SAMPLE = 200   # 1人ずつの適用は時間がかかるので，一部のユーザで計測して全体を推定する
+
+
+def main():
+    server, state = start_mock_server(latency=LATENCY, error_rate=ERROR_RATE)
+    richmenu.API_ENDPOINT = f"http://127.0.0.1:{server.server_port}"
+    richmenu.DATA_ENDPOINT = richmenu.API_ENDPOINT
+    users = [f"U{i:032x}" for i in range(NUM_USERS)]
+    print(f"users: {NUM_USERS}, latency: {LATENCY}s, error_rate: {ERROR_RATE}")
+
+    sample = users[:PER_USER_SAMPLE]
+    start = time.perf_counter()
+    for user_id in sample:
+        richmenu.apply_richmenu("richmenu-maintenance", user_id)
+    elapsed = time.perf_counter() - start
+    print(f"per_user: {elapsed:.2f}s for {len(sample)} users -> estimated {elapsed / len(sample) * NUM_USERS:.1f}s for {NUM_USERS} users")
+
+    progress_file = os.path.join(tempfile.mkdtemp(), "progress.json")
+    start = time.perf_counter()
+    result = richmenu.bulk_apply_richmenu("richmenu-maintenance", users, progress_file=progress_file)
+    print(f"bulk: {time.perf_counter() - start:.2f}s, {result}")
+
+    # 失敗したチャンクがある場合は，進捗ファイルから残りのユーザだけ再送する
+    while result["failed"]:
+        result = richmenu.bulk_apply_richmenu("richmenu-maintenance", users, progress_file=progress_file)
+        print(f"bulk (resume): {result}")
+
+    start = time.perf_counter()
+    richmenu.set_default_richmenu("richmenu-maintenance")
+    result = richmenu.bulk_cancel_richmenu(users, progress_file=progress_file)
+    print(f"default + bulk unlink: {time.perf_counter() - start:.2f}s, {result}")
+    print(f"mock: {state.stats()}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
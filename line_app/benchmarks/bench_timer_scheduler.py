@@ -0,0 +1,121 @@
+"""
+DeadlineScheduler（1スレッドのヒープ）と threading.Timer（タイマーごとに1スレッド）の比較
+
+    python benchmarks/bench_timer_scheduler.py [タイマー数] [発火までの時間(秒)]
+
+line_app ディレクトリで実行する（config/main.yaml を読み込むため）
+同時に動いているタイマー数に対して，登録・延長・キャンセル・残り時間の取得にかかる時間，
+スレッド数，期限からの実行の遅れを計測する
+"""
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "line_app.settings")
+
+import django
+django.setup()
+
+from counseling_linebot.utils.scheduler import DeadlineScheduler
+
+
+NUM_TIMERS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+FIRE_AFTER = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+
+
+def bench_scheduler():
+    scheduler = DeadlineScheduler(max_workers=4, name="Bench")
+    fired = threading.Semaphore(0)
+    lags = []
+
+    def on_expire(deadline):
+        lags.append(time.monotonic() - deadline)
+        fired.release()
+
+    rng = random.Random(0)
+    threads_before = threading.active_count()
+
+    # 登録（長い時間で登録し，あとで期限を変更する）
+    start = time.perf_counter()
+    tasks = []
+    for _ in range(NUM_TIMERS):
+        task = scheduler.schedule(3600, on_expire, args=[0.0])
+        tasks.append(task)
+    schedule_time = time.perf_counter() - start
+
+    # 残り時間の取得
+    start = time.perf_counter()
+    for task in tasks:
+        max(0, task.deadline - time.monotonic())
+    remaining_time = time.perf_counter() - start
+
+    # 延長（期限の変更）: 半分を FIRE_AFTER 秒後に発火するように変更
+    start = time.perf_counter()
+    base = time.monotonic() + FIRE_AFTER
+    firing = tasks[: NUM_TIMERS // 2]
+    for task in firing:
+        deadline = base + rng.random()
+        task.args = [deadline]
+        scheduler.reschedule(task, deadline)
+    reschedule_time = time.perf_counter() - start
+
+    # キャンセル: 残りの半分
+    start = time.perf_counter()
+    for task in tasks[NUM_TIMERS // 2:]:
+        scheduler.cancel(task)
+    cancel_time = time.perf_counter() - start
+
+    threads_running = threading.active_count() - threads_before
+    for _ in firing:
+        fired.acquire()
+    lags.sort()
+
+    print(f"===== DeadlineScheduler: {NUM_TIMERS} timers =====")
+    print(f"schedule      {schedule_time / NUM_TIMERS * 1e6:8.2f} us/op")
+    print(f"remaining     {remaining_time / NUM_TIMERS * 1e6:8.2f} us/op")
+    print(f"reschedule    {reschedule_time / len(firing) * 1e6:8.2f} us/op")
+    print(f"cancel        {cancel_time / (NUM_TIMERS - len(firing)) * 1e6:8.2f} us/op")
+    print(f"threads       {threads_running}")
+    print(f"lag           p50: {lags[len(lags) // 2] * 1000:.2f} ms, p99: {lags[int(len(lags) * 0.99)] * 1000:.2f} ms, max: {lags[-1] * 1000:.2f} ms")
+    print(f"metrics       {scheduler.metrics()}")
+
+
+def bench_threading_timer():
+    fired = threading.Semaphore(0)
+    lags = []
+
+    def on_expire(deadline):
+        lags.append(time.monotonic() - deadline)
+        fired.release()
+
+    threads_before = threading.active_count()
+    start = time.perf_counter()
+    timers = []
+    try:
+        for i in range(NUM_TIMERS):
+            deadline = time.monotonic() + FIRE_AFTER
+            timer = threading.Timer(FIRE_AFTER, on_expire, args=[deadline])
+            timer.start()
+            timers.append(timer)
+    except RuntimeError as e:
+        print(f"threading.Timer: スレッドを作成できませんでした（{len(timers)} 個目）: {e}")
+    schedule_time = time.perf_counter() - start
+    threads_running = threading.active_count() - threads_before
+
+    for _ in timers:
+        fired.acquire()
+    lags.sort()
+
+    print(f"\n===== threading.Timer: {len(timers)} timers =====")
+    print(f"schedule      {schedule_time / max(1, len(timers)) * 1e6:8.2f} us/op")
+    print(f"threads       {threads_running}")
+    if lags:
+        print(f"lag           p50: {lags[len(lags) // 2] * 1000:.2f} ms, p99: {lags[int(len(lags) * 0.99)] * 1000:.2f} ms, max: {lags[-1] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    bench_scheduler()
+    bench_threading_timer()
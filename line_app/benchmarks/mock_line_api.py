@@ -0,0 +1,228 @@
+"""
+リッチメニュー・メッセージ送信関連の LINE Messaging API のモックサーバ
+
+    python benchmarks/mock_line_api.py [--port 8089] [--latency 0.05] [--error-rate 0.1]
+
+config/main.yaml の RICHMENU_HTTP.API_ENDPOINT / DATA_ENDPOINT を http://127.0.0.1:8089 にすると，
+実際の LINE API の代わりにこのサーバへリクエストが送られる（メッセージ送信は LINE_CLIENT.API_ENDPOINT）
+各リクエストに latency 秒の遅延を入れ，error_rate の割合で 429 / 500 を返す
+"""
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BULK_LIMIT = 500   # bulk/link, bulk/unlink の userIds の上限
+
+
+class MockState:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.links = {}            # user_id -> richmenu_id
+        self.default_richmenu = None
+        self.richmenus = {}        # richmenu_id -> name
+        self.requests = 0
+        self.errors = 0
+        self.messages = {"reply": 0, "push": 0, "broadcast": 0, "loading": 0}
+        self.quota_consumption = 0
+        self.retry_keys = set()    # 受け付けた X-Line-Retry-Key
+        self.bulk_sizes = []       # bulk/link, bulk/unlink で受け取った userIds の数
+        self.fail_user_ids = set() # このユーザを含む bulk/link, bulk/unlink には 500 を返す（テスト用）
+        self.message_failures = [] # メッセージの送信に順に返すステータス（テスト用．400 は Invalid reply token）
+
+    def should_fail(self):
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return self.random.choice([429, 500])
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "linked_users": len(self.links), "default": self.default_richmenu, "messages": dict(self.messages)}
+
+
+class MockLineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+    disable_nagle_algorithm = True   # keep-alive でヘッダと本文を別々に送るときの遅延（Nagle + 遅延 ACK）を避ける
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return {}
+        body = self.rfile.read(length)
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {}
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body if body is not None else {}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        payload = self._read_json() if method == "POST" else {}
+        time.sleep(self.state.latency)
+
+        status = self.state.should_fail()
+        if status is not None:
+            headers = {"Retry-After": "0"} if status == 429 else None
+            return self._send(status, {"message": "mock error"}, headers)
+
+        path = self.path.split("?")[0]
+        state = self.state
+
+        if method == "POST" and path == "/v2/bot/richmenu/bulk/link":
+            user_ids = payload.get("userIds", [])
+            if not user_ids or len(user_ids) > BULK_LIMIT or "richMenuId" not in payload:
+                return self._send(400, {"message": "invalid request"})
+            with state.lock:
+                state.bulk_sizes.append(len(user_ids))
+                if state.fail_user_ids.intersection(user_ids):
+                    return self._send(500, {"message": "mock error"})
+                for user_id in user_ids:
+                    state.links[user_id] = payload["richMenuId"]
+            return self._send(202)
+
+        if method == "POST" and path == "/v2/bot/richmenu/bulk/unlink":
+            user_ids = payload.get("userIds", [])
+            if not user_ids or len(user_ids) > BULK_LIMIT:
+                return self._send(400, {"message": "invalid request"})
+            with state.lock:
+                state.bulk_sizes.append(len(user_ids))
+                if state.fail_user_ids.intersection(user_ids):
+                    return self._send(500, {"message": "mock error"})
+                for user_id in user_ids:
+                    state.links.pop(user_id, None)
+            return self._send(202)
+
+        if method == "GET" and path == "/v2/bot/richmenu/list":
+            with state.lock:
+                richmenus = [{"richMenuId": rid, "name": name} for rid, name in state.richmenus.items()]
+            return self._send(200, {"richmenus": richmenus})
+
+        if method == "POST" and path == "/v2/bot/richmenu":
+            richmenu_id = f"richmenu-{len(state.richmenus) + 1:032d}"
+            with state.lock:
+                state.richmenus[richmenu_id] = payload.get("name", "")
+            return self._send(200, {"richMenuId": richmenu_id})
+
+        if method == "POST" and path in ("/v2/bot/message/reply", "/v2/bot/message/push", "/v2/bot/message/broadcast"):
+            kind = path.rsplit("/", 1)[1]
+            if not payload.get("messages") or (kind == "reply" and "replyToken" not in payload) or (kind == "push" and "to" not in payload):
+                return self._send(400, {"message": "invalid request"})
+            with state.lock:
+                failure = state.message_failures.pop(0) if state.message_failures else None
+            if failure is not None and failure != 400:
+                return self._send(failure, {"message": "mock error"})
+            if failure == 400 or (kind == "reply" and payload["replyToken"].startswith("expired")):
+                return self._send(400, {"message": "Invalid reply token"})
+            retry_key = self.headers.get("X-Line-Retry-Key")
+            with state.lock:
+                if retry_key is not None:
+                    if retry_key in state.retry_keys:
+                        return self._send(409, {"message": "The retry key is already accepted"})
+                    state.retry_keys.add(retry_key)
+                state.messages[kind] += 1
+                if kind != "reply":   # 送信数は宛先の人数で数える（モックには友だちの一覧がないので broadcast も1とする）
+                    state.quota_consumption += 1
+            return self._send(200, {"sentMessages": [{"id": str(i)} for i in range(len(payload["messages"]))]})
+
+        if method == "POST" and path == "/v2/bot/chat/loading/start":
+            with state.lock:
+                state.messages["loading"] += 1
+            return self._send(202)
+
+        if method == "GET" and path == "/v2/bot/message/quota":
+            return self._send(200, {"type": "limited", "value": 1000})
+
+        if method == "GET" and path == "/v2/bot/message/quota/consumption":
+            with state.lock:
+                return self._send(200, {"totalUsage": state.quota_consumption})
+
+        match = re.fullmatch(r"/v2/bot/user/all/richmenu(?:/([^/]+))?", path)
+        if match:
+            with state.lock:
+                state.default_richmenu = match.group(1) if method == "POST" else None
+            return self._send(200)
+
+        match = re.fullmatch(r"/v2/bot/user/([^/]+)/richmenu(?:/([^/]+))?", path)
+        if match:
+            with state.lock:
+                if method == "POST":
+                    state.links[match.group(1)] = match.group(2)
+                else:
+                    state.links.pop(match.group(1), None)
+            return self._send(200)
+
+        match = re.fullmatch(r"/v2/bot/richmenu/([^/]+)(/content)?", path)
+        if match:
+            with state.lock:
+                name = state.richmenus.get(match.group(1), "")
+                if method == "DELETE":
+                    state.richmenus.pop(match.group(1), None)
+            return self._send(200, {"richMenuId": match.group(1), "name": name})
+
+        return self._send(404, {"message": "not found"})
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def start_mock_server(port=0, latency=0.0, error_rate=0.0):
+    """
+    モックサーバを別スレッドで起動し，(server, state) を返す．URL は f"http://127.0.0.1:{server.server_port}"
+    """
+    state = MockState(latency=latency, error_rate=error_rate)
+    handler = type("Handler", (MockLineHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MockLineAPI", daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.05, help="1リクエストあたりの遅延（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429/500 を返す割合")
+    args = parser.parse_args()
+
+    server, state = start_mock_server(args.port, args.latency, args.error_rate)
+    print(f"mock LINE API: http://127.0.0.1:{server.server_port} (latency: {args.latency}s, error_rate: {args.error_rate})")
+    try:
+        while True:
+            time.sleep(10)
+            print(state.stats())
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
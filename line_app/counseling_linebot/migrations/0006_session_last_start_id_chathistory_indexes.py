@@ -0,0 +1,42 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+
+def backfill_last_start_id(apps, schema_editor):
+    """
+    既存のセッションに，最後の[START]のChatHistory.idを設定する
+    """
+    Session = apps.get_model('counseling_linebot', 'Session')
+    ChatHistory = apps.get_model('counseling_linebot', 'ChatHistory')
+    last_starts = (
+        ChatHistory.objects.filter(message='[START]')
+        .values('user_id')
+        .annotate(last_id=models.Max('id'))
+    )
+    for row in last_starts:
+        Session.objects.filter(user_id=row['user_id']).update(last_start_id=row['last_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counseling_linebot', '0005_session_risk_level_reason_session_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='last_start_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['user_id', 'id'], name='chat_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['user_id', 'session_id', 'post_time'], name='chat_user_session_time_idx'),
+        ),
+        migrations.RunPython(backfill_last_start_id, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counseling_linebot', '0006_session_last_start_id_chathistory_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='counseling_deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='counseling_started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counseling_linebot', '0007_session_counseling_clock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='risk_level_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 14:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counseling_linebot', '0008_session_risk_level_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='summary_until_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
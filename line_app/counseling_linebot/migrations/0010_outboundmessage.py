@@ -0,0 +1,34 @@
+# Generated by Django 5.2.10 on 2026-10-18 14:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('counseling_linebot', '0009_session_summary_until_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('user_id', models.CharField(blank=True, default='', max_length=255)),
+                ('reply_token', models.TextField(blank=True, default='')),
+                ('token_issued_at', models.DateTimeField(blank=True, null=True)),
+                ('messages', models.JSONField(default=list)),
+                ('retry_key', models.CharField(max_length=64)),
+                ('owner', models.CharField(blank=True, default='', max_length=128)),
+                ('status', models.CharField(default='pending', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='outbound_status_idx')],
+            },
+        ),
+    ]
@@ -16,18 +16,28 @@ class Session(models.Model):
 	               }
 	# ユーザのLINE上のボタンの状態を管理する文字列．ユーザはボタン以外の動作（リッチメニュー操作や任意のテキスト送信）が可能なので，それらを無効にする
 	flag: str: 'accepted', 'start_chat', 'reset_history', 'consent'
-	time: セッションの時間（秒）
+	time: セッションの時間（秒）．カウンセリング中は開始時点の時間で，終了時に残り時間で更新する
+	counseling_started_at: カウンセリング（時間計測）の開始日時
+	counseling_deadline: カウンセリングの終了予定日時．残り時間はここから計算する（カウンセリング中でない場合は None）
 	risk_level: int (0-3): リスクレベル
+	risk_level_seq: リスクレベルを推定した依頼の順番（time_ns）．古い推定結果で新しい結果を上書きしないために使う
 	survey: dict[question]: アンケートの回答
+	summary: セッション開始以降の対話の要約（バックグラウンドで数発話ごとに更新する）
+	summary_until_id: summary に含まれている最後の発話の ChatHistory の id（0 の場合は要約なし）
 	"""
 	user_id = models.CharField(max_length=255, primary_key=True)
 	session_data = models.JSONField(default=dict)
 	flag = models.TextField(blank=True, default="")
 	time = models.IntegerField(default=0)
+	counseling_started_at = models.DateTimeField(null=True, blank=True)
+	counseling_deadline = models.DateTimeField(null=True, blank=True)
 	risk_level = models.IntegerField(default=0, validators=[MinValueValidator(0), MaxValueValidator(3)])
 	risk_level_reason = models.TextField(blank=True, default="")  # リスクレベルの理由を保存するフィールド
+	risk_level_seq = models.BigIntegerField(default=0)
 	survey = models.JSONField(default=dict)
 	summary = models.TextField(blank=True, default="")  # カウンセリング内容の要約を保存するフィールド
+	summary_until_id = models.BigIntegerField(default=0)
+	last_start_id = models.BigIntegerField(null=True, blank=True)  # 最後の[START]のChatHistory.id（セッション開始の目印）
 
 
 class Setting(models.Model):
@@ -43,7 +53,41 @@ class ChatHistory(models.Model):
 	finished = models.IntegerField(default=0)
 	session_id = models.CharField(max_length=64, default="")
 
+	class Meta:
+		indexes = [
+			models.Index(fields=["user_id", "id"], name="chat_user_id_idx"),  # ユーザごとの最新の履歴の取得
+			models.Index(fields=["user_id", "session_id", "post_time"], name="chat_user_session_time_idx"),  # セッションごとの履歴の取得
+		]
+
 class ReplyToken(models.Model):
 	user_id = models.CharField(max_length=255, default="")
 	token = models.TextField()
-	created_at = models.DateTimeField()
\ No newline at end of file
+	created_at = models.DateTimeField()
+
+class OutboundMessage(models.Model):
+	"""
+	送信キュー（utils/outbound_queue.py）に積まれた，送信待ち・送信に失敗したメッセージ．送信に成功したものは削除する
+	kind: "reply" or "push"（reply_token の期限が切れた場合は push に切り替える）
+	messages: 送信するメッセージ（Message.to_dict() のリスト）
+	retry_key: push を再送するときの X-Line-Retry-Key（同じメッセージが2回届かないようにする）
+	status: "pending"（送信待ち） / "sending"（送信中） / "failed"（再送しても送信できなかった）
+	token_issued_at: reply_token を受け取った日時
+	owner: キューに積んだ（送り直すために引き取った）プロセス．各プロセスは自分のメッセージの updated_at を定期的に進める
+	"""
+	kind = models.CharField(max_length=16)
+	user_id = models.CharField(max_length=255, blank=True, default="")
+	reply_token = models.TextField(blank=True, default="")
+	token_issued_at = models.DateTimeField(null=True, blank=True)
+	messages = models.JSONField(default=list)
+	retry_key = models.CharField(max_length=64)
+	owner = models.CharField(max_length=128, blank=True, default="")
+	status = models.CharField(max_length=16, default="pending")
+	attempts = models.IntegerField(default=0)
+	last_error = models.TextField(blank=True, default="")
+	created_at = models.DateTimeField()
+	updated_at = models.DateTimeField()
+
+	class Meta:
+		indexes = [
+			models.Index(fields=["status", "updated_at"], name="outbound_status_idx"),  # 再起動時の送信待ちのメッセージの取得
+		]
@@ -1,3 +1,281 @@
-from django.test import TestCase
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from linebot.v3.messaging import TextMessage
+
+from counseling_linebot.models import OutboundMessage
+from counseling_linebot.utils import bot, outbound_queue, richmenu, tool
+from counseling_linebot.utils.line_client import LineClient, create_configuration
+from counseling_linebot.utils.message_quota import QuotaTracker
+from counseling_linebot.utils.scheduler import DeadlineScheduler
+from benchmarks.mock_line_api import start_mock_server
+
+
+class BulkRequestTest(SimpleTestCase):
+    """
+    richmenu._bulk_request を benchmarks/mock_line_api.py のモックサーバに送って確認する
+    """
+    def setUp(self):
+        self.server, self.state = start_mock_server()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.progress_file = os.path.join(self.tmp_dir, "progress.json")
+        self.users = [f"U{i:032x}" for i in range(10)]
+
+        endpoint = f"http://127.0.0.1:{self.server.server_port}"
+        for name, value in (("API_ENDPOINT", endpoint), ("http", requests.Session())):   # 失敗したチャンクを HTTP のリトライで送り直さない
+            patcher = mock.patch.object(richmenu, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def apply(self):
+        return richmenu.bulk_apply_richmenu("richmenu-maintenance", self.users, chunk_size=3, max_workers=2, progress_file=self.progress_file)
+
+    def test_chunking(self):
+        result = self.apply()
+
+        self.assertEqual(result, {"total": 10, "succeeded": 10, "failed": 0, "resumed": 0})
+        self.assertEqual(sorted(self.state.bulk_sizes), [1, 3, 3, 3])
+        self.assertEqual(self.state.links, {user_id: "richmenu-maintenance" for user_id in self.users})
+        self.assertFalse(os.path.exists(self.progress_file))   # 全て成功した場合は進捗を残さない
+
+    def test_failed_chunk_and_resume(self):
+        self.state.fail_user_ids = {self.users[4]}   # 2番目のチャンク（users[3:6]）だけ失敗させる
+        result = self.apply()
+
+        self.assertEqual(result, {"total": 10, "succeeded": 7, "failed": 3, "resumed": 0})
+        self.assertEqual(set(self.state.links), set(self.users) - set(self.users[3:6]))
+        with open(self.progress_file, "r", encoding="utf-8") as f:
+            self.assertEqual(set(json.load(f)["done"]), set(self.state.links))
+
+        # 次の呼び出しでは，失敗したユーザだけを送り直す
+        self.state.fail_user_ids = set()
+        self.state.bulk_sizes = []
+        result = self.apply()
+
+        self.assertEqual(result, {"total": 10, "succeeded": 10, "failed": 0, "resumed": 7})
+        self.assertEqual(self.state.bulk_sizes, [3])
+        self.assertEqual(set(self.state.links), set(self.users))
+        self.assertFalse(os.path.exists(self.progress_file))
+
+    def test_progress_of_another_operation_is_ignored(self):
+        self.state.fail_user_ids = {self.users[0]}
+        self.apply()
+
+        # 進捗はリッチメニューごとに記録されるので，解除の処理では使わない
+        self.state.fail_user_ids = set()
+        result = richmenu.bulk_cancel_richmenu(self.users, chunk_size=3, max_workers=2, progress_file=self.progress_file)
+        self.assertEqual(result["resumed"], 0)
+        self.assertEqual(result["succeeded"], 10)
+
+
+class DeadlineSchedulerTest(SimpleTestCase):
+    """
+    DeadlineScheduler の実行順・キャンセル・期限の変更を確認する
+    """
+    def setUp(self):
+        self.scheduler = DeadlineScheduler(max_workers=1, name="Test")
+        self.fired = []
+        self.done = threading.Event()
+        self.addCleanup(self.scheduler.executor.shutdown, wait=False)
+
+    def record(self, name, last=False):
+        self.fired.append(name)
+        if last:
+            self.done.set()
+
+    def test_fires_in_deadline_order(self):
+        # 登録順ではなく期限の順に実行される
+        self.scheduler.schedule(0.15, self.record, ("c", True))
+        self.scheduler.schedule(0.05, self.record, ("a",))
+        self.scheduler.schedule(0.10, self.record, ("b",))
+
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, ["a", "b", "c"])
+        self.assertEqual(self.scheduler.metrics()["fired"], 3)
+
+    def test_cancel(self):
+        task = self.scheduler.schedule(0.05, self.record, ("cancelled",))
+        self.scheduler.schedule(0.10, self.record, ("kept", True))
+
+        self.assertTrue(self.scheduler.cancel(task))
+        self.assertFalse(self.scheduler.cancel(task))   # 2回目はキャンセル済み
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, ["kept"])
+        self.assertEqual(self.scheduler.active(), 0)
+
+        # キャンセル済みの予定は期限を変更できない
+        self.assertFalse(self.scheduler.reschedule(task, time.monotonic()))
+
+    def test_extend(self):
+        task = self.scheduler.schedule(0.05, self.record, ("extended", True))
+        self.scheduler.schedule(0.10, self.record, ("other",))
+
+        # 期限を延ばすと，後から期限が来る予定より後に実行される
+        self.assertTrue(self.scheduler.reschedule(task, task.deadline + 0.15))
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, ["other", "extended"])
+        self.assertFalse(self.scheduler.reschedule(task, time.monotonic()))   # 実行済み
+
+    def test_trackable_timer_extend(self):
+        with mock.patch.object(tool, "scheduler", self.scheduler):
+            timer = tool.TrackableTimer(0.05, self.record, args=["timer", True])
+            timer.start()
+            remaining = timer.extend(0.1)
+
+            self.assertGreater(remaining, 0.1)
+            self.assertFalse(self.done.wait(0.08))   # 元の期限では実行されない
+            self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.fired, ["timer"])
+
+
+class FakeStreamClient(bot.APIClient):
+    """
+    決まったチャンクを順に返す API クライアント
+    """
+    def __init__(self, chunks):
+        super().__init__(api_key="", model_name="gemini-test", temperature=0.0)
+        self.chunks = chunks
+        self.received = 0
+
+    def _stream(self, history):
+        for chunk in self.chunks:
+            self.received += 1
+            yield chunk
+
+
+class StreamingReplyTest(SimpleTestCase):
+    """
+    ストリーミングで受信した応答の打ち切りと，対話の終了の判定を確認する
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+        paths = []
+        for name in ("system.txt", "example.txt"):
+            paths.append(os.path.join(self.tmp_dir, name))
+            with open(paths[-1], "w", encoding="utf-8") as f:
+                f.write(name)
+        self.bot = bot.CounselorBot(db_path="", init_message="", system_prompt_path=paths[0], example_files=paths[1:], api_key="dummy", model_name="gpt-4o")
+
+        for name, value in (("STREAMING", True), ("COMBINED_RISK_DETECTION", False)):
+            patcher = mock.patch.object(bot, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def generate(self, chunks):
+        self.bot.client = FakeStreamClient(chunks)
+        prompts = self.bot.prompts._replace(risk_prompt="")
+        response = self.bot._generate_candidate([{"role": "user", "content": "こんにちは"}], prompts, 0)
+        return self.bot._evaluate_candidate(response, "", 0, 0, prompts)
+
+    def test_marker_after_paragraph(self):
+        _, response, finished, _ = self.generate(["お話しいただき", "ありがとうございました。\n", "\n[Dialogue ", "Finished]"])
+        self.assertEqual(response, "お話しいただきありがとうございました。")
+        self.assertEqual(finished, bot.DIALOGUE_FINISHED)
+
+    def test_stops_at_marker(self):
+        self.generate(["text\n\n", "[Dialogue Finished]", "続き", "続き"])
+        self.assertEqual(self.bot.client.received, 2)   # 目印を受信した時点で打ち切る
+
+    def test_no_marker(self):
+        _, response, finished, _ = self.generate(["text\n\n", "second paragraph"])
+        self.assertEqual(response, "text")
+        self.assertEqual(finished, bot.DIALOGUE_NOT_FINISHED)
+
+
+class OutboundQueueTest(TestCase):
+    """
+    OutboundQueue._deliver の再送と reply から push への切り替えを benchmarks/mock_line_api.py のモックサーバで確認する
+    """
+    def setUp(self):
+        self.server, self.state = start_mock_server()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        client = LineClient(create_configuration(access_token="test", host=f"http://127.0.0.1:{self.server.server_port}"))
+        self.queue = outbound_queue.OutboundQueue(client, num_workers=1)
+        for name, value in (("line_client", client), ("quota_tracker", QuotaTracker(client)), ("BACKOFF", 0)):
+            patcher = mock.patch.object(outbound_queue, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create(self, kind, reply_token="", owner=None, updated_at=None):
+        now = timezone.now()
+        return OutboundMessage.objects.create(
+            kind=kind,
+            user_id="U0",
+            reply_token=reply_token,
+            token_issued_at=now if kind == "reply" else None,
+            messages=[TextMessage(text="こんにちは").to_dict()],
+            retry_key="retry-key",
+            owner=self.queue.owner if owner is None else owner,
+            created_at=now,
+            updated_at=updated_at or now,
+        )
+
+    def deliver(self, row):
+        self.queue._deliver(row.id, time.monotonic())
+        self.assertFalse(OutboundMessage.objects.filter(id=row.id).exists())   # 送信できたものは削除される
+
+    def test_retry_after_server_error(self):
+        self.state.message_failures = [500]
+        self.deliver(self.create("reply", "token"))
+
+        self.assertEqual(self.state.messages["reply"], 1)
+        self.assertEqual(self.queue.counts["retried"], 1)
+
+    def test_invalid_reply_token_falls_back_to_push(self):
+        self.deliver(self.create("reply", "expired-token"))
+
+        self.assertEqual(self.state.messages, {"reply": 0, "push": 1, "broadcast": 0, "loading": 0})
+        self.assertEqual(self.state.retry_keys, {"retry-key"})
+        self.assertEqual(self.queue.counts["fallback"], 1)
+
+    def test_invalid_reply_token_after_server_error_is_not_pushed(self):
+        # 500 の reply が届いていれば token は使用済みなので，push で送ると2重に届く
+        self.state.message_failures = [500, 400]
+        self.deliver(self.create("reply", "token"))
+
+        self.assertEqual(self.state.messages["push"], 0)
+        self.assertEqual(self.queue.counts["fallback"], 0)
+
+    def test_push_already_accepted(self):
+        self.state.retry_keys.add("retry-key")   # 前回の送信は受け付けられたが，応答を受け取れなかった
+        self.deliver(self.create("push"))
+
+        self.assertEqual(self.state.messages["push"], 0)
+        self.assertEqual(self.queue.counts["failed"], 0)
+
+    def test_recover_only_stale_messages(self):
+        stale = timezone.now() - timedelta(seconds=outbound_queue.RECOVER_AFTER * 2)
+        live = self.create("push", owner="other")   # 他のプロセスのキューにある
+        renewed = self.create("push", updated_at=stale)   # このプロセスのもので，更新日時を進める
+        dead = self.create("push", owner="dead", updated_at=stale)   # 停止したプロセスのもの
+
+        with mock.patch.object(self.queue, "_put") as put:
+            self.queue._renew()
+            self.queue._recover()
+
+        put.assert_called_once_with(dead.id, "U0")
+        self.assertEqual(OutboundMessage.objects.get(id=dead.id).owner, self.queue.owner)
+        self.assertEqual(OutboundMessage.objects.get(id=live.id).owner, "other")
+        self.assertGreater(OutboundMessage.objects.get(id=renewed.id).updated_at, stale)
+
+        # 他のプロセスが引き取ったメッセージは送らない
+        other = outbound_queue.OutboundQueue(self.queue.client, num_workers=1)
+        other._deliver(live.id, time.monotonic())
+        self.assertEqual(self.state.messages["push"], 0)
@@ -1,12 +1,21 @@
 import json
 import os
+import time
+import threading
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from openai import OpenAI
 from django.conf import settings
+from django.db import close_old_connections
 
 from logger.set_logger import start_logger
-from counseling_linebot.models import ChatHistory, Session
+from counseling_linebot.models import Session
+from counseling_linebot.utils.context_cache import get_context
+from counseling_linebot.utils.db_handler import get_summary
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+from counseling_linebot.utils.risk_prescreen import PRESCREEN_ENABLED, prescreen
 
 
 conf = settings.MAIN_CONFIG
@@ -14,50 +23,315 @@ logger = start_logger(conf["LOGGER"]["ASYNC_LLM"])
 
 OPENAI_MODEL = conf["OPENAI_MODEL"]
 RISK_PROMPT_PATH = conf["PROMPT"]["RISK_LEVEL_DETECTION"]
+RISK_INCREMENTAL_PROMPT_PATH = conf["PROMPT"].get(
+	"RISK_LEVEL_DETECTION_INCREMENTAL", "./counseling_linebot/prompts/risk_level_detection_incremental.txt"
+)
 
+RISK_CONF = conf.get("RISK_DETECTION", {})
+RISK_MODE = RISK_CONF.get("MODE", "full")   # "full"（毎回全ての対話を評価）, "incremental"（前回の評価以降の対話だけを評価）
+FULL_RESCORE_INTERVAL = RISK_CONF.get("FULL_RESCORE_INTERVAL", 5)   # incremental のとき、全ての対話で評価し直す間隔（ユーザ発話数）
+MAX_RISK_STATES = RISK_CONF.get("MAX_STATES", 1000)   # 保持するセッションごとの評価状態の数
+SUMMARY_ENABLED = conf.get("SUMMARY", {}).get("ENABLED", False)   # 対話の要約がある場合は、要約と要約に含まれていない対話で評価する
+COMBINED_RISK_DETECTION = RISK_CONF.get("COMBINED", False)   # AIモードでは、応答の生成と同時にリスクレベルを推定する（別の呼び出しをしない）
 
-def risk_level_detection_async(user_id, session_id, current_uttr):
-	"""対話履歴からリスクレベルを非同期で推定し、Sessionに保存する。"""
+SPEAKER_LABELS = {"user": "ユーザ", "assistant": "AIカウンセラー", "counselor": "AIカウンセラー"}
+
+# プロンプトのキャッシュ（path -> (更新時刻, 内容)）。ファイルが更新された場合だけ読み直す
+_prompt_cache = {}
+_client = None
+
+# セッションごとの評価状態（incremental のとき）。(user_id, session_id) -> dict
+# 保存した risk_level_seq を持ち、Session の risk_level_seq と異なる場合（他のプロセスでの推定やリセットがあった場合）は使わない
+_risk_states = OrderedDict()
+_risk_states_lock = threading.Lock()
+_call_counts = {"full": 0, "incremental": 0, "prompt_chars": 0, "combined": 0, "combined_fallback": 0}   # LLM の呼び出し回数と送信したプロンプトの文字数
+
+
+def load_prompt(path):
+	"""プロンプトを読み込む（更新時刻が変わっていなければキャッシュを返す）。"""
+	mtime = os.path.getmtime(path)
+	cached = _prompt_cache.get(path)
+	if cached is None or cached[0] != mtime:
+		with open(path, "r", encoding="utf-8") as f:
+			cached = (mtime, f.read())
+		_prompt_cache[path] = cached
+	return cached[1]
+
+
+def get_openai_client():
+	global _client
+	if _client is None:
+		_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+	return _client
+
+
+def _format_turns(turns):
+	return "".join(f"{speaker}: {message}\n" for speaker, message in turns)
+
+
+def _ask_risk_level(prompt, kind):
+	"""プロンプトを送信し、JSON の出力を dict で返す。"""
+	with _risk_states_lock:
+		_call_counts[kind] += 1
+		_call_counts["prompt_chars"] += len(prompt)
+	logger.debug(f"[Risk Detection] Prompt:\n{prompt}")
+	response = get_openai_client().chat.completions.create(
+		model=OPENAI_MODEL,
+		messages=[{"role": "user", "content": prompt}],
+		temperature=0,
+	)
+	content = response.choices[0].message.content or ""
+	if "```" in content:
+		content = content.replace("```json", "").replace("```", "").strip()
+
+	parsed = json.loads(content)
+	parsed["score"] = max(0, min(3, int(parsed.get("score", 0))))
+	parsed["reason"] = parsed.get("reason", "")
+	return parsed
+
+
+def _summarized_turns(user_id, session_id, logs, turns):
+	"""対話の要約がある場合は、(要約に含まれていない対話, 要約) を返す。
+
+	turns の先頭から len(logs) 件は logs（get_context の結果）と対応し、要約に含まれているかは ChatHistory の id で判定する。
+	"""
+	if not SUMMARY_ENABLED:
+		return turns, ""
+	summary, until_id = get_summary(user_id, session_id)
+	if not summary or (logs and until_id > logs[-1]["id"]):
+		return turns, ""
+	summarized = sum(1 for log in logs if log["id"] <= until_id)
+	return turns[summarized:], summary
+
+
+def _detect_full(turns, summary=""):
+	"""全ての対話（要約がある場合は、要約と要約に含まれていない対話）からリスクレベルを推定する。"""
+	dialogue_history = _format_turns(turns)
+	if summary:
+		dialogue_history = f"（これまでの対話の要約）\n{summary}\n\n（要約以降の対話）\n{dialogue_history}"
+	prompt = load_prompt(RISK_PROMPT_PATH).replace("{{ dialogue_history }}", dialogue_history)
+	parsed = _ask_risk_level(prompt, "full")
+	return parsed["score"], parsed["reason"]
+
+
+def _detect_incremental(user_id, session_id, logs, turns, seq=None):
+	"""
+	前回の評価結果・要約と、前回の評価以降の対話だけからリスクレベルを推定する。
+	FULL_RESCORE_INTERVAL 回ごと、またはスコアが上がった場合は、全ての対話で評価し直す。
+
+	turns の先頭から len(logs) 件は logs（get_context の結果）と対応し、前回の評価以降かは ChatHistory の id で判定する。
+	残りは履歴にまだ保存されていない現在の発話で、評価済みとして覚えておき、次回に保存された行として読み込んだときは送らない。
+	"""
+	assessed_id = logs[-1]["id"] if logs else 0
+	unsaved = [message for _, message in turns[len(logs):]]
+	key = (user_id, session_id)
+	with _risk_states_lock:
+		state = _risk_states.get(key)
+	if state is not None and state["seq"] != Session.objects.filter(user_id=user_id).values_list("risk_level_seq", flat=True).first():
+		state = None   # 前回の評価の後に他のプロセスで推定・リセットされた場合は最初から評価する
+	if state is not None and assessed_id < state["assessed_id"]:
+		state = None   # 履歴がリセットされた場合は最初から評価する
+
+	previous = state or {"score": 0, "reason": "なし", "summary": "なし", "assessed_id": 0, "unsaved": [], "user_turns": 0}
+	new_turns = [turn for log, turn in zip(logs, turns) if log["id"] > previous["assessed_id"]]
+	for message in previous["unsaved"]:
+		# 前回の評価に含めた未保存の発話は、保存された後の行として送り直さない
+		if new_turns and new_turns[0] == (SPEAKER_LABELS["user"], message):
+			new_turns.pop(0)
+	new_turns += turns[len(logs):]
+	prompt = (
+		load_prompt(RISK_INCREMENTAL_PROMPT_PATH)
+		.replace("{{ previous_score }}", str(previous["score"]))
+		.replace("{{ previous_reason }}", previous["reason"])
+		.replace("{{ summary }}", previous["summary"])
+		.replace("{{ new_turns }}", _format_turns(new_turns))
+	)
+	parsed = _ask_risk_level(prompt, "incremental")
+	score, reason = parsed["score"], parsed["reason"]
+
+	user_turns = previous["user_turns"] + sum(1 for speaker, _ in new_turns if speaker == SPEAKER_LABELS["user"])
+	if state is not None and (score > previous["score"] or user_turns >= FULL_RESCORE_INTERVAL):
+		logger.debug(f"[Risk Detection] user: {user_id}, 全ての対話で評価し直します（score: {previous['score']} -> {score}, turns: {user_turns}）")
+		score, reason = _detect_full(*_summarized_turns(user_id, session_id, logs, turns))
+		user_turns = 0
+
+	with _risk_states_lock:
+		_risk_states[key] = {
+			"score": score,
+			"reason": reason,
+			"summary": parsed.get("summary") or previous["summary"],
+			"assessed_id": assessed_id,
+			"unsaved": unsaved,
+			"user_turns": user_turns,
+			"seq": seq,
+		}
+		_risk_states.move_to_end(key)
+		while len(_risk_states) > MAX_RISK_STATES:
+			_risk_states.popitem(last=False)
+	return score, reason
+
+
+def risk_level_detection_async(user_id, session_id, current_uttr, seq=None):
+	"""対話履歴からリスクレベルを非同期で推定し、Sessionに保存する。
+
+	seq を指定した場合は、保存済みの risk_level_seq より新しいときだけ保存する（古い推定結果で上書きしない）。
+	"""
 	try:
-		logs = ChatHistory.objects.filter(user_id=user_id)
-		if session_id:
-			logs = logs.filter(session_id=session_id)
-		logs = logs.order_by("post_time")
-
-		dialogue_history = ""
-		for log in logs[1:]:  # 最初のログはセッション開始のシステムメッセージなのでスキップ
-			if log.speaker == "user":
-				speaker_label = "ユーザ"
-			elif log.speaker == "assistant":
-				speaker_label = "AIカウンセラー"
-			elif log.speaker == "counselor":
-				speaker_label = "AIカウンセラー"
-			else:
-				speaker_label = str(log.speaker)
-			dialogue_history += f"{speaker_label}: {log.message}\n"
-		dialogue_history += f"ユーザ: {current_uttr}\n"
-
-		with open(RISK_PROMPT_PATH, "r", encoding="utf-8") as f:
-			prompt_template = f.read()
-		prompt = prompt_template.replace("{{ dialogue_history }}", dialogue_history)
-		logger.debug(f"[Risk Detection] Prompt:\n{prompt}")
-
-		client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])  
-		response = client.chat.completions.create(
-			model=OPENAI_MODEL,
-			messages=[{"role": "user", "content": prompt}],
-			temperature=0,
-		)
-		content = response.choices[0].message.content or ""
-		if "```" in content:
-			content = content.replace("```json", "").replace("```", "").strip()
-
-		parsed = json.loads(content)
-		reason = parsed.get("reason", "")
-		score = int(parsed.get("score", 0))
-		score = max(0, min(3, score))
-		Session.objects.filter(user_id=user_id).update(risk_level=score, risk_level_reason=reason)
-		logger.info(f"[Risk Level] user: {user_id}, risk_level: {score}\n\treason: {reason}")
+		# セッション開始（[START]）以降の対話履歴をキャッシュから取得（キャッシュにない場合は DB から読み込む）
+		logs = get_context(user_id, session_id=session_id)
+
+		turns = [(SPEAKER_LABELS.get(log["speaker"], str(log["speaker"])), log["message"]) for log in logs]
+		# 現在の発話がまだ履歴に保存されていない場合は追加する
+		if not logs or logs[-1]["speaker"] != "user" or logs[-1]["message"] != current_uttr:
+			turns.append((SPEAKER_LABELS["user"], current_uttr))
+
+		if RISK_MODE == "incremental":
+			score, reason = _detect_incremental(user_id, session_id, logs, turns, seq)
+		else:
+			score, reason = _detect_full(*_summarized_turns(user_id, session_id, logs, turns))
+
+		if save_risk_level(user_id, score, reason, seq):
+			logger.info(f"[Risk Level] user: {user_id}, risk_level: {score}\n\treason: {reason}")
+		else:
+			with _risk_states_lock:
+				_risk_states.pop((user_id, session_id), None)   # 保存されなかった評価は次回の前提にしない
+			logger.debug(f"[Risk Level] user: {user_id}, より新しい推定結果が保存済みのため、risk_level: {score} は保存しません")
 
 	except Exception as e:
 		logger.error(f"[Risk Level] Failed to detect risk level for user {user_id}: {e}")
+
+
+def save_risk_level(user_id, score, reason, seq=None):
+	"""リスクレベルを保存する。seq が保存済みの risk_level_seq 以下の場合は保存せず False を返す。"""
+	if seq is None:
+		Session.objects.filter(user_id=user_id).update(risk_level=score, risk_level_reason=reason)
+		return True
+	updated = Session.objects.filter(user_id=user_id, risk_level_seq__lt=seq).update(
+		risk_level=score,
+		risk_level_reason=reason,
+		risk_level_seq=seq,
+	)
+	return bool(updated)
+
+
+class RiskDetectionExecutor:
+	"""
+	リスクレベルの推定を決まった数のスレッドで実行するエグゼキュータ。
+
+	同じユーザの依頼は1つにまとめ、実行待ちの間に新しい依頼が来た場合は最新のものだけを実行する。
+	実行待ちのユーザ数が queue_limit を超えた場合、新しいユーザの依頼は破棄する。
+	"""
+
+	def __init__(self, detect, max_workers=2, queue_limit=100):
+		self.detect = detect
+		self.queue_limit = queue_limit
+		self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="RiskDetection")
+		self.pending = {}       # user_id -> (seq, session_id, current_uttr, 依頼された時刻)
+		self.scheduled = set()  # 実行待ち・実行中のユーザ
+		self.lock = threading.Lock()
+
+		self.submitted = 0
+		self.coalesced = 0
+		self.dropped = 0
+		self.completed = 0
+		self.latency_stats = LatencyStats()   # 依頼から推定完了までの時間
+
+	def submit(self, user_id, session_id, current_uttr):
+		"""リスクレベルの推定を依頼する。キューが満杯で破棄した場合は False を返す。"""
+		seq = time.time_ns()
+		with self.lock:
+			self.submitted += 1
+			if user_id in self.pending:
+				self.coalesced += 1
+			elif user_id not in self.scheduled and len(self.scheduled) >= self.queue_limit:
+				self.dropped += 1
+				logger.warning(f"[Risk Detection] キューが満杯のため、user: {user_id} の依頼を破棄しました")
+				return False
+
+			self.pending[user_id] = (seq, session_id, current_uttr, time.monotonic())
+			if user_id in self.scheduled:
+				return True
+			self.scheduled.add(user_id)
+		self.executor.submit(self._run, user_id)
+		return True
+
+	def _run(self, user_id):
+		close_old_connections()
+		try:
+			while True:
+				with self.lock:
+					item = self.pending.pop(user_id, None)
+					if item is None:
+						self.scheduled.discard(user_id)
+						return
+				seq, session_id, current_uttr, requested_at = item
+				self.detect(user_id, session_id, current_uttr, seq=seq)
+				self.latency_stats.add(time.monotonic() - requested_at)
+				with self.lock:
+					self.completed += 1
+		except BaseException:
+			with self.lock:
+				self.scheduled.discard(user_id)
+			raise
+		finally:
+			close_old_connections()
+
+	def metrics(self):
+		with self.lock:
+			return {
+				"pending": len(self.pending),
+				"scheduled": len(self.scheduled),
+				"submitted": self.submitted,
+				"coalesced": self.coalesced,
+				"dropped": self.dropped,
+				"completed": self.completed,
+				"latency_seconds": self.latency_stats.snapshot(),
+			}
+
+
+risk_executor = RiskDetectionExecutor(
+	risk_level_detection_async,
+	max_workers=RISK_CONF.get("MAX_WORKERS", 2),
+	queue_limit=RISK_CONF.get("QUEUE_LIMIT", 100),
+)
+register_metrics("risk_detection", risk_executor.metrics)
+
+
+def submit_risk_detection(user_id, session_id, current_uttr):
+	"""リスクレベルの推定をバックグラウンドで実行する（同じユーザの依頼は最新のものだけを実行）。
+
+	RISK_PRESCREEN.ENABLED のときは、リスク語を含まない定型の発話（「はい」など）では推定を省略し False を返す。
+	"""
+	if PRESCREEN_ENABLED and not prescreen.needs_llm(current_uttr):
+		logger.debug(f"[Risk Detection] user: {user_id}, リスクを含まない発話のため推定を省略しました")
+		return False
+	return risk_executor.submit(user_id, session_id, current_uttr)
+
+
+def save_combined_risk_level(user_id, session_id, current_uttr, risk, seq):
+	"""応答と同時に推定されたリスクレベル (score, reason) を保存する。
+
+	応答に推定結果が含まれていなかった場合（risk が None）は、別の呼び出しで推定する。
+	"""
+	if risk is None:
+		with _risk_states_lock:
+			_call_counts["combined_fallback"] += 1
+		logger.warning(f"[Risk Level] user: {user_id}, 応答にリスクレベルが含まれていないため、別に推定します")
+		risk_executor.submit(user_id, session_id, current_uttr)
+		return
+
+	with _risk_states_lock:
+		_call_counts["combined"] += 1
+	score, reason = risk
+	if save_risk_level(user_id, score, reason, seq):
+		logger.info(f"[Risk Level] user: {user_id}, risk_level: {score} (combined)\n\treason: {reason}")
+	else:
+		logger.debug(f"[Risk Level] user: {user_id}, より新しい推定結果が保存済みのため、risk_level: {score} は保存しません")
+
+
+def risk_call_metrics():
+	with _risk_states_lock:
+		return {"mode": RISK_MODE, "states": len(_risk_states), **_call_counts}
+
+
+register_metrics("risk_detection_calls", risk_call_metrics)
@@ -1,6 +1,12 @@
+import os
 import re
+import json
+import time
+import zlib
 import random
-from typing import List, Dict, Tuple, Any, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Tuple, Any, Optional, NamedTuple
 
 from openai import OpenAI
 import google.generativeai as genai
@@ -12,9 +18,13 @@ from logger.set_logger import start_logger
 from logger.ansi import *
 from django.conf import settings
 from django.utils import timezone
-from counseling_linebot.models import ChatHistory
+from counseling_linebot.models import ChatHistory, Session
 from counseling_linebot.utils.tool import format_history
 from counseling_linebot.utils.db_handler import save_dialogue_history, get_session
+from counseling_linebot.utils.context_cache import get_context, record_message
+from counseling_linebot.utils.token_budget import fit_to_budget, record_usage
+from counseling_linebot.utils.summarizer import SUMMARY_ENABLED, get_summarized_history, schedule_summary
+from counseling_linebot.utils.async_llm import COMBINED_RISK_DETECTION, save_combined_risk_level
 
 # ロガーの設定
 conf = settings.MAIN_CONFIG
@@ -23,15 +33,37 @@ logger = start_logger(conf['LOGGER']['DIALOGUE'])
 # Constants
 DIALOGUE_FINISHED = 1
 DIALOGUE_NOT_FINISHED = 0
+DIALOGUE_FINISHED_MARKER = "[Dialogue Finished]"
 DEFAULT_GEMINI_MODEL = "gemini-exp-1206"
 DEFAULT_TEMPERATURE = 0.0
 DEFAULT_CONTEXT_NUM = 500   # 指定した user_id のチャット履歴を「新しい順」に最大 DEFAULT_CONTEXT_NUM 件まで取得
 SIMILARITY_THRESHOLD = 40
 RESPONSE_GENERATION_TRIALS = 3
+MARKDOWN_CHARS = ["*", "#", "-", "_"]
+
+# 応答候補の生成方法（sequential: 1つずつ順番に生成, hedged: 一定時間応答がなければ次の候補を並行して生成, parallel: 全候補を同時に生成）
+GENERATION_CONF = conf.get("RESPONSE_GENERATION", {})
+GENERATION_STRATEGY = GENERATION_CONF.get("STRATEGY", "sequential").lower()
+HEDGE_DELAY = GENERATION_CONF.get("HEDGE_DELAY", 3.0)
+STREAMING = GENERATION_CONF.get("STREAMING", False)   # 応答をストリーミングで受信し，生成途中でチェックする
+# プロンプトの構成（random: 試行ごとにexampleをランダムに選択, stable: セッションごとに決まったexampleから順に使い，先頭を同じにしてプロンプトのキャッシュを効かせる）
+PROMPT_LAYOUT = GENERATION_CONF.get("PROMPT_LAYOUT", "random").lower()
+_candidate_executor = ThreadPoolExecutor(max_workers=GENERATION_CONF.get("MAX_WORKERS", 8), thread_name_prefix="Candidate")
+
+# RISK_DETECTION.COMBINED のとき，応答の1行目に危険度の評価（<risk>{"reason": ..., "score": ...}</risk>）を出力させる
+RISK_ENVELOPE_PROMPT_PATH = conf["PROMPT"].get("RISK_ENVELOPE", "./counseling_linebot/prompts/risk_envelope.txt")
+RISK_ENVELOPE_OPEN = "<risk>"
+RISK_ENVELOPE_CLOSE = "</risk>"
+RISK_ENVELOPE_PATTERN = re.compile(r"^\s*<risk>(.*?)</risk>\s*", re.DOTALL)
 
 # Type Aliases for Clarity
 # ChatHistory = List[Dict[str, str]]
 
+# プロセス内で共有するAPIクライアントとCounselorBotのレジストリ
+_api_clients: Dict[Tuple[str, str, str], "APIClient"] = {}
+_counselor_bots: Dict[Tuple[str, str, str, Tuple[str, ...]], "CounselorBot"] = {}
+_registry_lock = threading.Lock()
+
 class APIClient:
     """
     Base class for interacting with AI APIs.
@@ -43,8 +75,58 @@ class APIClient:
         logger.debug(f"\n[Initialized Bot] {self.__class__.__name__} with model: {model_name}, temperature: {temperature}")
 
     def reply(self, history: ChatHistory) -> str:
+        """
+        Returns the response. Raises the API error so that the caller can reject the candidate.
+        """
         raise NotImplementedError("Subclasses must implement the reply method")
 
+    def _stream(self, history: ChatHistory):
+        """
+        Yields text chunks of the response. Closing the generator must stop the generation.
+        """
+        raise NotImplementedError("Subclasses must implement the _stream method")
+
+    def reply_stream(self, history: ChatHistory, cancel_event: Optional[threading.Event] = None, envelope: bool = False) -> Optional[str]:
+        """
+        Streams the response and checks it while it is being generated.
+        Returns the first paragraph once "\n\n" appears. The rest is only read to look for the "[Dialogue Finished]" marker,
+        which is appended to the paragraph as soon as it is found (the stream stops there).
+        Returns None if Markdown appears or cancel_event is set, aborting the generation.
+        If envelope is True, the leading risk envelope is kept as is and only the text after it is checked.
+        API errors are raised so that the caller can reject the candidate.
+        """
+        text = ""
+        answer = None   # 最初の段落（受信した後は，終了の目印だけを探す）
+        rest = 0        # text の中で最初の段落より後の位置
+        stream = self._stream(history)
+        try:
+            for chunk in stream:
+                text += chunk
+                if answer is None:
+                    header, body = split_streamed_envelope(text) if envelope else ("", text)
+                    if body is None:
+                        continue   # 危険度の評価を受信し終わるまではチェックしない
+                    paragraph = body.split("\n\n")[0]
+                    if any(char in paragraph for char in MARKDOWN_CHARS):
+                        logger.debug(f"[Bot] Aborting stream due to Markdown: {paragraph[:100]}...")
+                        return None
+                    if "\n\n" in body:
+                        answer = header + paragraph
+                        rest = len(text) - len(body) + len(paragraph)
+                        if DIALOGUE_FINISHED_MARKER in paragraph:
+                            return answer
+                if answer is not None and DIALOGUE_FINISHED_MARKER in text[rest:]:
+                    return answer + "\n\n" + DIALOGUE_FINISHED_MARKER   # 2段落目以降の目印も，応答全体で判定していたときと同じく終了とする
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.debug(f"[Bot] Stream cancelled: {text[:100]}...")
+                    return None
+            return text if answer is None else answer
+        except Exception as e:
+            logger.debug(f"[Bot] Error streaming from {self.__class__.__name__}: {e}")
+            raise
+        finally:
+            stream.close()
+
 class OpenAIReply(APIClient):
     """
     Handles communication with the OpenAI API.
@@ -57,18 +139,41 @@ class OpenAIReply(APIClient):
     def reply(self, history: ChatHistory) -> str:
         # logger.debug(f"[Sending Request] History To OpenAI.")
         try:
+            start = time.monotonic()
             response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=history,
                 temperature=self.temperature
             )
+            record_usage(self.model_name, response.usage, response_seconds=time.monotonic() - start)
             res = response.choices[0].message.content
             # logger.debug(f"[Response Received] {repr(res)}")
             return res
         
         except Exception as e:
             logger.debug(f"[Bot] Error communicating with OpenAI: {e}")
-            return "申し訳ありませんが、ただいま応答できません。"
+            raise
+
+    def _stream(self, history: ChatHistory):
+        start = time.monotonic()
+        first_token_seconds = None
+        stream = self.client.chat.completions.create(
+            model=self.model_name,
+            messages=history,
+            temperature=self.temperature,
+            stream=True,
+            stream_options={"include_usage": True}   # 最後のチャンクでトークン数を受け取る
+        )
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    record_usage(self.model_name, chunk.usage, first_token_seconds=first_token_seconds)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token_seconds is None:
+                        first_token_seconds = time.monotonic() - start
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()   # 途中で打ち切った場合も接続を閉じて生成を止める
 
 class GeminiReply(APIClient):
     """
@@ -101,12 +206,45 @@ class GeminiReply(APIClient):
             gemini_history, user_input = self._convert_history(history)
             gemini_history = gemini_history[:-1]  # Remove the last message as it's the current user input
             chat = self.client.start_chat(history=gemini_history)
+            start = time.monotonic()
             response = chat.send_message(user_input, generation_config=self.config)
+            record_usage(self.model_name, getattr(response, "usage_metadata", None), response_seconds=time.monotonic() - start)
             logger.debug(f"[Bot] Gemini response received: {response.text}")
             return response.text
         except Exception as e:
             logger.debug(f"[Bot] Error communicating with Gemini: {e}")
-            return "申し訳ありませんが、ただいま応答できません。"
+            raise
+
+    def _stream(self, history: ChatHistory):
+        gemini_history, user_input = self._convert_history(history)
+        gemini_history = gemini_history[:-1]  # Remove the last message as it's the current user input
+        chat = self.client.start_chat(history=gemini_history)
+        start = time.monotonic()
+        first_token_seconds = None
+        response = chat.send_message(user_input, generation_config=self.config, stream=True)
+        try:
+            for chunk in response:
+                if chunk.text:
+                    if first_token_seconds is None:
+                        first_token_seconds = time.monotonic() - start
+                    yield chunk.text
+        finally:
+            # 途中で打ち切った場合も接続を閉じて生成を止め，それまでのトークン数を記録する
+            iterator = getattr(response, "_iterator", None)   # gRPC のストリーム（cancel）または REST のジェネレータ（close）
+            close = getattr(iterator, "cancel", None) or getattr(iterator, "close", None)
+            if close is not None:
+                close()
+            record_usage(self.model_name, getattr(response, "usage_metadata", None), first_token_seconds=first_token_seconds)
+
+class PromptSet(NamedTuple):
+    """
+    The prompts used by CounselorBot. A reload builds a new PromptSet and replaces the old one in a single assignment,
+    so a generation that took the set beforehand never mixes old and new prompts.
+    """
+    mtimes: Dict[str, Optional[float]]
+    system_prompt: str
+    examples: List[str]
+    risk_prompt: str
 
 class CounselorBot:
     """
@@ -132,18 +270,15 @@ class CounselorBot:
         self.conn = None
         self.cursor = None
         
-        # モデルタイプに応じてクライアントを初期化
+        # モデルタイプに応じてクライアントを取得（同じモデルのクライアントはプロセス内で共有し，コネクションを再利用する）
         if self.model_type == "gemini":
             if not self.google_api_key:
                 raise ValueError("Google API key is required for Gemini model")
-            self.client = GeminiReply(api_key=self.google_api_key, model_name=model_name)
-        else:  # デフォルトはOpenAI
-            self.client = OpenAIReply(api_key=self.api_key, model_name=model_name)
+        self.client = get_api_client(self.model_type, model_name, api_key=self.api_key, google_api_key=self.google_api_key)
         
         self._initialize_database()
         logger.debug(f'[Load Examples] {self.example_files}')
-        self.system_prompt = self._load_system_prompt()
-        self.examples = self._load_examples()
+        self.prompts = self._load_prompts()
 
     def _initialize_database(self):
         """
@@ -167,6 +302,19 @@ class CounselorBot:
             logger.error(f"[ERROR] Error loading system prompt: {e}")
             return ""
 
+    def _load_risk_prompt(self) -> str:
+        """
+        Loads the instruction for the risk envelope, appended after the example in combined mode.
+        """
+        if not COMBINED_RISK_DETECTION:
+            return ""
+        try:
+            with open(RISK_ENVELOPE_PROMPT_PATH, "r", encoding='utf-8') as f:
+                return f.read()
+        except Exception as e:
+            logger.error(f"[ERROR] Error loading risk envelope prompt: {e}")
+            return ""
+
     def _load_examples(self) -> List[str]:
         """
         Loads example prompts from the specified files.
@@ -182,6 +330,53 @@ class CounselorBot:
                 logger.error(f"[Bot] Error loading example file {file}: {e}")
         return examples
 
+    def _get_prompt_mtimes(self) -> Dict[str, float]:
+        """
+        Returns the modification times of the system prompt and example files.
+        """
+        mtimes = {}
+        for path in [self.system_prompt_path, RISK_ENVELOPE_PROMPT_PATH] + list(self.example_files):
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _load_prompts(self) -> PromptSet:
+        """
+        Loads all prompt files into a new PromptSet.
+        """
+        mtimes = self._get_prompt_mtimes()   # 読み込み中に更新された場合は，次の確認で読み直す
+        return PromptSet(mtimes, self._load_system_prompt(), self._load_examples(), self._load_risk_prompt())
+
+    @property
+    def prompt_mtimes(self) -> Dict[str, Optional[float]]:
+        return self.prompts.mtimes
+
+    @property
+    def system_prompt(self) -> str:
+        return self.prompts.system_prompt
+
+    @property
+    def examples(self) -> List[str]:
+        return self.prompts.examples
+
+    @property
+    def risk_prompt(self) -> str:
+        return self.prompts.risk_prompt
+
+    def reload_prompts_if_modified(self) -> bool:
+        """
+        Reloads the system prompt and examples only if one of the prompt files has been modified.
+        """
+        mtimes = self._get_prompt_mtimes()
+        if mtimes == self.prompt_mtimes:
+            return False
+
+        logger.info(f"[Reload Prompts] {[path for path in mtimes if mtimes[path] != self.prompt_mtimes.get(path)]}")
+        self.prompts = self._load_prompts()   # 生成中のスレッドは置き換える前のセットを使い続ける
+        return True
+
     def start_message(self, user_id: str) -> str:
         """
         Starts a new conversation with the user, initializes the dialogue in the database.
@@ -191,7 +386,7 @@ class CounselorBot:
         session_id = session.get('session_id', '')
         try:
             post_time = timezone.now()
-            ChatHistory.objects.create(
+            start = ChatHistory.objects.create(
                 user_id=user_id,
                 speaker="user",
                 message="[START]",
@@ -199,10 +394,12 @@ class CounselorBot:
                 finished=DIALOGUE_FINISHED,
                 session_id=session_id,
             )
+            Session.objects.filter(user_id=user_id).update(last_start_id=start.id, summary="", summary_until_id=0)  # セッション開始の目印を保存し，要約をリセット
+            record_message(user_id, "user", "[START]", DIALOGUE_FINISHED, session_id, row_id=start.id)
             save_dialogue_history(user_id, "user", "[START]", session_id, post_time)  # Save to file
 
             post_time = timezone.now()
-            ChatHistory.objects.create(
+            row = ChatHistory.objects.create(
                 user_id=user_id,
                 speaker="assistant",
                 message=self.init_message,
@@ -210,6 +407,7 @@ class CounselorBot:
                 finished=DIALOGUE_NOT_FINISHED,
                 session_id=session_id,
             )
+            record_message(user_id, "assistant", self.init_message, DIALOGUE_NOT_FINISHED, session_id, row_id=row.id)
             save_dialogue_history(user_id, "assistant", self.init_message, session_id, post_time)  # Save to file
             return self.init_message
         except Exception as e:
@@ -222,69 +420,206 @@ class CounselorBot:
         Retrieves the chat history for a given user.
         """
         try:
-            rows = (
-                ChatHistory.objects.filter(user_id=user_id)
-                .order_by("-id")   # 新しいレコード順（id 降順）に並べる
-                .values_list("speaker", "message", "finished")[:context_num]    # モデル全体ではなく3列だけ取得して軽量化したあと，先頭から最大 context_num 件に制限
-            )
-
-            history: ChatHistory = []
-            for speaker, message, finished in rows:
-                if finished == DIALOGUE_FINISHED:
-                    break
-                history.append({"role": speaker, "content": message})
-            return history[::-1]
+            # 最後の区切り（[START], [END]）以降の履歴をキャッシュから取得（キャッシュにない場合は DB から読み込む）
+            rows = get_context(user_id, context_num)
+            return [{"role": row["speaker"], "content": row["message"]} for row in rows]
 
         except Exception as e:
             logger.debug(f"[Bot] Error retrieving chat history for user {user_id}: {e}")
             return []
 
-    def _generate_response(self, history: ChatHistory, trial_num: int = RESPONSE_GENERATION_TRIALS, user_id: str ='') -> Tuple[str, int]:
+    def _get_summarized_history(self, user_id: str, session_id: str, context_num: int) -> Tuple[str, ChatHistory]:
+        """
+        Retrieves the summary of the older turns and the turns not covered by it.
+        Falls back to the raw history (with an empty summary) if summarization is disabled.
+        """
+        if not SUMMARY_ENABLED:
+            return "", self._get_history(user_id, context_num)
+        try:
+            summary, rows = get_summarized_history(user_id, session_id, get_context(user_id, context_num, session_id=session_id))
+            return summary, [{"role": row["speaker"], "content": row["message"]} for row in rows]
+        except Exception as e:
+            logger.debug(f"[Bot] Error retrieving summarized history for user {user_id}: {e}")
+            return "", self._get_history(user_id, context_num)
+
+    def _generate_candidate(self, history: ChatHistory, prompts: PromptSet, example_id: int, cancel_event: Optional[threading.Event] = None, summary: str = "") -> Optional[str]:
+        """
+        Generates a single response candidate with the given example.
+        Returns None if the streamed candidate was aborted or the API call failed.
+        """
+        # 変わらない部分（システムプロンプト，example，指示）を先頭に置き，セッション中に変わる要約は最後に置く
+        prompt = prompts.system_prompt + prompts.examples[example_id] + prompts.risk_prompt
+        if summary:
+            prompt += f"\n\n# これまでの対話の要約\n{summary}\n"
+        # モデルごとのトークン数の上限に収まるように，古い発話を切り詰める・省略する
+        augmented_history, _ = fit_to_budget(prompt, history, self.client.model_name)
+        try:
+            if STREAMING:
+                return self.client.reply_stream(augmented_history, cancel_event=cancel_event, envelope=bool(prompts.risk_prompt))
+            return self.client.reply(augmented_history)
+        except Exception as e:
+            # 失敗した候補は不採用にする（全ての候補が失敗した場合だけ，_select_best_reply で謝罪のメッセージを返す）
+            logger.error(f"[Bot] Error generating candidate with example {self.example_files[example_id]}: {e}")
+            return None
+
+    def _evaluate_candidate(self, generated_response: str, prev_last_reply: str, trial: int, example_id: int, prompts: PromptSet) -> Optional[Tuple[float, str, int, Optional[Tuple[int, str]]]]:
+        """
+        Checks a response candidate. Returns (similarity, response, finished, risk), or None if the candidate is rejected for Markdown.
+        The risk envelope is removed from the response before the checks (risk is None if there is none).
+        """
+        risk = None
+        if prompts.risk_prompt:
+            risk, generated_response = parse_risk_envelope(generated_response)
+            if generated_response.lstrip().startswith(RISK_ENVELOPE_OPEN):
+                logger.debug(f"[Bot] Skipping response due to unterminated risk envelope: {generated_response[:100]}...")
+                return None
+
+        finished = DIALOGUE_NOT_FINISHED
+        if DIALOGUE_FINISHED_MARKER in generated_response:
+            finished = DIALOGUE_FINISHED
+
+        # Skip if the response contains Markdown
+        if any(char in generated_response for char in MARKDOWN_CHARS):
+            logger.debug(f"[Bot] Skipping response due to Markdown: {generated_response[:100]}...")
+            return None
+
+        if "\n\n" in generated_response:
+            generated_response = generated_response.split("\n\n")[0]
+
+        removed_response = re.sub(r"\[.*?\]\s+", "", generated_response)   # AIからの応答に含まれる[]で囲まれた文字列を削除
+        removed_prev_last_reply = re.sub(r"\[.*?\]\s+", "", prev_last_reply)  # 前回の応答に含まれる[]で囲まれた文字列を削除
+        similarity = extract(removed_response, [removed_prev_last_reply])[0][1]   # 前回の応答と，今回生成された応答の類似度を計算
+        logger.debug(f"[Trial {trial+1}] Similarity: {similarity:.3f}, example: {self.example_files[example_id]} \n  Generated response: {repr(removed_response)}")
+        return similarity, generated_response, finished, risk
+
+    def _stable_example_ids(self, session_id: str, trial_num: int, num_examples: int) -> List[int]:
+        """
+        Returns the examples for the trials in "stable" layout: the first trial always uses the same
+        example within a session (so the prompt prefix is byte-identical across turns), later trials the next ones.
+        """
+        base = zlib.crc32(session_id.encode("utf-8"))
+        return [(base + trial) % num_examples for trial in range(trial_num)]
+
+    def _generate_response(self, history: ChatHistory, trial_num: int = RESPONSE_GENERATION_TRIALS, user_id: str ='', summary: str = "", session_id: str = "",
+                           prompts: Optional[PromptSet] = None) -> Tuple[str, int, Optional[Tuple[int, str]]]:
         """
         Generates a response using the AI model, with multiple trials to find a suitable response.
+        Returns (response, finished, risk). risk is (score, reason) from the risk envelope, or None.
+        summary is the summary of the older turns that are no longer in history.
+        All trials use the same prompts (the current PromptSet if not given).
         """
+        prompts = prompts or self.prompts
         log_hist = format_history(history, indent=2, max_chars=200)
-        logger.debug(f"[Sending Request] NumTrials:{trial_num}, History: \n{log_hist}")
+        logger.debug(f"[Sending Request] NumTrials:{trial_num}, Strategy: {GENERATION_STRATEGY}, History: \n{log_hist}")
         prev_last_reply = next((h["content"] for h in reversed(history) if h["role"] == "assistant"), "")
-        best_reply: Tuple[int, Optional[str], int] = (9999, None, DIALOGUE_NOT_FINISHED)
+
+        if GENERATION_STRATEGY in ("hedged", "parallel"):
+            return self._generate_response_concurrent(history, prompts, prev_last_reply, trial_num, user_id, summary, session_id)
+
+        stable_ids = self._stable_example_ids(session_id, trial_num, len(prompts.examples)) if PROMPT_LAYOUT == "stable" else None
+        best_reply: Tuple[int, Optional[str], int, Optional[Tuple[int, str]]] = (9999, None, DIALOGUE_NOT_FINISHED, None)
 
         for i in range(trial_num):
-            rand_id = random.randrange(len(self.examples))   # ランダムにexampleを選択
-            prompt = self.system_prompt + self.examples[rand_id]
-            augmented_history = [{"role": "system", "content": prompt}] + history
-            generated_response = self.client.reply(augmented_history)
-
-            finished = DIALOGUE_NOT_FINISHED
-            if "[Dialogue Finished]" in generated_response:
-                finished = DIALOGUE_FINISHED
-
-            # Skip if the response contains Markdown
-            if any(char in generated_response for char in ["*", "#", "-", "_"]):
-                logger.debug(f"[Bot] Skipping response due to Markdown: {generated_response[:100]}...")
+            rand_id = stable_ids[i] if stable_ids else random.randrange(len(prompts.examples))   # ランダムにexampleを選択（stable のときはセッションごとに決まった順）
+            generated_response = self._generate_candidate(history, prompts, rand_id, summary=summary)
+            if generated_response is None:
                 continue
 
-            if "\n\n" in generated_response:
-                generated_response = generated_response.split("\n\n")[0]
-
-            removed_response = re.sub(r"\[.*?\]\s+", "", generated_response)   # AIからの応答に含まれる[]で囲まれた文字列を削除
-            removed_prev_last_reply = re.sub(r"\[.*?\]\s+", "", prev_last_reply)  # 前回の応答に含まれる[]で囲まれた文字列を削除
-            similarity = extract(removed_response, [removed_prev_last_reply])[0][1]   # 前回の応答と，今回生成された応答の類似度を計算
-            logger.debug(f"[Trial {i+1}] Similarity: {similarity:.3f}, example: {self.example_files[rand_id]} \n  Generated response: {repr(removed_response)}")
+            result = self._evaluate_candidate(generated_response, prev_last_reply, i, rand_id, prompts)
+            if result is None:
+                continue
+            similarity, generated_response, finished, risk = result
 
             if similarity < SIMILARITY_THRESHOLD:
                 logger.info(f"[Acceptable] user: {user_id},  {similarity:.3f} < {SIMILARITY_THRESHOLD}\n  SendMessage: {repr(generated_response)}")
-                return generated_response, finished
+                return generated_response, finished, risk
 
             if similarity < best_reply[0]:
-                best_reply = (similarity, generated_response, finished)
+                best_reply = (similarity, generated_response, finished, risk)
                 # logger.debug(f"[Better Response] Trial {i + 1}, similarity: {similarity}")
 
+        return self._select_best_reply(best_reply, user_id)
+
+    def _generate_response_concurrent(self, history: ChatHistory, prompts: PromptSet, prev_last_reply: str, trial_num: int, user_id: str, summary: str = "", session_id: str = "") -> Tuple[str, int, Optional[Tuple[int, str]]]:
+        """
+        Generates response candidates concurrently and returns the first acceptable one.
+        In "parallel" mode all candidates are started at once. In "hedged" mode the next candidate is
+        started when the running ones take longer than HEDGE_DELAY seconds or one of them is rejected.
+        """
+        # 候補ごとに異なるexampleを使う（exampleの数より試行回数が多い場合はランダムに追加）
+        if PROMPT_LAYOUT == "stable":
+            example_ids = self._stable_example_ids(session_id, trial_num, len(prompts.examples))
+        else:
+            example_ids = random.sample(range(len(prompts.examples)), k=min(trial_num, len(prompts.examples)))
+            example_ids += [random.randrange(len(prompts.examples)) for _ in range(trial_num - len(example_ids))]
+
+        best_reply: Tuple[int, Optional[str], int, Optional[Tuple[int, str]]] = (9999, None, DIALOGUE_NOT_FINISHED, None)
+        pending = {}   # future -> (試行番号, exampleのインデックス)
+        launched = 0
+        cancel_event = threading.Event()   # 採用が決まったら，ストリーミング中の候補の生成を打ち切る
+
+        def launch():
+            nonlocal launched
+            future = _candidate_executor.submit(self._generate_candidate, history, prompts, example_ids[launched], cancel_event, summary)
+            pending[future] = (launched, example_ids[launched])
+            launched += 1
+
+        launch()
+        while GENERATION_STRATEGY == "parallel" and launched < trial_num:
+            launch()
+
+        try:
+            while pending:
+                # hedged: 未起動の候補がある場合は HEDGE_DELAY 秒だけ待ち，応答がなければ次の候補を起動する
+                can_launch = launched < trial_num
+                timeout = HEDGE_DELAY if GENERATION_STRATEGY == "hedged" and can_launch else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    logger.debug(f"[Hedge] user: {user_id}, no response within {HEDGE_DELAY}s. Launching trial {launched + 1}")
+                    launch()
+                    continue
+
+                for future in done:
+                    trial, example_id = pending.pop(future)
+                    try:
+                        generated_response = future.result()
+                    except Exception as e:
+                        logger.error(f"[Bot] Error generating candidate {trial+1}: {e}")
+                        generated_response = None
+
+                    result = None
+                    if generated_response is not None:
+                        result = self._evaluate_candidate(generated_response, prev_last_reply, trial, example_id, prompts)
+
+                    if result is not None:
+                        similarity, generated_response, finished, risk = result
+                        if similarity < SIMILARITY_THRESHOLD:
+                            logger.info(f"[Acceptable] user: {user_id},  {similarity:.3f} < {SIMILARITY_THRESHOLD}\n  SendMessage: {repr(generated_response)}")
+                            return generated_response, finished, risk
+                        if similarity < best_reply[0]:
+                            best_reply = (similarity, generated_response, finished, risk)
+
+                    # 候補が不採用の場合は，待たずに次の候補を起動する
+                    if launched < trial_num:
+                        launch()
+        finally:
+            # 採用が決まった時点で，まだ開始されていない候補はキャンセルし，生成中の候補は打ち切る
+            cancel_event.set()
+            for future in pending:
+                future.cancel()
+
+        return self._select_best_reply(best_reply, user_id)
+
+    def _select_best_reply(self, best_reply: Tuple[int, Optional[str], int, Optional[Tuple[int, str]]], user_id: str) -> Tuple[str, int, Optional[Tuple[int, str]]]:
+        """
+        Returns the most dissimilar candidate when no candidate passed the similarity check.
+        """
         if best_reply[1]:
             logger.warning(f"[Unacceptable] user: {user_id},  {best_reply[0]:.3f} > {SIMILARITY_THRESHOLD}\n  SendMessage: {repr(best_reply[1])}")
-            return best_reply[1], best_reply[2]
+            return best_reply[1], best_reply[2], best_reply[3]
         else:
             logger.info(f"[ERROR] Failed to generate a suitable response after multiple trials.")
-            return "申し訳ありませんが、応答を生成できませんでした。", DIALOGUE_NOT_FINISHED
+            return "申し訳ありませんが、応答を生成できませんでした。", DIALOGUE_NOT_FINISHED, None
 
     def finish_dialogue(self, user_id: str):
         """
@@ -294,7 +629,7 @@ class CounselorBot:
         session_id = get_session(user_id).get('session_id', '')
         try:
             post_time = timezone.now()
-            ChatHistory.objects.create(
+            row = ChatHistory.objects.create(
                 user_id=user_id,
                 speaker="user",
                 message="[END]",
@@ -302,33 +637,50 @@ class CounselorBot:
                 finished=DIALOGUE_FINISHED,
                 session_id=session_id,
             )
+            record_message(user_id, "user", "[END]", DIALOGUE_FINISHED, session_id, row_id=row.id)
             save_dialogue_history(user_id, "user", "[END]", session_id, post_time)  # Save to file
         except Exception as e:
             logger.debug(f"[Bot] Error finishing dialogue for user {user_id}: {e}")
 
-    def reply(self, user_id: str, message: str, remove_thought: bool = False, context_num: int = DEFAULT_CONTEXT_NUM) -> str:
+    def add_user_message(self, user_id: str, message: str, session_id: Optional[str] = None) -> str:
         """
-        Handles a user's message, saves it to the database, generates a response, and saves the response.
+        Saves a user's message to the database without generating a response. Returns the session ID.
         """
         logger.info(f"[Receive Message] user: {user_id}\n  message: {repr(message)}")
-        session_id = get_session(user_id).get('session_id', '')
+        if session_id is None:
+            session_id = get_session(user_id).get('session_id', '')
+        post_time = timezone.now()
+        row = ChatHistory.objects.create(
+            user_id=user_id,
+            speaker="user",
+            message=message,
+            post_time=post_time,
+            finished=DIALOGUE_NOT_FINISHED,
+            session_id=session_id,
+        )
+        record_message(user_id, "user", message, DIALOGUE_NOT_FINISHED, session_id, row_id=row.id)
+        save_dialogue_history(user_id, "user", message, session_id, post_time)  # Save to file
+        return session_id
+
+    def generate_reply(self, user_id: str, message: str, remove_thought: bool = False, context_num: int = DEFAULT_CONTEXT_NUM,
+                       session_id: Optional[str] = None, risk_seq: Optional[int] = None) -> Tuple[str, int]:
+        """
+        Generates a response to the saved history and saves it.
+        message is the latest user utterance (or several coalesced utterances), used for the combined risk level.
+        """
+        if session_id is None:
+            session_id = get_session(user_id).get('session_id', '')
+        if risk_seq is None:
+            risk_seq = time.time_ns()   # リスクレベルを保存する順序（これより後に依頼された推定結果は上書きしない）
         try:
-            post_time = timezone.now()
-            ChatHistory.objects.create(
-                user_id=user_id,
-                speaker="user",
-                message=message,
-                post_time=post_time,
-                finished=DIALOGUE_NOT_FINISHED,
-                session_id=session_id,
-            )
-            save_dialogue_history(user_id, "user", message, session_id, post_time)  # Save to file
-
-            history = self._get_history(user_id, context_num)
-            response, is_finished = self._generate_response(history, user_id=user_id)
+            prompts = self.prompts   # 生成の途中でプロンプトが読み直されても，同じセットを使う
+            summary, history = self._get_summarized_history(user_id, session_id, context_num)
+            response, is_finished, risk = self._generate_response(history, user_id=user_id, summary=summary, session_id=session_id, prompts=prompts)
+            if prompts.risk_prompt:
+                save_combined_risk_level(user_id, session_id, message, risk, risk_seq)
 
             post_time = timezone.now()
-            ChatHistory.objects.create(
+            row = ChatHistory.objects.create(
                 user_id=user_id,
                 speaker="assistant",
                 message=response,
@@ -336,7 +688,9 @@ class CounselorBot:
                 finished=0,
                 session_id=session_id,
             )
+            record_message(user_id, "assistant", response, 0, session_id, row_id=row.id)
             save_dialogue_history(user_id, "assistant", response, session_id, post_time)  # Save to file
+            schedule_summary(user_id, session_id)   # 必要であれば，バックグラウンドで対話の要約を更新
 
             if remove_thought:
                 response = re.sub(r'\[.*?\]', '', response)
@@ -346,3 +700,100 @@ class CounselorBot:
             logger.debug(f"[ERROR] Error processing message from user {user_id}: {e}")
             return "エラーが発生しました。もう一度お試しください。", False
 
+    def reply(self, user_id: str, message: str, remove_thought: bool = False, context_num: int = DEFAULT_CONTEXT_NUM) -> str:
+        """
+        Handles a user's message, saves it to the database, generates a response, and saves the response.
+        """
+        risk_seq = time.time_ns()   # リスクレベルを保存する順序（これより後に依頼された推定結果は上書きしない）
+        try:
+            session_id = self.add_user_message(user_id, message)
+        except Exception as e:
+            logger.debug(f"[ERROR] Error processing message from user {user_id}: {e}")
+            return "エラーが発生しました。もう一度お試しください。", False
+        return self.generate_reply(user_id, message, remove_thought=remove_thought, context_num=context_num,
+                                   session_id=session_id, risk_seq=risk_seq)
+
+def parse_risk_envelope(text: str) -> Tuple[Optional[Tuple[int, str]], str]:
+    """
+    Splits the risk envelope (<risk>{"reason": ..., "score": ...}</risk>) off the beginning of a response.
+    Returns ((score, reason), rest of the response), or (None, response) if there is no valid envelope.
+    """
+    match = RISK_ENVELOPE_PATTERN.match(text)
+    if match is None:
+        return None, text
+    rest = text[match.end():]
+    try:
+        parsed = json.loads(match.group(1))
+        score = max(0, min(3, int(parsed.get("score", 0))))
+        return (score, str(parsed.get("reason", ""))), rest
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.debug(f"[Bot] Invalid risk envelope: {match.group(1)[:100]} ({e})")
+        return None, rest
+
+
+def split_streamed_envelope(text: str) -> Tuple[str, Optional[str]]:
+    """
+    Splits a partially streamed response into (risk envelope, text after it).
+    The text is None while the envelope is still being received.
+    """
+    stripped = text.lstrip()
+    if stripped.startswith(RISK_ENVELOPE_OPEN):
+        end = text.find(RISK_ENVELOPE_CLOSE)
+        if end < 0:
+            return "", None
+        end += len(RISK_ENVELOPE_CLOSE)
+        return text[:end] + "\n", text[end:].lstrip()
+    if RISK_ENVELOPE_OPEN.startswith(stripped):
+        return "", None   # "<ri" など，危険度の評価の途中かどうかまだ判定できない
+    return "", text
+
+
+def get_api_client(model_type: str, model_name: str, api_key: str = "", google_api_key: str = "") -> APIClient:
+    """
+    Returns a process-wide API client for the given model, creating it on first use.
+    """
+    model_type = model_type.lower()
+    key = (model_type, model_name, google_api_key if model_type == "gemini" else api_key)
+    with _registry_lock:
+        client = _api_clients.get(key)
+        if client is None:
+            if model_type == "gemini":
+                client = GeminiReply(api_key=google_api_key, model_name=model_name)
+            else:
+                client = OpenAIReply(api_key=api_key, model_name=model_name)
+            _api_clients[key] = client
+    return client
+
+
+def get_counselor_bot(db_path: str,
+                      init_message: str,
+                      system_prompt_path: str,
+                      example_files: List[str],
+                      api_key: str,
+                      model_name: str,
+                      model_type: str = "openai",
+                      google_api_key: str = "",
+                      language: str = "Japanese") -> CounselorBot:
+    """
+    Returns a shared CounselorBot keyed by model type, model name and prompt set.
+    The prompts are reloaded only when one of the prompt files has been modified.
+    """
+    key = (model_type.lower(), model_name, system_prompt_path, tuple(example_files))
+    with _registry_lock:
+        bot = _counselor_bots.get(key)
+
+    if bot is None:
+        bot = CounselorBot(db_path,
+                           init_message,
+                           system_prompt_path=system_prompt_path,
+                           example_files=example_files,
+                           api_key=api_key,
+                           model_name=model_name,
+                           model_type=model_type,
+                           google_api_key=google_api_key,
+                           language=language)
+        with _registry_lock:
+            bot = _counselor_bots.setdefault(key, bot)
+    else:
+        bot.reload_prompts_if_modified()
+    return bot
@@ -0,0 +1,96 @@
+import time
+import threading
+
+from django.db import close_old_connections
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.scheduler import DeadlineScheduler
+from counseling_linebot.utils.metrics import LatencyStats
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+COALESCE_CONF = conf.get("MESSAGE_COALESCE", {})
+COALESCE_ENABLED = COALESCE_CONF.get("ENABLED", False)
+WINDOW_MS = COALESCE_CONF.get("WINDOW_MS", 1500)       # 最後のメッセージからこの時間（ミリ秒）次のメッセージが来なければ応答する
+MAX_WAIT_MS = COALESCE_CONF.get("MAX_WAIT_MS", 5000)   # 最初のメッセージからこの時間（ミリ秒）を過ぎたら，続けて送られていても応答する
+
+
+class MessageCoalescer:
+    """
+    ユーザごとに，短い間隔で続けて送られたメッセージをまとめて1回だけ処理する（デバウンス）
+    最後のメッセージから window 秒（最初のメッセージから最大 max_wait 秒）経ったら，まとめたメッセージを flush(user_id, items) に渡す
+    flush は DeadlineScheduler のワーカースレッドで実行される
+
+    Parameters:
+        flush: まとめたメッセージを処理する関数（user_id と，add で渡した item のリストを引数に取る）
+        window: 待つ時間（秒）
+        max_wait: 最初のメッセージから待つ最大時間（秒）
+        max_workers: flush を実行するスレッド数
+    """
+    def __init__(self, flush, window: float = 1.5, max_wait: float = 5.0, max_workers: int = 4):
+        self.flush = flush
+        self.window = window
+        self.max_wait = max(window, max_wait)
+        self.scheduler = DeadlineScheduler(max_workers=max_workers, name="Coalesce")
+
+        self.lock = threading.Lock()
+        self.pending = {}   # user_id -> {"task": ScheduledTask, "first_at": float, "items": list}
+
+        self.added = 0
+        self.flushed = 0
+        self.batch_stats = LatencyStats()   # 1回の処理にまとめたメッセージの数
+
+    def add(self, user_id: str, item):
+        """
+        メッセージを追加する．待っているメッセージがあれば，まとめて処理するように期限を延ばす
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.added += 1
+            entry = self.pending.get(user_id)
+            if entry is None:
+                entry = {"task": None, "first_at": now, "items": [item]}
+                self.pending[user_id] = entry
+                entry["task"] = self.scheduler.schedule(self.window, self._fire, (user_id,))
+                return
+            entry["items"].append(item)
+            # 期限が来て _fire がこのロックを待っている場合は延長できないが，追加したメッセージはそのまま処理される
+            self.scheduler.reschedule(entry["task"], min(now + self.window, entry["first_at"] + self.max_wait))
+
+    def _fire(self, user_id: str):
+        with self.lock:
+            entry = self.pending.pop(user_id, None)
+            if entry is None:
+                return
+            self.flushed += 1
+        self.batch_stats.add(len(entry["items"]))
+        if len(entry["items"]) > 1:
+            logger.info(f"[Coalesce] user: {user_id}, messages: {len(entry['items'])}")
+
+        close_old_connections()
+        try:
+            self.flush(user_id, entry["items"])
+        finally:
+            close_old_connections()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            added, flushed = self.added, self.flushed
+            waiting_users = len(self.pending)
+            waiting_messages = sum(len(entry["items"]) for entry in self.pending.values())
+        return {
+            "enabled": COALESCE_ENABLED,
+            "window_ms": int(self.window * 1000),
+            "max_wait_ms": int(self.max_wait * 1000),
+            "waiting_users": waiting_users,
+            "messages": added,
+            "flushes": flushed,
+            "saved_generations": (added - waiting_messages) - flushed,   # まとめたことで省略できた応答の生成の回数
+            "batch_size": self.batch_stats.snapshot(),
+            "scheduler": self.scheduler.metrics(),
+        }
@@ -0,0 +1,181 @@
+import time
+import itertools
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.models import ChatHistory
+from counseling_linebot.utils.metrics import register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+CACHE_CONF = conf.get("CONTEXT_CACHE", {})
+CACHE_ENABLED = CACHE_CONF.get("ENABLED", True)
+VALIDATE = CACHE_CONF.get("VALIDATE", True)   # 読み出しのたびに，ユーザの最新の行の id を DB と比較する（他のプロセスで追加された行を反映する）
+MAX_ROWS = 500   # 1ユーザあたりに保持する最大行数（CounselorBot の DEFAULT_CONTEXT_NUM と同じ）
+
+DIALOGUE_FINISHED = 1
+
+
+class DialogueContextCache:
+    """
+    ユーザごとに，最後の区切り（finished == 1 の行: [START], [END]）より後の対話履歴を保持するキャッシュ
+    ChatHistory に行を追加するたびに append し，キャッシュにないユーザは DB から読み込む
+    max_users を超えた場合は最も長く使われていないユーザから，ttl 秒を過ぎたエントリは読み出し時に削除する
+    エントリにはキャッシュに反映済みの最新の行の id（ユーザごとのバージョン）を持ち，
+    読み出し時に DB の最新の id と異なる場合（他のプロセスで行が追加された場合）は DB から読み込み直す
+
+    rows: [{"id": int, "speaker": str, "message": str, "session_id": str}, ...]（古い順．id は ChatHistory の id）
+    """
+    def __init__(self, max_users: int = 1000, ttl: float = 600):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.entries = OrderedDict()   # user_id -> (有効期限, rows, 最新の行の id)
+        self.lock = threading.Lock()
+        # ユーザごとのバージョン（append のたびに更新）．DB から読み込んでいる間に追加された行を取りこぼさないために使う
+        # 他のユーザへの追加では変わらないので，読み込んだ結果は他のユーザの発話に関係なくキャッシュできる
+        self.versions = OrderedDict()   # user_id -> int
+        self.counter = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0   # 他のプロセスで行が追加されていたため読み込み直した回数
+
+    def get(self, user_id: str, latest_id: Optional[int] = None, validate: bool = False) -> Optional[List[Dict[str, str]]]:
+        """
+        validate が True の場合は，latest_id（DB のユーザの最新の行の id）とエントリの id が異なれば None を返す
+        """
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and validate and entry[2] != latest_id:
+                self.stale += 1
+                entry = None
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return list(entry[1])
+
+    def version(self, user_id: str) -> int:
+        with self.lock:
+            return self.versions.get(user_id, 0)
+
+    def set(self, user_id: str, rows: List[Dict[str, str]], latest_id: Optional[int] = None, version: int = None):
+        with self.lock:
+            # 読み込み中にこのユーザの行が追加された場合は，古い内容になるのでキャッシュしない
+            if version is not None and version != self.versions.get(user_id, 0):
+                return
+            self._set(user_id, rows[-MAX_ROWS:], latest_id)
+
+    def _set(self, user_id, rows, latest_id):
+        self.entries[user_id] = (time.monotonic() + self.ttl, rows, latest_id)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_users:
+            self.entries.popitem(last=False)
+
+    def append(self, user_id: str, speaker: str, message: str, finished: int, session_id: str, row_id: Optional[int] = None):
+        """
+        row_id: 追加した ChatHistory の行の id（省略した場合は，次回の読み出し時に DB から読み込む）
+        """
+        with self.lock:
+            self.versions[user_id] = next(self.counter)
+            self.versions.move_to_end(user_id)
+            while len(self.versions) > self.max_users * 2:   # 古いユーザのバージョンは，読み込み中でなければ不要
+                self.versions.popitem(last=False)
+            if row_id is None:
+                self.entries.pop(user_id, None)
+                return
+            # 区切りの行が追加された場合は，それ以降の履歴は空になる
+            if finished == DIALOGUE_FINISHED:
+                self._set(user_id, [], row_id)
+                return
+
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                # キャッシュにない場合は，次回の読み出し時に DB から読み込む
+                self.entries.pop(user_id, None)
+                return
+            # 同じユーザの処理は user_lock で1つのプロセスだけが実行するので，間に他のプロセスの行は入らない
+            rows = entry[1]
+            rows.append({"id": row_id, "speaker": speaker, "message": message, "session_id": session_id})
+            del rows[:-MAX_ROWS]
+            self._set(user_id, rows, row_id)
+
+    def clear(self, user_id: str):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"users": len(self.entries), "hits": self.hits, "misses": self.misses, "stale": self.stale}
+
+
+context_cache = DialogueContextCache(
+    max_users=CACHE_CONF.get("MAX_USERS", 1000),
+    ttl=CACHE_CONF.get("TTL", 600),
+)
+register_metrics("context_cache", context_cache.stats)
+
+
+def _latest_id(user_id: str) -> Optional[int]:
+    """
+    DB のユーザの最新の行の id（行がない場合は None）
+    """
+    return ChatHistory.objects.filter(user_id=user_id).order_by("-id").values_list("id", flat=True).first()
+
+
+def _load_rows(user_id: str, context_num: int):
+    """
+    DB から最後の区切りより後の対話履歴を，新しい順に最大 context_num 件まで読み込む
+    (対話履歴（古い順）, 最新の行の id) を返す
+    """
+    rows = (
+        ChatHistory.objects.filter(user_id=user_id)
+        .order_by("-id")   # 新しいレコード順（id 降順）に並べる
+        .values_list("id", "speaker", "message", "finished", "session_id")[:context_num]
+    )
+
+    history = []
+    latest_id = None
+    for row_id, speaker, message, finished, session_id in rows:
+        if latest_id is None:
+            latest_id = row_id
+        if finished == DIALOGUE_FINISHED:
+            break
+        history.append({"id": row_id, "speaker": speaker, "message": message, "session_id": session_id})
+    return history[::-1], latest_id
+
+
+def record_message(user_id: str, speaker: str, message: str, finished: int, session_id: str, row_id: Optional[int] = None):
+    """
+    ChatHistory に追加した行（id が row_id）をキャッシュにも反映する
+    """
+    if CACHE_ENABLED:
+        context_cache.append(user_id, speaker, message, finished, session_id, row_id=row_id)
+
+
+def get_context(user_id: str, context_num: int = MAX_ROWS, session_id: str = None) -> List[Dict[str, str]]:
+    """
+    最後の区切りより後の対話履歴を古い順に最大 context_num 件まで取得する
+    session_id を指定した場合は，そのセッションの行だけを返す
+    """
+    rows = None
+    if CACHE_ENABLED:
+        latest_id = _latest_id(user_id) if VALIDATE else None
+        rows = context_cache.get(user_id, latest_id, validate=VALIDATE)
+    if rows is None:
+        version = context_cache.version(user_id)
+        rows, latest_id = _load_rows(user_id, max(context_num, MAX_ROWS))
+        if CACHE_ENABLED:
+            context_cache.set(user_id, rows, latest_id, version=version)
+
+    if session_id:
+        rows = [row for row in rows if row["session_id"] == session_id]
+    return rows[-context_num:]
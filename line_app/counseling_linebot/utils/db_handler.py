@@ -1,4 +1,6 @@
 import json
+import time
+import threading
 from datetime import timedelta
 
 # 自作モジュールのインポート
@@ -20,19 +22,56 @@ SURVEY_LAST_MESSAGE = conf["SURVEY"]['SURVEY_LAST_MESSAGE']
 LANGUAGE = conf["LANGUAGE"]
 SESSIONS_DB = conf["SESSIONS_DB"]
 LINEBOT_DB = conf["LINEBOT_DB"]
+SETTING_CACHE_TTL = conf.get("SETTING_CACHE_TTL", 30)
+
+# Setting の値のプロセス内キャッシュ（key -> (有効期限, value)）
+_setting_cache = {}
+_setting_cache_lock = threading.Lock()
+
+
+def get_setting(key, default=None):
+    """
+    Setting の値を取得する．値はプロセス内に SETTING_CACHE_TTL 秒キャッシュする
+    （他のプロセスで set_setting された場合も，TTL が過ぎれば反映される）
+    """
+    now = time.monotonic()
+    with _setting_cache_lock:
+        entry = _setting_cache.get(key)
+    if entry is not None and entry[0] > now:
+        value = entry[1]
+    else:
+        value = Setting.objects.filter(key=key).values_list("value", flat=True).first()
+        with _setting_cache_lock:
+            _setting_cache[key] = (now + SETTING_CACHE_TTL, value)
+    return default if value is None else value
+
+def set_setting(key, value):
+    """
+    Setting の値を保存し，このプロセスのキャッシュも更新する
+    """
+    value = str(value)
+    Setting.objects.update_or_create(key=key, defaults={"value": value})
+    with _setting_cache_lock:
+        _setting_cache[key] = (time.monotonic() + SETTING_CACHE_TTL, value)
+
+def invalidate_setting(key=None):
+    """
+    Setting のキャッシュを削除する．key を省略した場合は全て削除する
+    """
+    with _setting_cache_lock:
+        if key is None:
+            _setting_cache.clear()
+        else:
+            _setting_cache.pop(key, None)
 
 
 def set_maintenance_mode(enabled: bool, tabs=0):
     indent = "\t" * tabs
     logger.info(f"{indent}[Setting Maintenance Mode] {enabled}")
-    Setting.objects.update_or_create(
-        key="maintenance",
-        defaults={"value": str(int(enabled))},
-    )
+    set_setting("maintenance", int(enabled))
 
 def get_maintenance_mode(tabs=0) -> bool:
-    setting = Setting.objects.filter(key="maintenance").first()
-    value = bool(int(setting.value)) if setting else False
+    value = bool(int(get_setting("maintenance", "0")))
     
     indent = "\t" * tabs
     logger.debug(f"{indent}[Getting Maintenance Mode] {value}")
@@ -85,19 +124,141 @@ def save_session(user_id, data, tabs=0):
     if not updated:
         indent = "\t" * tabs
         logger.error(f"{indent}user_id '{user_id}' が sessions テーブルに存在しません。")
+
+
+class SessionState:
+    """
+    1つのイベントの処理中に使う Session のアクセサ
+    行は最初に1度だけ読み込み，変更したフィールド（session_data, flag, time, risk_level）は flush() でまとめて1回の UPDATE で保存する
+    DB から直接セッションを読む関数（start_chat, survey, reply など）を呼ぶ前には flush() すること
+    同じユーザのイベントは user_lock の中で処理するので，読み込みから flush() までの間に他の処理が行を更新することはない
+    """
+    FIELDS = ("session_data", "flag", "time", "risk_level", "risk_level_seq", "counseling_started_at", "counseling_deadline")
+
+    def __init__(self, user_id, tabs=0):
+        self.user_id = user_id
+        self.tabs = tabs
+        self.values = None
+        self.dirty = set()
+        self.load()
+
+    def load(self):
+        self.values = Session.objects.filter(user_id=self.user_id).values(*self.FIELDS).first()
+        self.dirty.clear()
+        if self.values is None:
+            indent = "\t" * self.tabs
+            logger.error(f"{indent}[Not Found] user_id '{self.user_id}' のセッションが見つかりません。")
+
+    def _get(self, field, default=None):
+        return self.values[field] if self.values is not None else default
+
+    def _set(self, field, value):
+        if self.values is None:
+            indent = "\t" * self.tabs
+            logger.error(f"{indent}user_id '{self.user_id}' が sessions テーブルに存在しません。")
+            return
+        self.values[field] = value
+        self.dirty.add(field)
+
+    @property
+    def session(self):
+        return self._get("session_data")
+
+    @property
+    def flag(self):
+        return self._get("flag")
+
+    @property
+    def time(self):
+        return self._get("time", 0)
+
+    @property
+    def risk_level(self):
+        return self._get("risk_level", 0)
+
+    def save_session(self, data):
+        self._set("session_data", data)
+
+    def save_flag(self, flag):
+        self._set("flag", flag)
+
+    def reset_flag(self):
+        self._set("flag", "")
+
+    def set_time(self, seconds):
+        self._set("time", seconds)
+
+    def reset_risk_level(self):
+        self._set("risk_level", 0)
+        self._set("risk_level_seq", time.time_ns())   # リセット前に依頼された推定結果で上書きしない
+
+    def remaining_time(self):
+        """
+        counseling_deadline から計算したカウンセリングの残り時間（秒）．カウンセリング中でない場合は None
+        """
+        deadline = self._get("counseling_deadline")
+        if deadline is None:
+            return None
+        return max(0, int((deadline - timezone.now()).total_seconds()))
+
+    def start_clock(self, seconds):
+        """
+        カウンセリングの時間計測を開始する（終了予定日時を保存する）
+        """
+        now = timezone.now()
+        self._set("counseling_started_at", now)
+        self._set("counseling_deadline", now + timedelta(seconds=seconds))
+
+    def stop_clock(self, remaining_time=None):
+        """
+        カウンセリングの時間計測を止め，残り時間を time に保存して返す
+        残り時間は counseling_deadline から計算する（未設定の場合は remaining_time を使い，それもなければ None を返す）
+        """
+        if self._get("counseling_deadline") is not None:
+            remaining_time = self.remaining_time()
+        if remaining_time is None:
+            return None
+        self._set("time", int(remaining_time))
+        self._set("counseling_started_at", None)
+        self._set("counseling_deadline", None)
+        return int(remaining_time)
+
+    def flush(self):
+        """
+        変更したフィールドを1回の UPDATE で保存する
+        """
+        if not self.dirty:
+            return
+        fields = {field: self.values[field] for field in self.dirty}
+        self.dirty.clear()
+        updated = Session.objects.filter(user_id=self.user_id).update(**fields)
+        indent = "\t" * self.tabs
+        if not updated:
+            logger.error(f"{indent}user_id '{self.user_id}' が sessions テーブルに存在しません。")
+        else:
+            logger.debug(f"{indent}[Flush Session] user: {self.user_id}, fields: {sorted(fields)}")
     
 
 def reset_all_sessions():
     """
     全ユーザのセッションの"counseling_mode", "survey_mode","survey_progress"をリセットする
+    時間計測中のカウンセリングは，stop_counseling_clock と同じく残り時間を time に保存して終了予定日時を消す
+    （残しておくと，再起動時に recover_timers がタイマーを復元し，終了メッセージが送られてしまう）
     """
+    now = timezone.now()
     for session in Session.objects.all():
         data = session.session_data or {}
         data["counseling_mode"] = False
         data["survey_mode"] = False
         data["survey_progress"] = 0
         session.session_data = data
-        session.save(update_fields=["session_data"])
+        update_fields = ["session_data"]
+        if session.counseling_deadline is not None:
+            session.time = max(0, int((session.counseling_deadline - now).total_seconds()))
+            session.counseling_started_at = None
+            session.counseling_deadline = None
+            update_fields += ["time", "counseling_started_at", "counseling_deadline"]
+        session.save(update_fields=update_fields)
 
 
 
@@ -131,6 +292,10 @@ def reset_all_flags():
 
 def increment_time(user_id, seconds):
     Session.objects.filter(user_id=user_id).update(time=models.F("time") + seconds)
+    # カウンセリング中の場合は，終了予定日時も延長する
+    Session.objects.filter(user_id=user_id, counseling_deadline__isnull=False).update(
+        counseling_deadline=models.F("counseling_deadline") + timedelta(seconds=int(seconds))
+    )
 
 def get_time(user_id, tabs=0):
     session = Session.objects.filter(user_id=user_id).first()
@@ -148,19 +313,100 @@ def set_time(user_id, seconds, tabs=0):
     Session.objects.filter(user_id=user_id).update(time=seconds)
     
 def reset_time(user_id):
-    Session.objects.filter(user_id=user_id).update(time=0)
+    Session.objects.filter(user_id=user_id).update(time=0, counseling_started_at=None, counseling_deadline=None)
+
+
+def expire_counseling_clock(user_id, tolerance=2):
+    """
+    終了予定日時を過ぎたカウンセリングの時間計測を終了し，セッション時間をリセットする
+    終了予定日時を条件にした UPDATE で行うため，複数のプロセスから呼ばれても成功するのは1回だけ
+
+    Returns:
+        (expired, remaining_time): 終了した場合は (True, 0)
+                                   まだ終了予定日時でない場合（延長された場合）は (False, 残り時間)
+                                   すでに終了していた場合は (False, None)
+    """
+    now = timezone.now()
+    updated = Session.objects.filter(
+        user_id=user_id,
+        counseling_deadline__isnull=False,
+        counseling_deadline__lte=now + timedelta(seconds=tolerance),
+    ).update(time=0, counseling_started_at=None, counseling_deadline=None)
+    if updated:
+        return True, 0
+
+    deadline = Session.objects.filter(user_id=user_id).values_list("counseling_deadline", flat=True).first()
+    if deadline is None:
+        return False, None
+    return False, max(0, int((deadline - now).total_seconds()))
+
+def start_counseling_clock(user_id, seconds):
+    """
+    カウンセリングの時間計測を開始する（終了予定日時を保存する）
+    """
+    now = timezone.now()
+    Session.objects.filter(user_id=user_id).update(
+        counseling_started_at=now,
+        counseling_deadline=now + timedelta(seconds=seconds),
+    )
+
+def stop_counseling_clock(user_id, remaining_time=None, tabs=0):
+    """
+    カウンセリングの時間計測を止め，残り時間を time に保存して返す
+    残り時間は counseling_deadline から計算する（未設定の場合は remaining_time を使い，それもなければ None を返す）
+    """
+    deadline = Session.objects.filter(user_id=user_id).values_list("counseling_deadline", flat=True).first()
+    if deadline is not None:
+        remaining_time = max(0, int((deadline - timezone.now()).total_seconds()))
+    if remaining_time is None:
+        indent = "\t" * tabs
+        logger.warning(f"{indent}[Not Found] user_id '{user_id}' のカウンセリングの終了予定日時が見つかりません。")
+        return None
+    Session.objects.filter(user_id=user_id).update(
+        time=int(remaining_time),
+        counseling_started_at=None,
+        counseling_deadline=None,
+    )
+    return int(remaining_time)
 
 
 def reset_risk_level(user_id, tabs=0):
     """
     ユーザのリスクレベルを初期値(0)にリセットする
     """
-    updated = Session.objects.filter(user_id=user_id).update(risk_level=0)
+    updated = Session.objects.filter(user_id=user_id).update(risk_level=0, risk_level_seq=time.time_ns())
     if not updated:
         indent = "\t" * tabs
         logger.error(f"{indent}user_id '{user_id}' が sessions テーブルに存在しません。")
 
 
+def get_summary(user_id, session_id=None):
+    """
+    対話の要約と，要約に含まれている最後の発話の ChatHistory の id を返す
+    session_id を指定した場合，別のセッションの要約であれば ("", 0) を返す
+    summary_until_id が 0 の場合（要約の更新で書かれたものではない summary）も ("", 0) を返す
+    """
+    query = Session.objects.filter(user_id=user_id)
+    if session_id:
+        query = query.filter(session_data__session_id=session_id)
+    row = query.values_list("summary", "summary_until_id").first()
+    if row is None or not row[1]:
+        return "", 0
+    return row
+
+
+def save_summary(user_id, session_id, summary, until_id, prev_until_id):
+    """
+    対話の要約を保存する．同じセッションで，要約が prev_until_id の発話の時点から更新されていない場合だけ保存し，保存できたら True を返す
+    """
+    updated = Session.objects.filter(
+        user_id=user_id,
+        session_data__session_id=session_id,
+        summary_until_id=prev_until_id,
+    ).update(summary=summary, summary_until_id=until_id)
+    return bool(updated)
+
+
 def init_survey(user_id, tabs=0):
     """
     ユーザのアンケートを初期化する
@@ -280,14 +526,17 @@ def delete_expired_reply_tokens(tabs=0):
     return deleted_count
 
     
-def check_and_reset_session(user_id, richmenu_ids, tabs=0):
-    session = get_session(user_id, tabs=tabs)
+def check_and_reset_session(user_id, richmenu_ids, tabs=0, state=None):
+    session = state.session if state is not None else get_session(user_id, tabs=tabs)
     if session['counseling_mode'] == False:
         session['survey_mode'] = False
         richmenu.apply_richmenu(richmenu_ids["START"], user_id)
         indent = "\t" * tabs
         logger.warning(f"{indent}[Reset Session]  '{user_id}' はカウンセリングモードでないため、リッチメニューをSTARTに設定しました。")
-        save_session(user_id, session, tabs=tabs)
+        if state is not None:
+            state.save_session(session)
+        else:
+            save_session(user_id, session, tabs=tabs)
         return True
     
     return False
\ No newline at end of file
@@ -0,0 +1,134 @@
+import time
+import queue
+import threading
+import zlib
+from collections import Counter
+
+from django.db import close_old_connections
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+
+class EventDispatcher:
+    """
+    Webhookで受信したイベントをキューに積み，ワーカースレッドで処理するディスパッチャ
+    同じユーザのイベントは常に同じワーカーのキューに入るため，受信した順番に処理される
+
+    Parameters:
+        dispatch: イベントを1件処理する関数（event を引数に取る）
+        num_workers: ワーカースレッド数
+        queue_size: ワーカーごとのキューの最大長
+        enqueue_timeout: キューが満杯のとき，空きを待つ最大時間（秒）
+    """
+    def __init__(self, dispatch, num_workers: int = 4, queue_size: int = 1000, enqueue_timeout: float = 1.0):
+        self.dispatch = dispatch
+        self.num_workers = max(1, num_workers)
+        self.enqueue_timeout = enqueue_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(self.num_workers)]
+        self.threads = []
+
+        self.wait_stats = LatencyStats()      # 受信からワーカーが処理を開始するまでの時間
+        self.process_stats = LatencyStats()   # ハンドラの処理時間
+        self.total_stats = LatencyStats()     # 受信から処理完了までの時間
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.submit_lock = threading.Lock()   # 空きの確認から追加までの間に，他のリクエストが追加しないようにする
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(q,), name=f"EventWorker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        register_metrics("event_queue", self.metrics)
+        logger.info(f"[Event Dispatcher] workers: {self.num_workers}, queue_size: {self.queues[0].maxsize}")
+
+    def _shard(self, event) -> int:
+        user_id = getattr(getattr(event, "source", None), "user_id", None) or ""
+        return zlib.crc32(user_id.encode("utf-8")) % self.num_workers
+
+    def submit(self, event) -> bool:
+        """
+        イベントをキューに追加する．キューが満杯で追加できなかった場合は False を返す
+        """
+        return self.submit_batch([event])
+
+    def _has_room(self, needed: Counter) -> bool:
+        for shard, count in needed.items():
+            q = self.queues[shard]
+            if q.maxsize > 0 and q.maxsize - q.qsize() < count:
+                return False
+        return True
+
+    def submit_batch(self, events) -> bool:
+        """
+        1つの Webhook で受信したイベントをまとめてキューに追加する
+        全てのイベントを追加できる空きがない場合は，1件も追加せずに False を返す
+        （途中まで追加して失敗すると，LINE プラットフォームが再送したときに追加済みのイベントが2回処理される）
+        """
+        needed = Counter(self._shard(event) for event in events)
+        deadline = time.monotonic() + self.enqueue_timeout
+        with self.submit_lock:
+            # ワーカーが取り出すとキューは空くだけなので，確認した空きは追加するまで減らない
+            while not self._has_room(needed):
+                if time.monotonic() >= deadline:
+                    with self.lock:
+                        self.rejected += len(events)
+                    return False
+                time.sleep(0.01)
+            received_at = time.monotonic()
+            for event in events:
+                self.queues[self._shard(event)].put_nowait((received_at, event))
+        return True
+
+    def _worker(self, q):
+        while True:
+            received_at, event = q.get()
+            started_at = time.monotonic()
+            self.wait_stats.add(started_at - received_at)
+
+            close_old_connections()
+            try:
+                self.dispatch(event)
+                with self.lock:
+                    self.processed += 1
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                logger.error(f"[Event Dispatch Error] {type(event).__name__}: {repr(e)}")
+            finally:
+                close_old_connections()
+                finished_at = time.monotonic()
+                self.process_stats.add(finished_at - started_at)
+                self.total_stats.add(finished_at - received_at)
+                q.task_done()
+
+            logger.debug(
+                f"[Event Processed] {type(event).__name__}, wait: {started_at - received_at:.3f}s, process: {finished_at - started_at:.3f}s"
+            )
+
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            processed, failed, rejected = self.processed, self.failed, self.rejected
+        return {
+            "queue_depth": self.queue_depth(),
+            "queue_depth_per_worker": [q.qsize() for q in self.queues],
+            "processed": processed,
+            "failed": failed,
+            "rejected": rejected,
+            "wait_seconds": self.wait_stats.snapshot(),
+            "process_seconds": self.process_stats.snapshot(),
+            "total_seconds": self.total_stats.snapshot(),
+        }
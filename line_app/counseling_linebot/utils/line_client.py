@@ -0,0 +1,144 @@
+import time
+import threading
+
+from linebot.v3.webhook import WebhookHandler
+from linebot.v3.messaging import (
+    Configuration,
+    ApiClient,
+    MessagingApi,
+    ReplyMessageRequest,
+    PushMessageRequest,
+    BroadcastRequest,
+    ShowLoadingAnimationRequest,
+)
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+LINE_CHANNEL_SECRET = conf["LINE_CHANNEL_SECRET"]
+LINE_ACCESS_TOKEN = conf["LINE_ACCESS_TOKEN"]
+
+CLIENT_CONF = conf.get("LINE_CLIENT", {})
+POOL_SIZE = CLIENT_CONF.get("POOL_SIZE", 16)               # 同時に使える接続の数（Keep-Alive で再利用する）
+CONNECT_TIMEOUT = CLIENT_CONF.get("CONNECT_TIMEOUT", 3.0)  # 接続のタイムアウト（秒）
+READ_TIMEOUT = CLIENT_CONF.get("READ_TIMEOUT", 10.0)       # 応答のタイムアウト（秒）
+API_ENDPOINT = CLIENT_CONF.get("API_ENDPOINT", None)       # 省略時は https://api.line.me（ベンチマークではモックサーバを指定する）
+
+
+def create_configuration(access_token: str = LINE_ACCESS_TOKEN, host: str = API_ENDPOINT, pool_size: int = POOL_SIZE) -> Configuration:
+    configuration = Configuration(access_token=access_token, host=host)
+    configuration.connection_pool_maxsize = pool_size
+    return configuration
+
+
+class LineClient:
+    """
+    プロセス内で共有する LINE Messaging API のクライアント
+    ApiClient（urllib3 の接続プール）を1つだけ作り，全ての送信で接続（TLS セッション）を再利用する
+    urllib3 の PoolManager はスレッドセーフなので，複数のスレッドから同時に呼び出せる
+
+    Parameters:
+        configuration: LINE Messaging API の設定オブジェクト
+        timeout: (接続のタイムアウト, 応答のタイムアウト)（秒）
+    """
+    def __init__(self, configuration: Configuration, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.configuration = configuration
+        self.timeout = timeout
+        self.api_client = ApiClient(configuration)
+        self.messaging_api = MessagingApi(self.api_client)
+
+        self.lock = threading.Lock()
+        self.stats = {}   # 操作名 -> {"latency": LatencyStats, "errors": int}
+
+    def _call(self, name: str, function, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return function(*args, _request_timeout=self.timeout, **kwargs)
+        except Exception:
+            with self.lock:
+                self._get_stats(name)["errors"] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self.lock:
+                stats = self._get_stats(name)
+            stats["latency"].add(elapsed)
+
+    def _get_stats(self, name: str) -> dict:
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = {"latency": LatencyStats(), "errors": 0}
+            self.stats[name] = stats
+        return stats
+
+    def percentile(self, name: str, p: float) -> float:
+        """
+        操作ごとの応答時間のパーセンタイル（秒）．まだ計測していない場合は 0.0
+        """
+        with self.lock:
+            stats = self.stats.get(name)
+        return stats["latency"].percentile(p) if stats is not None else 0.0
+
+    def reply(self, reply_token: str, messages):
+        return self._call(
+            "reply",
+            self.messaging_api.reply_message_with_http_info,
+            ReplyMessageRequest(reply_token=reply_token, messages=messages),
+        )
+
+    def push(self, user_id: str, messages, retry_key: str = None):
+        return self._call(
+            "push",
+            self.messaging_api.push_message_with_http_info,
+            PushMessageRequest(to=user_id, messages=messages),
+            x_line_retry_key=retry_key,
+        )
+
+    def broadcast(self, messages, retry_key: str = None):
+        return self._call(
+            "broadcast",
+            self.messaging_api.broadcast_with_http_info,
+            BroadcastRequest(messages=messages),
+            x_line_retry_key=retry_key,
+        )
+
+    def show_loading_animation(self, user_id: str, seconds: int = 20):
+        """
+        1対1のトークにローディングアニメーションを表示する（メッセージを送信するか seconds 秒経つと消える）
+        seconds は 5 の倍数（5〜60）に丸める
+        """
+        seconds = min(60, max(5, (int(seconds) + 4) // 5 * 5))
+        return self._call(
+            "loading",
+            self.messaging_api.show_loading_animation_with_http_info,
+            ShowLoadingAnimationRequest(chat_id=user_id, loading_seconds=seconds),
+        )
+
+    def get_message_quota(self):
+        return self._call("quota", self.messaging_api.get_message_quota)
+
+    def get_message_quota_consumption(self):
+        return self._call("quota_consumption", self.messaging_api.get_message_quota_consumption)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            stats = {name: (s["latency"], s["errors"]) for name, s in self.stats.items()}
+        return {
+            "pool_size": self.configuration.connection_pool_maxsize,
+            "timeout": list(self.timeout),
+            "requests": {name: {"errors": errors, "latency_seconds": latency.snapshot()} for name, (latency, errors) in stats.items()},
+        }
+
+
+# Webhook の署名検証とイベントの振り分け，送信用のクライアントはプロセス内で1つだけ作る
+handler = WebhookHandler(LINE_CHANNEL_SECRET)
+configuration = create_configuration()
+line_client = LineClient(configuration)
+register_metrics("line_client", line_client.metrics)
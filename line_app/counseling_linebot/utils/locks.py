@@ -0,0 +1,133 @@
+import os
+import time
+import zlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:   # Windows
+    fcntl = None
+    import msvcrt
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+LOCK_CONF = conf.get("USER_LOCK", {})
+LOCK_DIR = LOCK_CONF.get("DIR", "database/locks")
+NUM_STRIPES = LOCK_CONF.get("STRIPES", 1024)   # ロックファイルの数．ユーザIDのハッシュで振り分ける
+POLL_INTERVAL = 0.01
+
+
+class _StripeLock:
+    """
+    1つのロックファイルに対応するロック
+    スレッド間は RLock で，プロセス間はファイルロック（fcntl.flock / msvcrt.locking）で排他制御する
+    同じスレッドからは何度でも取得でき（再入可能），最も外側で取得したときだけファイルをロックする
+    """
+    def __init__(self, path):
+        self.path = path
+        self.rlock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def _try_lock_file(self) -> bool:
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock_file(self):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def acquire(self, timeout=None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self.rlock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        if self.depth > 0:
+            self.depth += 1
+            return True
+
+        try:
+            self.file = open(self.path, "a+b")
+            while not self._try_lock_file():
+                if deadline is not None and time.monotonic() >= deadline:
+                    self.file.close()
+                    self.file = None
+                    self.rlock.release()
+                    return False
+                time.sleep(POLL_INTERVAL)
+        except BaseException:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.rlock.release()
+            raise
+
+        self.depth = 1
+        return True
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            try:
+                self._unlock_file()
+            finally:
+                self.file.close()
+                self.file = None
+        self.rlock.release()
+
+
+_stripes = {}
+_stripes_lock = threading.Lock()
+_wait_stats = LatencyStats()   # ロックの取得を待った時間
+
+
+def _get_stripe(user_id) -> _StripeLock:
+    index = zlib.crc32(str(user_id).encode("utf-8")) % NUM_STRIPES
+    with _stripes_lock:
+        stripe = _stripes.get(index)
+        if stripe is None:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            stripe = _StripeLock(os.path.join(LOCK_DIR, f"user_{index:04d}.lock"))
+            _stripes[index] = stripe
+    return stripe
+
+
+@contextmanager
+def user_lock(user_id, timeout=None):
+    """
+    ユーザごとの排他制御（同じユーザの処理は，スレッド・プロセスをまたいで同時に1つだけ実行される）
+    同じスレッド内では入れ子にして使える．timeout 秒以内に取得できなかった場合は TimeoutError
+
+        with user_lock(user_id):
+            ...
+    """
+    stripe = _get_stripe(user_id)
+    start = time.monotonic()
+    if not stripe.acquire(timeout=timeout):
+        raise TimeoutError(f"user_lock: user_id '{user_id}' のロックを取得できませんでした。")
+    _wait_stats.add(time.monotonic() - start)
+    try:
+        yield
+    finally:
+        stripe.release()
+
+
+register_metrics("user_lock", lambda: {"stripes": len(_stripes), "wait_seconds": _wait_stats.snapshot()})
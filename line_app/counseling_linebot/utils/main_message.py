@@ -1,17 +1,11 @@
 import os
-import threading
+import time
 
-from linebot.v3.webhook import WebhookHandler
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
     ButtonsTemplate,
     MessageAction,
     TemplateMessage,
     TextMessage,
-    PushMessageRequest
 )
 from linebot.v3.webhooks import MessageEvent, StickerMessageContent, TextMessageContent
 from linebot.v3.messaging.models.flex_message import FlexMessage
@@ -22,15 +16,24 @@ from linebot.v3.messaging.models.flex_container import FlexContainer
 from logger.set_logger import start_logger
 from logger.ansi import *
 from django.conf import settings
-from counseling_linebot.utils.bot import CounselorBot
+from django.db.models import Q
+from django.utils import timezone
+from counseling_linebot.models import Session
+from counseling_linebot.utils.bot import get_counselor_bot
 from counseling_linebot.utils import richmenu
-from counseling_linebot.utils.tool import load_config, split_message
+from counseling_linebot.utils.tool import TrackableTimer, load_config, split_message
+from counseling_linebot.utils.locks import user_lock
+from counseling_linebot.utils.outbound_queue import send_reply, send_push
+from counseling_linebot.utils.reply_deadline import reply_deadline
+from counseling_linebot.utils.coalesce import MessageCoalescer, COALESCE_ENABLED, COALESCE_CONF, WINDOW_MS, MAX_WAIT_MS
+from counseling_linebot.utils.metrics import register_metrics
 from counseling_linebot.utils.db_handler import (
     get_session,
     save_session,
     save_flag,
-    reset_time,
-    set_time,
+    expire_counseling_clock,
+    start_counseling_clock,
+    stop_counseling_clock,
     init_survey,
     save_survey,
     get_survey,
@@ -40,6 +43,7 @@ from counseling_linebot.utils.db_handler import (
 # ロガーと設定の読み込み
 conf = settings.MAIN_CONFIG
 richmenu_ids = load_config(conf['RICHMENU_PATH'])
+richmenu.register_richmenu_names(richmenu_ids)
 logger = start_logger(conf['LOGGER']['SYSTEM'])
 
 # ユーザごとのタイマーを管理する辞書．ユーザはボタン以外の動作（リッチメニュー操作や任意のテキスト送信）が可能なので，それらを無効にする
@@ -65,12 +69,14 @@ FINISH_MESSAGE = conf["SURVEY"]['FINISH_MESSAGE']
 
 LINEBOT_DB = conf["LINEBOT_DB"]
 
-LINE_CHANNEL_SECRET = conf["LINE_CHANNEL_SECRET"]
-LINE_ACCESS_TOKEN = conf["LINE_ACCESS_TOKEN"]
+SYSTEM_PROMPT_PATH = "./counseling_linebot/prompts/system_prompt.txt"
+EXAMPLE_FILES = ["./counseling_linebot/prompts/case1_0.txt",
+                 "./counseling_linebot/prompts/case2_0.txt",
+                 "./counseling_linebot/prompts/case3_0.txt",
+                 "./counseling_linebot/prompts/case4_0.txt",
+                 "./counseling_linebot/prompts/case5_0.txt",
+                 "./counseling_linebot/prompts/case6_1.txt"]
 
-#mil-ai
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
-configuration = Configuration(access_token=LINE_ACCESS_TOKEN)
 
 
 def generate_shop_flex_message(url: str, user_id: str):
@@ -131,21 +137,15 @@ def shop(event, tunnel):
         contents=flex_contents
     )
 
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        messaging_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[flex_message]
-            )
-        )
+    send_reply(event.reply_token, [flex_message], user_id=user_id)
     logger.debug(f"[Shop Flex Message] user: {user_id}")
 
 
 
-def start_chat(event, reset=False):
-    user_id = event.source.user_id
-
+def get_bot():
+    """
+    設定中のモデルに対応する CounselorBot を取得する（プロセス内で共有されるインスタンス）
+    """
     # モデルタイプに応じてAPIキーとモデル名を設定
     if MODEL_TYPE.lower() == "gemini":
         api_key = os.environ.get('OPENAI_API_KEY', '')  # OpenAI APIキーは必須パラメータなので空文字でも設定
@@ -156,16 +156,21 @@ def start_chat(event, reset=False):
         google_api_key = ""
         model_name = OPENAI_MODEL
 
-    bot = CounselorBot(LINEBOT_DB, 
+    return get_counselor_bot(LINEBOT_DB, 
                 INIT_MESSAGE, 
                 api_key=api_key, 
                 model_name=model_name,
                 model_type=MODEL_TYPE,
                 google_api_key=google_api_key,
-                system_prompt_path="./counseling_linebot/prompts/system_prompt.txt", 
-                example_files=["./counseling_linebot/prompts/case1_0.txt", "./counseling_linebot/prompts/case2_0.txt", "./counseling_linebot/prompts/case3_0.txt", "./counseling_linebot/prompts/case4_0.txt", "./counseling_linebot/prompts/case5_0.txt", "./counseling_linebot/prompts/case6_1.txt"]
+                system_prompt_path=SYSTEM_PROMPT_PATH, 
+                example_files=EXAMPLE_FILES
                 )
-    
+
+
+def start_chat(event, reset=False):
+    user_id = event.source.user_id
+
+    bot = get_bot()
     init_message = bot.start_message(user_id)
 
     if "]" in init_message:
@@ -178,15 +183,7 @@ def start_chat(event, reset=False):
         init_message = f"### システム通知 ###\n対話履歴をリセットしました。\n\n{init_message}"
 
     msgs = split_message(init_message)
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=msgs
-            )   
-        )
+    send_reply(event.reply_token, msgs, user_id=user_id)
 
                 
 def reply(event, tunnel):
@@ -198,34 +195,75 @@ def reply(event, tunnel):
         return
 
     user_id = event.source.user_id
-    session = get_session(user_id)
-
-    # モデルタイプに応じてAPIキーとモデル名を設定
-    if MODEL_TYPE.lower() == "gemini":
-        api_key = os.environ.get('OPENAI_API_KEY', '')  # OpenAI APIキーは必須パラメータなので空文字でも設定
-        google_api_key = conf.get('GOOGLE_API_KEY', os.environ.get('GOOGLE_API_KEY', ''))
-        model_name = GEMINI_MODEL
-    else:
-        api_key = os.environ['OPENAI_API_KEY']
-        google_api_key = ""
-        model_name = OPENAI_MODEL
+    bot = get_bot()
+
+    if COALESCE_ENABLED:
+        # 発話はすぐに保存し，続けて送られたメッセージとまとめて1回だけ応答する（最新のメッセージの reply_token で返信する）
+        try:
+            session_id = bot.add_user_message(user_id, uttr)
+        except Exception as e:
+            logger.error(f"[ERROR] Error saving message from user {user_id}: {e}")
+            reply_deadline.send(event, [TextMessage(text="エラーが発生しました。もう一度お試しください。")])
+            return
+        coalescer.add(user_id, (event, tunnel, uttr, session_id, time.time_ns()))
+        return
 
-    bot = CounselorBot(LINEBOT_DB, 
-                INIT_MESSAGE, 
-                api_key=api_key, 
-                model_name=model_name,
-                model_type=MODEL_TYPE,
-                google_api_key=google_api_key,
-                system_prompt_path="./counseling_linebot/prompts/system_prompt.txt", 
-                example_files=["./counseling_linebot/prompts/case1_0.txt", 
-                               "./counseling_linebot/prompts/case2_0.txt", 
-                               "./counseling_linebot/prompts/case3_0.txt", 
-                               "./counseling_linebot/prompts/case4_0.txt", 
-                               "./counseling_linebot/prompts/case5_0.txt", 
-                               "./counseling_linebot/prompts/case6_1.txt"]
-                )
+    reply_deadline.start(event)   # 応答の生成に時間がかかる場合はローディングアニメーションを表示する
+    start = time.monotonic()
     response, is_finished = bot.reply(user_id, uttr, remove_thought=True)
-    
+    reply_deadline.record_generation(time.monotonic() - start)
+
+    send_response(event, tunnel, response, is_finished)
+
+
+def reply_coalesced(user_id: str, items):
+    """
+    続けて送られたメッセージ（保存済み）に対して，まとめて1回だけ応答を生成して送信する
+    items: (event, tunnel, 発話, session_id, risk_seq) のリスト（古い順）
+    """
+    event, tunnel, _, session_id, risk_seq = items[-1]
+    with user_lock(user_id):
+        session = get_session(user_id)
+        # 待っている間にカウンセリングの終了やセッションのリセット，人間の対応への切り替えがあった場合は応答しない
+        if (
+            session is None
+            or not session.get("counseling_mode")
+            or session.get("response_mode", "AI") != "AI"
+            or session.get("session_id", "") != session_id
+        ):
+            logger.info(f"[Coalesce] user: {user_id}, session changed while waiting. skip reply")
+            return
+
+        bot = get_bot()
+        reply_deadline.start(event)
+        start = time.monotonic()
+        response, is_finished = bot.generate_reply(
+            user_id,
+            "\n".join(item[2] for item in items),
+            remove_thought=True,
+            session_id=session_id,
+            risk_seq=risk_seq,
+        )
+        reply_deadline.record_generation(time.monotonic() - start)
+
+        send_response(event, tunnel, response, is_finished)
+
+
+coalescer = MessageCoalescer(
+    reply_coalesced,
+    window=WINDOW_MS / 1000,
+    max_wait=MAX_WAIT_MS / 1000,
+    max_workers=COALESCE_CONF.get("MAX_WORKERS", 4),
+)
+register_metrics("message_coalesce", coalescer.metrics)
+
+
+def send_response(event, tunnel, response: str, is_finished):
+    """
+    生成した応答を送信する．対話が終了した場合はアンケートを開始する
+    """
+    user_id = event.source.user_id
+    session = get_session(user_id)
     response = response.strip()
     
     if is_finished:
@@ -235,26 +273,74 @@ def reply(event, tunnel):
         logger.debug(f'[Save Session] user: {user_id}\n  counseling_mode: {session["counseling_mode"]}\n  survey_mode: {session["survey_mode"]}')
 
         # タイマーをストップし，セッション内の時間を更新
-        with threading.Lock():
-            remaining_time = timers[user_id].cancel()  
-            del timers[user_id]  # タイマーを削除
-        set_time(user_id, remaining_time)  # セッション時間を更新
+        with user_lock(user_id):
+            timer = timers.pop(user_id, None)  # タイマーを削除
+        timer_remaining = timer.cancel() if timer is not None else None
+        stop_counseling_clock(user_id, timer_remaining)  # 終了予定日時から残り時間を計算し，セッション時間を更新
 
         richmenu.apply_richmenu(richmenu_ids['SURVEY'], user_id)  # アンケートのリッチメニューを適用
         survey(event, tunnel)    # アンケートを開始
     
     # 通常のカウンセリング対話の応答
     else:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=response)]
-                )   
-            )
+        # reply_token の期限に間に合わない場合は push で送る
+        reply_deadline.send(event, [TextMessage(text=response)])
+
+
+
+def start_timer(user_id: str, seconds):
+    """
+    カウンセリング時間のタイマーを開始する．時間切れになると send_end_message が呼ばれる
+    すでにタイマーがある場合は，キャンセルしてから置き換える（古いタイマーで2回終了しないようにする）
+    """
+    previous = timers.pop(user_id, None)
+    if previous is not None:
+        previous.cancel()
+    timer = TrackableTimer(seconds, send_end_message, args=[user_id])
+    timer.start()
+    timers[user_id] = timer
+    return timer
+
 
+def get_remaining_time(user_id: str, remaining_time=None):
+    """
+    カウンセリングの残り時間（秒）を返す
+    remaining_time には DB の終了予定日時から計算した残り時間を渡す．再起動などでタイマーが失われていた場合は，その時間でタイマーを再開する
+    終了予定日時が未設定で，タイマーもない場合は KeyError
+    """
+    if remaining_time is None:
+        return timers[user_id].remaining_time()
+    if user_id not in timers:
+        logger.warning(f"[Recover Timer] user: {user_id}, remaining_time: {remaining_time} seconds")
+        start_timer(user_id, remaining_time)
+    return remaining_time
+
+
+def recover_timers():
+    """
+    起動時に，カウンセリング中のセッションのタイマーを DB の終了予定日時から再開する
+    終了予定日時を過ぎていたセッションは，すぐに時間切れの処理（send_end_message）を行う
+    """
+    now = timezone.now()
+    rows = Session.objects.filter(
+        Q(counseling_deadline__isnull=False) | Q(session_data__counseling_mode=True)
+    ).values_list("user_id", "counseling_deadline", "time")
+
+    rearmed, expired = 0, 0
+    for user_id, deadline, session_time in rows:
+        if deadline is None:
+            # 終了予定日時を保存する前から続いているセッションは，保存されているセッション時間で再開する
+            remaining_time = session_time
+            start_counseling_clock(user_id, remaining_time)
+        else:
+            remaining_time = max(0, int((deadline - now).total_seconds()))
+
+        start_timer(user_id, remaining_time)
+        if remaining_time > 0:
+            rearmed += 1
+        else:
+            expired += 1
+    logger.info(f"[Recover Timers] rearmed: {rearmed}, expired: {expired}")
 
 
 def send_end_message(user_id: str):
@@ -262,6 +348,24 @@ def send_end_message(user_id: str):
     セッション終了時に指定ユーザへ「終了」メッセージをプッシュ送信し、
     セッション状態を削除する
     """
+    with user_lock(user_id):
+        _send_end_message(user_id)
+
+
+def _send_end_message(user_id: str):
+    timers.pop(user_id, None)  # 時間切れになったタイマーを削除
+
+    # 終了予定日時を条件にして時間計測を終了する（複数のプロセスでタイマーが動いていても，終了処理は1回だけ行われる）
+    expired, remaining_time = expire_counseling_clock(user_id)
+    if not expired:
+        if remaining_time:
+            # 別のプロセスで時間が延長されていた場合は，延長後の終了予定日時でタイマーを再開する
+            logger.debug(f'[Timer Extended] user: {user_id}, remaining_time: {remaining_time} seconds')
+            start_timer(user_id, remaining_time)
+        else:
+            logger.debug(f'[Timer Skipped] user: {user_id} のカウンセリングはすでに終了しています。')
+        return
+
     session = get_session(user_id)
     try:
         logger.debug(f'[Send Message] 時間終了によるカウンセリング対話の終了メッセージと，アンケートの開始確認メッセージを送信')
@@ -269,7 +373,6 @@ def send_end_message(user_id: str):
     except Exception as e:
         logger.error(f"Failed to send end message to user {user_id}: {e}")
     
-    reset_time(user_id)  # セッション時間をリセット
     richmenu.apply_richmenu(richmenu_ids['SURVEY'], user_id)  # アンケートのリッチメニューを適用
     session['counseling_mode'] = False
     session['survey_mode'] = True
@@ -286,34 +389,26 @@ def survey_push(user_id):
         with open(f"survey/trial_{LANGUAGE}_{user_id}.txt", "w") as w:
             w.close()
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        
-        # YES/NOボタンを作成
-        message_template = [
-            TextMessage(text="時間となりましたので，カウンセリング対話を終了いたします。"),
-            TextMessage(text=SURVEY_INIT_MESSAGE),
-            TemplateMessage(
-                alt_text="アンケートにご協力いただけますか？",
-                template=ButtonsTemplate(
-                    text="アンケートにご協力いただけますか？",
-                    actions=[
-                        MessageAction(label=YES, text=YES),
-                        MessageAction(label=NO, text=NO),
-                    ]
-                )
+    # YES/NOボタンを作成
+    message_template = [
+        TextMessage(text="時間となりましたので，カウンセリング対話を終了いたします。"),
+        TextMessage(text=SURVEY_INIT_MESSAGE),
+        TemplateMessage(
+            alt_text="アンケートにご協力いただけますか？",
+            template=ButtonsTemplate(
+                text="アンケートにご協力いただけますか？",
+                actions=[
+                    MessageAction(label=YES, text=YES),
+                    MessageAction(label=NO, text=NO),
+                ]
             )
-        ]
-        line_bot_api.push_message_with_http_info(
-            PushMessageRequest(
-                to=user_id,
-                messages=message_template
-            )   
         )
+    ]
+    send_push(user_id, message_template)
+
+    logger.debug(f'[Save Flag] flag: start_survey, user: {user_id}')
+    save_flag(user_id, flag='start_survey')  # フラグを保存
 
-        logger.debug(f'[Save Flag] flag: start_survey, user: {user_id}')
-        save_flag(user_id, flag='start_survey')  # フラグを保存
-    
 
 def survey(event, tunnel):
 
@@ -336,29 +431,21 @@ def survey(event, tunnel):
 
     # アンケートの開始確認メッセージを送信
     if survey_progress == 0:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            
-            # YES/NOボタンを作成
-            message_template = [
-                TextMessage(text=SURVEY_INIT_MESSAGE),
-                TemplateMessage(
-                    alt_text="アンケートにご協力いただけますか？",
-                    template=ButtonsTemplate(
-                        text="アンケートにご協力いただけますか？",
-                        actions=[
-                            MessageAction(label=YES, text=YES),
-                            MessageAction(label=NO, text=NO),
-                        ]
-                    )
+        # YES/NOボタンを作成
+        message_template = [
+            TextMessage(text=SURVEY_INIT_MESSAGE),
+            TemplateMessage(
+                alt_text="アンケートにご協力いただけますか？",
+                template=ButtonsTemplate(
+                    text="アンケートにご協力いただけますか？",
+                    actions=[
+                        MessageAction(label=YES, text=YES),
+                        MessageAction(label=NO, text=NO),
+                    ]
                 )
-            ]
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=message_template
-                )   
             )
+        ]
+        send_reply(event.reply_token, message_template, user_id=user_id)
 
         logger.debug(f'[Save Flag] flag: start_survey, user: {user_id}')
         save_flag(user_id, flag='start_survey')  # フラグを保存
@@ -370,14 +457,7 @@ def survey(event, tunnel):
             survey_results = get_survey(user_id)
             survey_results[SURVEY_MESSAGES[survey_progress-1]] = uttr
             save_survey(user_id, survey_results)  # アンケート結果を保存
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=SURVEY_LAST_MESSAGE)]
-                    )   
-                )
+            send_reply(event.reply_token, [TextMessage(text=SURVEY_LAST_MESSAGE)], user_id=user_id)
             session["survey_progress"] = 100
             save_session(user_id, session)
             logger.debug(f'[Save Session] user: {user_id}\n  survey_progress: {session["survey_progress"]}')
@@ -413,12 +493,7 @@ def survey(event, tunnel):
                     )
                 )
             ]
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=message_template
-                ) 
-            )
+            send_reply(event.reply_token, message_template, user_id=user_id)
 
 
     # 自由記述アンケート終了時
@@ -430,14 +505,7 @@ def survey(event, tunnel):
         save_survey_results(user_id)  # アンケート結果をファイルに保存
 
         # アンケート終了メッセージを送信
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=FINISH_MESSAGE)]
-                )   
-            )
+        send_reply(event.reply_token, [TextMessage(text=FINISH_MESSAGE)], user_id=user_id)
             
         # 初期化
         richmenu.apply_richmenu(richmenu_ids['START'], user_id)  # リッチメニューを適用
@@ -464,57 +532,45 @@ def survey(event, tunnel):
         current_survey_progress = session.get("survey_progress", 1) # 1から始まる想定
 
         # 5択の回答ボタンを作成
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            # SURVEY_MESSAGES のインデックスは current_survey_progress - 1
-            if current_survey_progress -1 < len(SURVEY_MESSAGES):
-                question_text = SURVEY_MESSAGES[current_survey_progress-1]
-            else:
-                # アンケート項目がない場合はエラーまたは最終処理へ
-                logger.error(f"Survey message index out of bounds for user {user_id}")
-                # ここで最終メッセージを送信するなどの処理が必要かもしれない
-                line_bot_api.reply_message_with_http_info(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=SURVEY_LAST_MESSAGE)] # 仮
-                    )
-                )
-                session["survey_progress"] = 100 # 完了状態へ
-                save_session(user_id, session)
-                logger.debug(f'[Save Session] user: {user_id}\n  survey_progress: {session["survey_progress"]}')
-                return
+        # SURVEY_MESSAGES のインデックスは current_survey_progress - 1
+        if current_survey_progress -1 < len(SURVEY_MESSAGES):
+            question_text = SURVEY_MESSAGES[current_survey_progress-1]
+        else:
+            # アンケート項目がない場合はエラーまたは最終処理へ
+            logger.error(f"Survey message index out of bounds for user {user_id}")
+            # ここで最終メッセージを送信するなどの処理が必要かもしれない
+            send_reply(event.reply_token, [TextMessage(text=SURVEY_LAST_MESSAGE)], user_id=user_id) # 仮
+            session["survey_progress"] = 100 # 完了状態へ
+            save_session(user_id, session)
+            logger.debug(f'[Save Session] user: {user_id}\n  survey_progress: {session["survey_progress"]}')
+            return
 
-            message_template = [
-                TemplateMessage(
-                    alt_text="選択肢",
-                    template=ButtonsTemplate(
-                        text=question_text,
-                        actions=[
-                            MessageAction(label=VERYGOOD, text=VERYGOOD),
-                            MessageAction(label=GOOD, text=GOOD),
-                            MessageAction(label=FAIR, text=FAIR),
-                            # MessageAction(label=BAD, text=BAD),
-                            # MessageAction(label=VERYBAD, text=VERYBAD),
-                        ]
-                    )
-                ),
-                TemplateMessage(
-                    alt_text="続き",
-                    template=ButtonsTemplate(
-                        text="(選択肢つづき)",
-                        actions=[
-                            # MessageAction(label=VERYGOOD, text=VERYGOOD),
-                            # MessageAction(label=GOOD, text=GOOD),
-                            # MessageAction(label=FAIR, text=FAIR),
-                            MessageAction(label=BAD, text=BAD),
-                            MessageAction(label=VERYBAD, text=VERYBAD),
-                        ]
-                    )
+        message_template = [
+            TemplateMessage(
+                alt_text="選択肢",
+                template=ButtonsTemplate(
+                    text=question_text,
+                    actions=[
+                        MessageAction(label=VERYGOOD, text=VERYGOOD),
+                        MessageAction(label=GOOD, text=GOOD),
+                        MessageAction(label=FAIR, text=FAIR),
+                        # MessageAction(label=BAD, text=BAD),
+                        # MessageAction(label=VERYBAD, text=VERYBAD),
+                    ]
+                )
+            ),
+            TemplateMessage(
+                alt_text="続き",
+                template=ButtonsTemplate(
+                    text="(選択肢つづき)",
+                    actions=[
+                        # MessageAction(label=VERYGOOD, text=VERYGOOD),
+                        # MessageAction(label=GOOD, text=GOOD),
+                        # MessageAction(label=FAIR, text=FAIR),
+                        MessageAction(label=BAD, text=BAD),
+                        MessageAction(label=VERYBAD, text=VERYBAD),
+                    ]
                 )
-            ]
-            line_bot_api.reply_message_with_http_info(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=message_template
-                ) 
             )
+        ]
+        send_reply(event.reply_token, message_template, user_id=user_id)
@@ -18,6 +18,10 @@ conf = settings.MAIN_CONFIG
 logger = start_logger(conf['LOGGER']['SYSTEM'])
 
 richmenu_ids = load_config(conf['RICHMENU_PATH'])  # リッチメニューの設定を読み込み
+richmenu.register_richmenu_names(richmenu_ids)
+
+# メンテナンス用リッチメニューの適用方法（"bulk": 一括適用, "default": デフォルトのリッチメニューに設定, "per_user": 1人ずつ適用）
+RICHMENU_APPLY_MODE = conf.get("RICHMENU_BULK", {}).get("MODE", "bulk")
 
 class FileChangeHandler(FileSystemEventHandler):
     def __init__(self, filepath):
@@ -61,6 +65,8 @@ class FileChangeHandler(FileSystemEventHandler):
                     elif richmenu_flag != self.last_richmenu_flag:
                         if richmenu_flag != True:
                             logger.debug(f"[File Change] RICHMENU_FLAG: {richmenu_flag} != True")
+
+                            maintenance_mode_off()
                         elif richmenu_flag == True:
                             logger.debug(f"[File Change] RICHMENU_FLAG: {richmenu_flag} == True")
 
@@ -77,8 +83,10 @@ class FileChangeHandler(FileSystemEventHandler):
 
 def maintenance_mode_on():
     set_maintenance_mode(True)  # メンテナンスモードをオンにする
-    for timer in timers.values():
-        timer.cancel()
+    for user_id in list(timers):
+        timer = timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
     reset_all_sessions()
     reset_all_flags()  # 全てのフラグをリセット
     logger.info("[All Flag Reset]")
@@ -86,6 +94,21 @@ def maintenance_mode_on():
     
     # メンテナンス用のリッチメニューを適用
     all_users = get_all_users()    # データベースから全ユーザを取得
-    logger.info(f'[All Richmenu Applied] maintenance mode for {len(all_users)} users')
-    for user in all_users:
-        richmenu.apply_richmenu(richmenu_ids['MAINTENANCE'], user)
\ No newline at end of file
+    logger.info(f'[All Richmenu Applied] maintenance mode for {len(all_users)} users ({RICHMENU_APPLY_MODE})')
+    if RICHMENU_APPLY_MODE == "default":
+        # デフォルトのリッチメニューをメンテナンス用にし，個別に適用されているリッチメニューを解除する
+        if richmenu.set_default_richmenu(richmenu_ids['MAINTENANCE']):
+            richmenu.bulk_cancel_richmenu(all_users)
+    elif RICHMENU_APPLY_MODE == "per_user":
+        for user in all_users:
+            richmenu.apply_richmenu(richmenu_ids['MAINTENANCE'], user)
+    else:
+        richmenu.bulk_apply_richmenu(richmenu_ids['MAINTENANCE'], all_users)
+
+
+def maintenance_mode_off():
+    # "default" のときだけ，メンテナンス用にしたデフォルトのリッチメニューを解除する（他の方法ではこれまで通り何もしない）
+    if RICHMENU_APPLY_MODE != "default":
+        return
+    richmenu.cancel_default_richmenu()
+    logger.info("[Default Richmenu Canceled] maintenance mode")
@@ -0,0 +1,190 @@
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.line_client import line_client
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+QUOTA_CONF = conf.get("MESSAGE_QUOTA", {})
+REFRESH_INTERVAL = QUOTA_CONF.get("REFRESH_INTERVAL", 300)   # API から送信数を取得し直す間隔（秒）
+WARN_RATIO = QUOTA_CONF.get("WARN_RATIO", 0.9)               # 送信数が上限のこの割合を超えたら警告する
+JST = timezone(timedelta(hours=9))   # 送信数は日本時間の月初にリセットされる
+
+
+def _month_range(now: datetime):
+    start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+class QuotaTracker:
+    """
+    メッセージの送信数（今月の消費数）と上限を手元で管理する
+    API（get_message_quota / get_message_quota_consumption）は REFRESH_INTERVAL 秒ごとにバックグラウンドで取得し，
+    その間に送信した数は手元で数えて加算する．取得した時点で API の値に合わせる（他のプロセスの送信分もここで反映される）
+    LINE の送信数は宛先の人数で数えるので，push は1通につき1，broadcast は宛先の人数が分からないため API から取得し直す
+
+    Parameters:
+        client: LineClient
+        refresh_interval: API から取得し直す間隔（秒）
+    """
+    def __init__(self, client, refresh_interval: float = 300):
+        self.client = client
+        self.refresh_interval = refresh_interval
+
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()   # API からの取得は同時に1つだけ実行する
+        self.quota = None          # 今月の上限（上限なしの場合は None）
+        self.api_usage = 0         # 最後に API から取得した送信数
+        self.local_sent = 0        # API から取得した後に手元で数えた送信数
+        self.fetched_at = None     # 最後に API から取得した時刻（time.monotonic）
+        self.month = None          # 送信数を取得した月（日本時間）
+        self.stale = False         # 手元で数えられない送信（broadcast）があった
+
+        self.fetches = 0
+        self.failed = 0
+        self.drift = 0             # 取得時の API の値と手元の見積もりの差（最後の取得時）
+        self.fetch_stats = LatencyStats()
+
+    def _needs_refresh(self) -> bool:
+        if self.fetched_at is None or self.stale:
+            return True
+        if self.month != datetime.now(JST).strftime("%Y-%m"):
+            return True
+        return time.monotonic() - self.fetched_at >= self.refresh_interval
+
+    def refresh(self):
+        """
+        API から上限と送信数を取得し，手元の見積もりを合わせる
+        """
+        if not self.fetch_lock.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                sent_before = self.local_sent
+                estimate = self.api_usage + sent_before
+                self.stale = False
+            start = time.monotonic()
+            quota = self.client.get_message_quota()
+            consumption = self.client.get_message_quota_consumption()
+            self.fetch_stats.add(time.monotonic() - start)
+
+            month = datetime.now(JST).strftime("%Y-%m")
+            with self.lock:
+                self.quota = quota.value if quota.type == "limited" else None
+                if self.month is not None and self.month == month:
+                    self.drift = consumption.total_usage - estimate
+                self.api_usage = consumption.total_usage
+                self.local_sent -= sent_before   # 取得中に送信した分は残す
+                self.fetched_at = time.monotonic()
+                self.month = month
+                self.fetches += 1
+            self._check_warning()
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+                self.fetched_at = time.monotonic()   # 失敗した場合も次の間隔まで取得し直さない
+            logger.error(f"[Message Quota] Failed to fetch message quota:\n  {repr(e)}")
+        finally:
+            self.fetch_lock.release()
+
+    def _refresh_if_needed(self):
+        with self.lock:
+            needed = self._needs_refresh()
+            first = self.fetched_at is None
+        if not needed:
+            return
+        if first:   # 最初の1回だけは取得を待つ
+            self.refresh()
+        else:
+            threading.Thread(target=self.refresh, name="QuotaTracker", daemon=True).start()
+
+    def usage(self):
+        """
+        (今月の送信数の見積もり, 上限) を返す（上限なしの場合は上限が None）
+        """
+        self._refresh_if_needed()
+        with self.lock:
+            return self.api_usage + self.local_sent, self.quota
+
+    def record(self, count: int = 1):
+        """
+        送信した数を加算し，(加算後の送信数の見積もり, 上限) を返す
+        """
+        with self.lock:
+            self.local_sent += count
+        return self.usage()
+
+    def record_broadcast(self):
+        """
+        broadcast の送信数は宛先の人数なので，次の確認時に API から取得し直す
+        """
+        with self.lock:
+            self.stale = True
+        self._refresh_if_needed()
+
+    def projection(self) -> dict:
+        """
+        今月のこれまでの送信ペースから，月末の送信数と上限に達する日時を見積もる
+        """
+        now = datetime.now(JST)
+        month_start, month_end = _month_range(now)
+        with self.lock:
+            usage = self.api_usage + self.local_sent
+            quota = self.quota
+
+        elapsed = max((now - month_start).total_seconds(), 1.0)
+        rate = usage / elapsed   # 1秒あたりの送信数
+        projected_usage = usage + rate * (month_end - now).total_seconds()
+        exhausted_at = None
+        if quota is not None and rate > 0:
+            exhausted = now + timedelta(seconds=max(quota - usage, 0) / rate)
+            if exhausted < month_end:
+                exhausted_at = exhausted.isoformat(timespec="minutes")
+        return {
+            "usage": usage,
+            "quota": quota,
+            "per_day": round(rate * 86400, 1),
+            "projected_month_end_usage": int(projected_usage),
+            "projected_exhausted_at": exhausted_at,
+        }
+
+    def _check_warning(self):
+        projection = self.projection()
+        usage, quota = projection["usage"], projection["quota"]
+        if quota is None:
+            return
+        if usage >= quota * WARN_RATIO:
+            logger.warning(f"[Message Quota] usage: {usage}/{quota}")
+        elif projection["projected_exhausted_at"] is not None:
+            logger.warning(
+                f"[Message Quota] usage: {usage}/{quota}, projected to run out at {projection['projected_exhausted_at']} "
+                f"({projection['per_day']}/day)"
+            )
+
+    def metrics(self) -> dict:
+        projection = self.projection()
+        with self.lock:
+            projection.update({
+                "api_usage": self.api_usage,
+                "local_sent": self.local_sent,
+                "last_fetch_age_seconds": round(time.monotonic() - self.fetched_at, 1) if self.fetched_at is not None else None,
+                "refresh_interval": self.refresh_interval,
+                "fetches": self.fetches,
+                "failed": self.failed,
+                "drift": self.drift,
+            })
+        projection["fetch_seconds"] = self.fetch_stats.snapshot()
+        return projection
+
+
+quota_tracker = QuotaTracker(line_client, refresh_interval=REFRESH_INTERVAL)
+register_metrics("message_quota", quota_tracker.metrics)
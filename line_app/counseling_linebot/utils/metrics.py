@@ -0,0 +1,73 @@
+import threading
+from collections import deque
+
+
+# 名前ごとにメトリクスの取得関数を登録する辞書（モニター画面から参照する）
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def register_metrics(name: str, provider):
+    """
+    メトリクスの取得関数を登録する．provider は引数なしで dict を返す関数
+    """
+    with _providers_lock:
+        _providers[name] = provider
+
+
+def collect_metrics() -> dict:
+    """
+    登録されている全てのメトリクスを取得する
+    """
+    with _providers_lock:
+        providers = list(_providers.items())
+
+    results = {}
+    for name, provider in providers:
+        try:
+            results[name] = provider()
+        except Exception as e:
+            results[name] = {"error": repr(e)}
+    return results
+
+
+class LatencyStats:
+    """
+    処理時間（秒）を直近 window 件まで保持し，件数・平均・パーセンタイルを集計する
+    """
+    def __init__(self, window: int = 1000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, p: float) -> float:
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(len(samples) * p))
+        return samples[index]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            samples = sorted(self.samples)
+            count = self.count
+
+        if not samples:
+            return {"count": count, "avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+
+        def pick(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+        return {
+            "count": count,
+            "avg": round(sum(samples) / len(samples), 4),
+            "p50": round(pick(0.50), 4),
+            "p95": round(pick(0.95), 4),
+            "max": round(samples[-1], 4),
+        }
@@ -0,0 +1,299 @@
+import os
+import time
+import uuid
+import socket
+import queue
+import zlib
+import threading
+from datetime import datetime, timedelta
+
+from linebot.v3.messaging import Message
+from linebot.v3.messaging.exceptions import ApiException
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from counseling_linebot.models import OutboundMessage
+from counseling_linebot.utils.line_client import line_client
+from counseling_linebot.utils.message_quota import quota_tracker
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+QUEUE_CONF = conf.get("OUTBOUND_QUEUE", {})
+QUEUE_ENABLED = QUEUE_CONF.get("ENABLED", False)
+NUM_WORKERS = QUEUE_CONF.get("NUM_WORKERS", 4)           # 送信するスレッド数（同じユーザへのメッセージは同じスレッドが順番に送る）
+MAX_ATTEMPTS = QUEUE_CONF.get("MAX_ATTEMPTS", 5)         # 1つのメッセージを送信する最大回数
+BACKOFF = QUEUE_CONF.get("BACKOFF", 1.0)                 # 再送の間隔の係数（1, 2, 4, ...秒．Retry-After ヘッダがあればそれに従う）
+MAX_BACKOFF = QUEUE_CONF.get("MAX_BACKOFF", 30.0)        # 再送の間隔の上限（秒）
+REPLY_TOKEN_TTL = QUEUE_CONF.get("REPLY_TOKEN_TTL", 50)  # reply_token を受け取ってからこの秒数を過ぎたら push で送る
+RECOVER_AFTER = QUEUE_CONF.get("RECOVER_AFTER", 300)     # この秒数以上更新されていない（停止したプロセスの）送信待ちのメッセージを送り直す
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_invalid_reply_token(error) -> bool:
+    """
+    reply_token が無効（期限切れ・使用済み）のため reply が拒否されたかどうか
+    400 は不正なメッセージなどでも返るので，本文のメッセージで判定する（この場合だけ push で送り直す）
+    """
+    return getattr(error, "status", None) == 400 and "invalid reply token" in str(getattr(error, "body", "") or "").lower()
+
+
+def push_now(user_id: str, messages, retry_key: str = None):
+    """
+    push で送信し，送信数を数える
+    """
+    line_client.push(user_id, messages, retry_key=retry_key)
+    updated_usage, quota = quota_tracker.record()
+    logger.info(f'[Push Usage] {updated_usage - 1}/{quota} -> {updated_usage}/{quota}')
+
+
+class OutboundQueue:
+    """
+    LINE へのメッセージの送信キュー
+    メッセージは OutboundMessage テーブルに保存してから送信するので，再起動しても送信待ちのものは失われない
+    同じユーザへのメッセージは常に同じワーカーが順番に送る（EventDispatcher と同じ振り分け）
+    429 / 5xx / 通信エラーの場合は指数バックオフで再送し，push は X-Line-Retry-Key で2重に届かないようにする
+    reply_token の期限が切れていた場合（受け取ってから REPLY_TOKEN_TTL 秒を過ぎた場合や，Invalid reply token の 400 が返った場合）は push で送る
+    メッセージには積んだプロセス（owner）を記録し，各プロセスは自分のメッセージの更新日時を RECOVER_AFTER より短い間隔で進める
+    RECOVER_AFTER 秒以上更新されていないメッセージは停止したプロセスのものなので，引き取って送り直す（他のプロセスのキューにあるものは送らない）
+
+    Parameters:
+        client: LineClient
+        num_workers: ワーカースレッド数
+    """
+    def __init__(self, client, num_workers: int = 4):
+        self.client = client
+        self.num_workers = max(1, num_workers)
+        self.queues = [queue.Queue() for _ in range(self.num_workers)]
+        self.threads = []
+        self.start_lock = threading.Lock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self.lock = threading.Lock()
+        self.counts = {"enqueued": 0, "reply": 0, "push": 0, "fallback": 0, "retried": 0, "failed": 0, "recovered": 0}
+        self.wait_stats = LatencyStats()   # キューに積んでから送信が完了するまでの時間
+        self.send_stats = LatencyStats()   # 送信にかかった時間（再送を含む）
+
+    def _count(self, key: str, n: int = 1):
+        with self.lock:
+            self.counts[key] += n
+
+    def start(self):
+        """
+        ワーカーと，送信待ちのメッセージを確認するスレッドを起動する（サーバの起動時に呼ぶ．最初の enqueue でも起動する）
+        確認は起動時とその後 RECOVER_AFTER / 3 秒ごとに行い，停止したプロセスのメッセージを送り直す
+        """
+        with self.start_lock:
+            if self.threads:
+                return
+            for i, q in enumerate(self.queues):
+                thread = threading.Thread(target=self._worker, args=(q,), name=f"OutboundWorker-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            thread = threading.Thread(target=self._recover_loop, name="OutboundRecover", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+            logger.info(f"[Outbound Queue] workers: {self.num_workers}, owner: {self.owner}")
+
+    def _recover_loop(self):
+        while True:
+            close_old_connections()
+            try:
+                self._renew()
+                self._recover()
+            except Exception as e:
+                logger.error(f"[Outbound Queue] Failed to recover messages: {repr(e)}")
+            finally:
+                close_old_connections()
+            time.sleep(RECOVER_AFTER / 3)   # 他のプロセスから停止したと見なされる前に，自分のメッセージの更新日時を進める
+
+    def _renew(self):
+        """
+        このプロセスのキューにある送信待ち・送信中のメッセージの更新日時を進める
+        """
+        OutboundMessage.objects.filter(owner=self.owner, status__in=["pending", "sending"]).update(updated_at=timezone.now())
+
+    def _recover(self):
+        """
+        停止したプロセスのメッセージ（RECOVER_AFTER 秒以上更新されていない送信待ち・送信中のもの）を引き取って送り直す
+        """
+        cutoff = timezone.now() - timedelta(seconds=RECOVER_AFTER)
+        rows = list(
+            OutboundMessage.objects.filter(status__in=["pending", "sending"], updated_at__lt=cutoff)
+            .order_by("id").values_list("id", "user_id")
+        )
+        recovered = 0
+        for row_id, user_id in rows:
+            # 他のプロセスと同時に送り直さないように，owner と更新日時を変えてから積む
+            if OutboundMessage.objects.filter(id=row_id, updated_at__lt=cutoff).update(status="pending", owner=self.owner, updated_at=timezone.now()):
+                self._put(row_id, user_id)
+                self._count("recovered")
+                recovered += 1
+        if recovered:
+            logger.info(f"[Outbound Queue] recovered: {recovered}")
+
+    def _put(self, row_id: int, user_id: str):
+        q = self.queues[zlib.crc32((user_id or "").encode("utf-8")) % self.num_workers]
+        q.put((time.monotonic(), row_id))
+
+    def enqueue(self, kind: str, messages, user_id: str = "", reply_token: str = "", issued_at: float = None) -> int:
+        """
+        メッセージを保存してキューに積み，OutboundMessage の id を返す
+        issued_at: reply_token を受け取った時刻（time.time()．省略時は現在時刻）
+        """
+        self.start()
+        now = timezone.now()
+        token_issued_at = datetime.fromtimestamp(issued_at, tz=now.tzinfo) if issued_at is not None else now
+        row = OutboundMessage.objects.create(
+            kind=kind,
+            user_id=user_id or "",
+            reply_token=reply_token or "",
+            token_issued_at=token_issued_at if kind == "reply" else None,
+            messages=[message.to_dict() for message in messages],
+            retry_key=str(uuid.uuid4()),
+            owner=self.owner,
+            created_at=now,
+            updated_at=now,
+        )
+        self._put(row.id, user_id)
+        self._count("enqueued")
+        return row.id
+
+    def _worker(self, q):
+        while True:
+            enqueued_at, row_id = q.get()
+            close_old_connections()
+            try:
+                self._deliver(row_id, enqueued_at)
+            except Exception as e:
+                self._count("failed")
+                logger.error(f"[Outbound Queue] Unexpected error while sending message {row_id}: {repr(e)}")
+            finally:
+                close_old_connections()
+                q.task_done()
+
+    def _backoff(self, attempt: int, error) -> float:
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("Retry-After") if hasattr(headers, "get") else None
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), MAX_BACKOFF)
+            except ValueError:
+                pass
+        return min(BACKOFF * (2 ** (attempt - 1)), MAX_BACKOFF)
+
+    def _deliver(self, row_id: int, enqueued_at: float):
+        row = OutboundMessage.objects.filter(id=row_id, owner=self.owner).first()
+        if row is None or row.status == "failed":
+            return   # 送信済み・送信に失敗したもの，または他のプロセスが引き取ったもの
+        messages = [Message.from_dict(message) for message in row.messages]
+        start = time.monotonic()
+        ambiguous = False   # 届いたかどうか分からない reply の失敗（5xx / 通信エラー）があった
+
+        while True:
+            row.attempts += 1
+            OutboundMessage.objects.filter(id=row.id).update(status="sending", attempts=row.attempts, kind=row.kind, updated_at=timezone.now())
+
+            if row.kind == "reply" and row.user_id and row.token_issued_at is not None:
+                token_age = (timezone.now() - row.token_issued_at).total_seconds()
+                if token_age > REPLY_TOKEN_TTL and not ambiguous:
+                    logger.info(f"[Outbound Queue] reply token expired ({token_age:.1f}s), falling back to push. user: {row.user_id}")
+                    row.kind = "push"
+                    self._count("fallback")
+
+            try:
+                if row.kind == "reply":
+                    self.client.reply(row.reply_token, messages)
+                else:
+                    push_now(row.user_id, messages, retry_key=row.retry_key)
+                break
+
+            except ApiException as e:
+                if row.kind == "push" and e.status == 409:
+                    # 同じ X-Line-Retry-Key の送信がすでに受け付けられている
+                    logger.info(f"[Outbound Queue] push already accepted (retry key: {row.retry_key}). user: {row.user_id}")
+                    break
+                if row.kind == "reply" and is_invalid_reply_token(e) and row.user_id:
+                    if ambiguous:   # 前回の reply が届いていて token が使用済みの可能性があるため，push で送り直さない
+                        logger.warning(f"[Outbound Queue] reply token rejected after an unconfirmed attempt, assuming delivered. user: {row.user_id}")
+                        break
+                    logger.info(f"[Outbound Queue] reply token rejected, falling back to push. user: {row.user_id}")
+                    row.kind = "push"
+                    self._count("fallback")
+                    if row.attempts < MAX_ATTEMPTS:
+                        continue
+                if e.status not in RETRY_STATUSES or row.attempts >= MAX_ATTEMPTS:
+                    self._fail(row, f"{e.status} {e.reason}: {e.body}")
+                    return
+                if row.kind == "reply" and e.status != 429:
+                    ambiguous = True
+                error = e
+
+            except Exception as e:   # 通信エラー・タイムアウト
+                if row.attempts >= MAX_ATTEMPTS:
+                    self._fail(row, repr(e))
+                    return
+                if row.kind == "reply":
+                    ambiguous = True
+                error = e
+
+            delay = self._backoff(row.attempts, error)
+            self._count("retried")
+            logger.warning(f"[Outbound Queue] {row.kind} failed (attempt {row.attempts}/{MAX_ATTEMPTS}), retrying in {delay:.1f}s: {getattr(error, 'status', None) or repr(error)}")
+            time.sleep(delay)
+
+        OutboundMessage.objects.filter(id=row.id).delete()
+        self._count(row.kind)
+        finished = time.monotonic()
+        self.send_stats.add(finished - start)
+        self.wait_stats.add(finished - enqueued_at)
+
+    def _fail(self, row, error: str):
+        OutboundMessage.objects.filter(id=row.id).update(status="failed", last_error=error, updated_at=timezone.now())
+        self._count("failed")
+        logger.error(f"[Outbound Queue] Failed to send {row.kind} to user {row.user_id} after {row.attempts} attempts: {error}")
+
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            counts = dict(self.counts)
+        counts.update({
+            "enabled": QUEUE_ENABLED,
+            "queue_depth": self.queue_depth(),
+            "wait_seconds": self.wait_stats.snapshot(),
+            "send_seconds": self.send_stats.snapshot(),
+        })
+        return counts
+
+
+outbound_queue = OutboundQueue(line_client, num_workers=NUM_WORKERS)
+register_metrics("outbound_queue", outbound_queue.metrics)
+
+
+def send_reply(reply_token: str, messages, user_id: str = None, issued_at: float = None):
+    """
+    reply で送信する．OUTBOUND_QUEUE.ENABLED のときは送信キューに積んですぐに戻る
+    user_id を指定すると，reply_token の期限が切れていた場合に push で送る
+    """
+    if QUEUE_ENABLED:
+        outbound_queue.enqueue("reply", messages, user_id=user_id, reply_token=reply_token, issued_at=issued_at)
+    else:
+        line_client.reply(reply_token, messages)
+
+
+def send_push(user_id: str, messages):
+    """
+    push で送信する．OUTBOUND_QUEUE.ENABLED のときは送信キューに積んですぐに戻る
+    """
+    if QUEUE_ENABLED:
+        outbound_queue.enqueue("push", messages, user_id=user_id)
+    else:
+        push_now(user_id, messages)
@@ -0,0 +1,126 @@
+import time
+import threading
+
+from linebot.v3.messaging.exceptions import ApiException
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.line_client import line_client
+from counseling_linebot.utils.outbound_queue import send_reply, send_push, is_invalid_reply_token
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+DEADLINE_CONF = conf.get("REPLY_DEADLINE", {})
+DEADLINE_ENABLED = DEADLINE_CONF.get("ENABLED", False)
+DEADLINE = DEADLINE_CONF.get("DEADLINE", 50)                 # reply_token を受け取ってから，この秒数までに返信が届かなければ push で送る
+PERCENTILE = DEADLINE_CONF.get("PERCENTILE", 0.95)           # 返信にかかる時間の見積もりに使う，reply の応答時間のパーセンタイル
+LOADING = DEADLINE_CONF.get("LOADING", True)                 # 応答の生成中にローディングアニメーションを表示する
+LOADING_SECONDS = DEADLINE_CONF.get("LOADING_SECONDS", 30)   # ローディングアニメーションを表示する最大秒数（5〜60）
+LOADING_AFTER = DEADLINE_CONF.get("LOADING_AFTER", 2.0)      # 応答の生成時間の中央値がこの秒数以上のときだけ表示する
+
+
+class ReplyDeadline:
+    """
+    reply_token の経過時間を見て，LLM の応答を reply（無料）で返すか push（送信数を消費する）で送るかを決める
+    reply_token の経過時間（イベントの timestamp から）に reply の応答時間のパーセンタイルを足して DEADLINE を超える場合は push で送り，
+    reply が期限切れ（Invalid reply token の 400）で失敗した場合も push で送り直す．応答の生成に時間がかかる場合はローディングアニメーションを表示する
+
+    Parameters:
+        client: LineClient
+        deadline: reply で返せる reply_token の経過時間の上限（秒）
+        percentile: reply の応答時間の見積もりに使うパーセンタイル
+    """
+    def __init__(self, client, deadline: float = 50, percentile: float = 0.95):
+        self.client = client
+        self.deadline = deadline
+        self.percentile = percentile
+
+        self.lock = threading.Lock()
+        self.counts = {"reply": 0, "push": 0, "expired": 0, "loading": 0}
+        self.token_age_stats = LatencyStats()    # 送信時の reply_token の経過時間
+        self.generation_stats = LatencyStats()   # 応答の生成にかかった時間
+
+    def _count(self, key: str):
+        with self.lock:
+            self.counts[key] += 1
+
+    def token_age(self, event) -> float:
+        """
+        reply_token を受け取ってからの経過時間（秒）．イベントの timestamp（ミリ秒）から計算する
+        """
+        if not getattr(event, "timestamp", None):
+            return 0.0
+        return max(0.0, time.time() - event.timestamp / 1000)
+
+    def reply_margin(self) -> float:
+        return self.client.percentile("reply", self.percentile)
+
+    def start(self, event):
+        """
+        応答の生成を始める前に呼ぶ．生成に時間がかかりそうな場合はローディングアニメーションを表示する
+        """
+        if not (DEADLINE_ENABLED and LOADING):
+            return
+        expected = self.generation_stats.percentile(0.5)
+        if self.generation_stats.count and expected < LOADING_AFTER:
+            return
+        try:
+            self.client.show_loading_animation(event.source.user_id, LOADING_SECONDS)
+            self._count("loading")
+        except Exception as e:
+            logger.warning(f"[Reply Deadline] Failed to show loading animation: {repr(e)}")
+
+    def record_generation(self, seconds: float):
+        self.generation_stats.add(seconds)
+
+    def send(self, event, messages):
+        """
+        reply_token の経過時間に応じて，reply か push で送信する
+        """
+        user_id = event.source.user_id
+        age = self.token_age(event)
+        self.token_age_stats.add(age)
+
+        margin = self.reply_margin()
+        if DEADLINE_ENABLED and age + margin > self.deadline:
+            logger.info(f"[Reply Deadline] token age: {age:.1f}s (+{margin:.2f}s) > {self.deadline}s, sending as push. user: {user_id}")
+            send_push(user_id, messages)
+            self._count("push")
+            return
+
+        issued_at = event.timestamp / 1000 if getattr(event, "timestamp", None) else None
+        try:
+            send_reply(event.reply_token, messages, user_id=user_id, issued_at=issued_at)
+            self._count("reply")
+        except ApiException as e:
+            if not is_invalid_reply_token(e):
+                raise
+            self._count("expired")
+            if not DEADLINE_ENABLED:
+                raise
+            logger.warning(f"[Reply Deadline] reply token rejected (age: {age:.1f}s), sending as push. user: {user_id}")
+            send_push(user_id, messages)
+            self._count("push")
+
+    def metrics(self) -> dict:
+        with self.lock:
+            counts = dict(self.counts)
+        sent = counts["reply"] + counts["push"]
+        counts.update({
+            "enabled": DEADLINE_ENABLED,
+            "deadline": self.deadline,
+            "push_ratio": round(counts["push"] / sent, 4) if sent else 0.0,
+            "reply_margin_seconds": round(self.reply_margin(), 4),
+            "token_age_seconds": self.token_age_stats.snapshot(),
+            "generation_seconds": self.generation_stats.snapshot(),
+        })
+        return counts
+
+
+reply_deadline = ReplyDeadline(line_client, deadline=DEADLINE, percentile=PERCENTILE)
+register_metrics("reply_deadline", reply_deadline.metrics)
@@ -1,4 +1,12 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 自作モジュールのインポート
 from logger.set_logger import start_logger
@@ -12,6 +20,63 @@ logger = start_logger(conf['LOGGER']['SYSTEM'])
 # LINEチャンネルアクセストークン
 ACCESS_TOKEN = conf['LINE_ACCESS_TOKEN']
 
+HTTP_CONF = conf.get("RICHMENU_HTTP", {})
+TIMEOUT = HTTP_CONF.get("TIMEOUT", 10)   # 1リクエストあたりのタイムアウト（秒）
+API_ENDPOINT = HTTP_CONF.get("API_ENDPOINT", "https://api.line.me").rstrip("/")
+DATA_ENDPOINT = HTTP_CONF.get("DATA_ENDPOINT", "https://api-data.line.me").rstrip("/")
+
+# 複数ユーザへのリッチメニューの一括適用
+BULK_CONF = conf.get("RICHMENU_BULK", {})
+BULK_CHUNK_SIZE = min(BULK_CONF.get("CHUNK_SIZE", 500), 500)   # 1リクエストあたりのユーザ数（LINE APIの上限は500）
+BULK_MAX_WORKERS = BULK_CONF.get("MAX_WORKERS", 2)
+BULK_PROGRESS_FILE = BULK_CONF.get("PROGRESS_FILE", "database/richmenu_bulk_progress.json")
+BULK_RESUME_TTL = BULK_CONF.get("RESUME_TTL", 3600)   # 進捗ファイルから再開する期限（秒）．古い進捗は破棄する
+
+
+def _create_http_session():
+    """
+    リッチメニューAPI用の HTTP セッションを作成する
+    接続を使い回し（keep-alive），429/5xx の場合は指数バックオフでリトライする（Retry-After ヘッダがあればそれに従う）
+    """
+    retry = Retry(
+        total=HTTP_CONF.get("RETRIES", 3),
+        backoff_factor=HTTP_CONF.get("BACKOFF", 0.5),
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST", "DELETE"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=2,   # api.line.me と api-data.line.me
+        pool_maxsize=HTTP_CONF.get("POOL_SIZE", 10),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Authorization": f"Bearer {ACCESS_TOKEN}"})
+    return session
+
+http = _create_http_session()
+
+# richmenu_id -> リッチメニュー名（ログ出力用）．create_richmenu と register_richmenu_names で登録する
+richmenu_names = {}
+
+
+def register_richmenu_names(richmenu_ids, prefix=""):
+    """
+    richmenu_ids.yaml の内容から richmenu_id -> 名前 の対応を登録する
+    create_richmenu で名前が登録されていない ID は，yaml のキー（例: REMAINING_TIME.10）を名前とする
+    """
+    if not richmenu_ids:
+        return
+    for key, value in richmenu_ids.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            register_richmenu_names(value, prefix=f"{name}.")
+        elif value:
+            richmenu_names.setdefault(str(value), name)
+
 def consent():
     """
     ユーザーIDを受け取り、リッチメニューの作成・画像アップロード、
@@ -318,30 +383,25 @@ def start():
 def create_richmenu(richmenu_data, image_path):
 
     # リッチメニュー一覧取得
-    headers = {'Authorization': f'Bearer {ACCESS_TOKEN}'}
-    response = requests.get('https://api.line.me/v2/bot/richmenu/list', headers=headers)
+    response = http.get(f'{API_ENDPOINT}/v2/bot/richmenu/list', timeout=TIMEOUT)
     richmenus = response.json().get('richmenus', [])
     # formatted_richmenus = format_structure(richmenus)
     # logger.debug(f"{formatted_richmenus}")
     for richmenu in richmenus:
         if richmenu['name'] == richmenu_data['name']:
             logger.ddebug(f"[RichMenu Already Exists] richmenu_id: {richmenu['richMenuId']}, name: {richmenu['name']}")
+            richmenu_names[richmenu['richMenuId']] = richmenu['name']
             return richmenu['richMenuId']
 
                    
     # リッチメニュー作成APIのURL
-    richmenu_url = "https://api.line.me/v2/bot/richmenu"
-
-    # リクエストヘッダー（JSON）
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    richmenu_url = f"{API_ENDPOINT}/v2/bot/richmenu"
 
     # リッチメニュー作成のリクエスト送信
-    response = requests.post(richmenu_url, headers=headers, json=richmenu_data)
+    response = http.post(richmenu_url, json=richmenu_data, timeout=TIMEOUT)
     if response.status_code == 200:
         richmenu_id = response.json()["richMenuId"]
+        richmenu_names[richmenu_id] = richmenu_data['name']
     else:
         logger.error(f"[RichMenu Creation Failed] error: {response.json()}")
     
@@ -349,16 +409,15 @@ def create_richmenu(richmenu_data, image_path):
 
     # 画像アップロードのヘッダー
     image_headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
         "Content-Type": "image/png"
     }
 
     # 画像アップロードAPIのURL
-    image_upload_url = f"https://api-data.line.me/v2/bot/richmenu/{richmenu_id}/content"
+    image_upload_url = f"{DATA_ENDPOINT}/v2/bot/richmenu/{richmenu_id}/content"
 
     # 画像ファイルを開いてPOSTリクエストを送信
     with open(image_path, "rb") as img:
-        image_response = requests.post(image_upload_url, headers=image_headers, data=img)
+        image_response = http.post(image_upload_url, headers=image_headers, data=img, timeout=TIMEOUT)
 
     if image_response.status_code == 200:
         logger.info(f"[RichMenu Image Upload Success] richmenu_id: {richmenu_id}, image: {image_path}")
@@ -382,6 +441,7 @@ def create_richmenus(config):
     for i in range(61):
         config['REMAINING_TIME'][i] = remaining_time(i)
 
+    register_richmenu_names(config)
     return config
 
 
@@ -390,17 +450,11 @@ def apply_richmenu(richmenu_id, user_id, tabs=0):
     indent = "\t" * tabs
 
     # ユーザーにリッチメニューを適用するAPIのURL
-    apply_richmenu_url = f"https://api.line.me/v2/bot/user/{user_id}/richmenu/{richmenu_id}"
+    apply_richmenu_url = f"{API_ENDPOINT}/v2/bot/user/{user_id}/richmenu/{richmenu_id}"
 
-    # ユーザー適用用ヘッダー
-    apply_headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
-    
-    apply_response = requests.post(apply_richmenu_url, headers=apply_headers)
+    apply_response = http.post(apply_richmenu_url, timeout=TIMEOUT)
 
-    richmenu_data = requests.get(f"https://api.line.me/v2/bot/richmenu/{richmenu_id}", headers=apply_headers).json()
-    richmenu_name = richmenu_data.get('name', 'Unknown RichMenu')
+    richmenu_name = richmenu_names.get(str(richmenu_id), richmenu_id)
 
     if apply_response.status_code == 200:
         logger.debug(f"{indent}[RichMenu Applied] {richmenu_name}, user: {user_id}")
@@ -408,20 +462,143 @@ def apply_richmenu(richmenu_id, user_id, tabs=0):
         logger.error(f"{indent}[RichMenu Apply Failed] error: {apply_response.json()}\nuser: {user_id}")
 
 
+def _load_bulk_progress(progress_file, key):
+    """
+    前回中断した一括処理の進捗（処理済みのユーザID）を読み込む．key が異なる場合や期限切れの場合は新しい処理として扱う
+    """
+    if not progress_file or not os.path.exists(progress_file):
+        return set(), time.time()
+    try:
+        with open(progress_file, "r", encoding="utf-8") as f:
+            progress = json.load(f)
+    except Exception as e:
+        logger.warning(f"[RichMenu Bulk] 進捗ファイルを読み込めませんでした: {repr(e)}")
+        return set(), time.time()
+    started_at = progress.get("started_at", 0)
+    if progress.get("key") != key or time.time() - started_at > BULK_RESUME_TTL:
+        return set(), time.time()
+    return set(progress.get("done", [])), started_at
+
+
+def _save_bulk_progress(progress_file, key, done, started_at):
+    if not progress_file:
+        return
+    tmp_path = f"{progress_file}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"key": key, "started_at": started_at, "done": sorted(done)}, f)
+    os.replace(tmp_path, progress_file)
+
+
+def _bulk_request(path, payload, user_ids, key, chunk_size=None, max_workers=None, progress_file=None):
+    """
+    user_ids を chunk_size 件ずつに分け，並列に POST する（payload に userIds を加えて送信）
+    成功したユーザは progress_file に記録し，途中で失敗した場合は次回の呼び出しで残りのユーザから再開する
+    """
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    max_workers = max_workers or BULK_MAX_WORKERS
+    if progress_file is None:
+        progress_file = BULK_PROGRESS_FILE
+
+    done, started_at = _load_bulk_progress(progress_file, key)
+    pending = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in done]
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+    if done:
+        logger.info(f"[RichMenu Bulk] {key}: 前回の進捗から再開します（処理済み: {len(done)}, 残り: {len(pending)}）")
+
+    lock = threading.Lock()
+    result = {"total": len(pending) + len(done), "succeeded": len(done), "failed": 0, "resumed": len(done)}
+
+    def send(chunk):
+        response = http.post(f"{API_ENDPOINT}{path}", json={**payload, "userIds": chunk}, timeout=TIMEOUT)
+        if response.status_code not in (200, 202):
+            raise RuntimeError(f"status: {response.status_code}, body: {response.text}")
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="RichMenuBulk") as executor:
+        futures = {executor.submit(send, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            chunk = futures[future]
+            with lock:
+                try:
+                    future.result()
+                    done.update(chunk)
+                    result["succeeded"] += len(chunk)
+                    _save_bulk_progress(progress_file, key, done, started_at)
+                except Exception as e:
+                    result["failed"] += len(chunk)
+                    logger.error(f"[RichMenu Bulk Failed] {key}: {len(chunk)} users, error: {repr(e)}")
+                logger.info(f"[RichMenu Bulk] {key}: {result['succeeded']}/{result['total']} users (failed: {result['failed']})")
+
+    # 全て成功した場合は進捗ファイルを削除する
+    if result["failed"] == 0 and progress_file and os.path.exists(progress_file):
+        os.remove(progress_file)
+    return result
+
+
+def bulk_apply_richmenu(richmenu_id, user_ids, chunk_size=None, max_workers=None, progress_file=None):
+    """
+    複数のユーザにリッチメニューを一括で適用する（POST /v2/bot/richmenu/bulk/link）
+    """
+    richmenu_name = richmenu_names.get(str(richmenu_id), richmenu_id)
+    logger.info(f"[RichMenu Bulk Link] {richmenu_name}, users: {len(user_ids)}")
+    return _bulk_request(
+        "/v2/bot/richmenu/bulk/link",
+        {"richMenuId": richmenu_id},
+        user_ids,
+        key=f"link:{richmenu_id}",
+        chunk_size=chunk_size,
+        max_workers=max_workers,
+        progress_file=progress_file,
+    )
+
+
+def bulk_cancel_richmenu(user_ids, chunk_size=None, max_workers=None, progress_file=None):
+    """
+    複数のユーザに適用されているリッチメニューを一括で解除する（POST /v2/bot/richmenu/bulk/unlink）
+    解除されたユーザにはデフォルトのリッチメニューが表示される
+    """
+    logger.info(f"[RichMenu Bulk Unlink] users: {len(user_ids)}")
+    return _bulk_request(
+        "/v2/bot/richmenu/bulk/unlink",
+        {},
+        user_ids,
+        key="unlink",
+        chunk_size=chunk_size,
+        max_workers=max_workers,
+        progress_file=progress_file,
+    )
+
+
+def set_default_richmenu(richmenu_id):
+    """
+    デフォルトのリッチメニューを設定する（個別にリッチメニューを適用していない全ユーザに表示される）
+    """
+    response = http.post(f"{API_ENDPOINT}/v2/bot/user/all/richmenu/{richmenu_id}", timeout=TIMEOUT)
+    richmenu_name = richmenu_names.get(str(richmenu_id), richmenu_id)
+    if response.status_code == 200:
+        logger.info(f"[Default RichMenu] {richmenu_name}")
+        return True
+    logger.error(f"[Default RichMenu Failed] {richmenu_name}, error: {response.text}")
+    return False
+
+
+def cancel_default_richmenu():
+    """
+    デフォルトのリッチメニューを解除する
+    """
+    response = http.delete(f"{API_ENDPOINT}/v2/bot/user/all/richmenu", timeout=TIMEOUT)
+    if response.status_code != 200:
+        logger.error(f"[Cancel Default RichMenu Failed] error: {response.text}")
+
+
 def cancel_richmenu(user_id):
     """
     ユーザーIDを受け取り、そのユーザーに適用されているリッチメニューを削除する関数
     """
     # リッチメニュー削除APIのURL
-    cancel_url = f"https://api.line.me/v2/bot/user/{user_id}/richmenu"
-
-    # ヘッダー
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}"
-    }
+    cancel_url = f"{API_ENDPOINT}/v2/bot/user/{user_id}/richmenu"
 
     # リクエスト送信
-    response = requests.delete(cancel_url, headers=headers)
+    response = http.delete(cancel_url, timeout=TIMEOUT)
 
     if response.status_code == 200:
         print(f"ユーザー {user_id} のリッチメニューが削除されました。")
@@ -430,12 +607,8 @@ def cancel_richmenu(user_id):
 
 
 def delete_all_richmenu():
-    headers = {
-        'Authorization': f'Bearer {ACCESS_TOKEN}'
-    }
-
     # リッチメニュー一覧取得
-    response = requests.get('https://api.line.me/v2/bot/richmenu/list', headers=headers)
+    response = http.get(f'{API_ENDPOINT}/v2/bot/richmenu/list', timeout=TIMEOUT)
     richmenus = response.json().get('richmenus', [])
 
     logger.info(len(richmenus))
@@ -444,7 +617,7 @@ def delete_all_richmenu():
     # 一括削除
     for rm in richmenus:
         richmenu_id = rm['richMenuId']
-        del_response = requests.delete(f'https://api.line.me/v2/bot/richmenu/{richmenu_id}', headers=headers)
+        del_response = http.delete(f'{API_ENDPOINT}/v2/bot/richmenu/{richmenu_id}', timeout=TIMEOUT)
         logger.info(f'Deleted {richmenu_id}: {del_response.status_code}')
 
 
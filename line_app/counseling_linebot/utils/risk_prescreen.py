@@ -0,0 +1,126 @@
+import re
+import time
+import threading
+import unicodedata
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+PRESCREEN_CONF = conf.get("RISK_PRESCREEN", {})
+PRESCREEN_ENABLED = PRESCREEN_CONF.get("ENABLED", False)
+
+# リスクを示す語（1つでも含まれていれば必ず LLM で推定する．ひらがな・カタカナは区別しない）
+# 英字だけの語（OD など）は単語として一致した場合だけ照合する
+RISK_TERMS = [
+    "死", "しね", "しにたい", "しのう", "氏ね", "自殺", "自死", "消えたい", "きえたい", "消えろ", "消えてしまいたい", "いなくなりたい",
+    "生きたくない", "生きる意味", "生きてる意味", "生まれてこなければ", "終わりにしたい", "終わらせたい", "楽になりたい",
+    "首を吊", "首吊", "首をつ", "吊りたい", "飛び降り", "とびおり", "身投げ", "練炭", "遺書", "リストカット", "リスカ", "自傷", "切りたい",
+    "OD", "オーバードーズ", "薬", "くすり", "睡眠薬", "殺", "ころす", "ころして", "ころしたい",
+    "つらい", "辛い", "苦しい", "くるしい", "しんどい", "限界", "もう無理", "もうむり", "耐えられない", "嫌だ", "いやだ",
+    "逃げたい", "助けて", "たすけて", "絶望", "虐待", "暴力", "殴", "いじめ", "レイプ", "性被害", "DV",
+] + PRESCREEN_CONF.get("EXTRA_TERMS", [])
+
+# リスクを含まない定型の発話（発話全体がこれらのどれかに一致し，リスク語を含まない場合だけ LLM で推定しない）
+BENIGN_TERMS = [
+    "はい", "いいえ", "うん", "ううん", "はーい", "うんうん", "そうです", "そうですね", "なるほど",
+    "ありがとう", "ありがとうございます", "ありがとうございました", "わかりました", "了解", "大丈夫です",
+    "こんにちは", "こんばんは", "おはようございます", "おやすみなさい", "よろしくお願いします",
+    "ok", "おk", "笑", "w",
+] + PRESCREEN_CONF.get("EXTRA_BENIGN_TERMS", [])
+
+
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(ord("ァ"), ord("ヶ") + 1)}
+
+
+def _fold(text: str) -> str:
+    """全角・半角，大文字・小文字，ひらがな・カタカナの違いをなくす"""
+    return unicodedata.normalize("NFKC", text).lower().translate(_KATAKANA_TO_HIRAGANA)
+
+
+def normalize(text: str) -> str:
+    """_fold に加えて，空白と句読点を取り除く"""
+    return "".join(ch for ch in _fold(text) if not (ch.isspace() or unicodedata.category(ch).startswith("P")))
+
+
+def _is_ascii_word(term: str) -> bool:
+    return term.isascii() and term.isalnum()
+
+
+class RiskPrescreen:
+    """
+    リスクレベルの推定を LLM に依頼する必要があるかを判定する
+    LLM の呼び出しを省略するのは，発話全体が定型の発話（「はい」など）に一致し，リスク語を含まない場合だけ
+    短いだけの発話は省略しない（見逃しは余分な API の呼び出しよりも重大なため）
+
+    Parameters:
+        risk_terms: リスクを示す語
+        benign_terms: リスクを含まない定型の発話
+    """
+    def __init__(self, risk_terms, benign_terms):
+        terms = [_fold(term) for term in risk_terms if normalize(term)]
+        self.risk_terms = [normalize(term) for term in terms if not _is_ascii_word(term)]
+        # 英字の語は前後が英数字でない場合だけ一致させる（"good food" を OD と判定しない）
+        ascii_terms = [term for term in terms if _is_ascii_word(term)]
+        self.ascii_pattern = re.compile(
+            r"(?<![a-z0-9])(" + "|".join(re.escape(term) for term in ascii_terms) + r")(?![a-z0-9])"
+        ) if ascii_terms else None
+        self.benign_terms = {normalize(term) for term in benign_terms}
+
+        self.lock = threading.Lock()
+        self.counts = {"checked": 0, "skipped": 0, "lexicon": 0, "other": 0}
+        self.latency_stats = LatencyStats()   # 判定にかかった時間
+
+    def classify(self, text: str):
+        """
+        発話を判定し，(LLM で推定する必要があるか, 判定の理由) を返す
+        理由: "lexicon:<語>"（リスク語を含む） / "other"（定型の発話ではない）で推定する，"benign" で省略する
+        """
+        folded = _fold(text)
+        if self.ascii_pattern is not None:
+            match = self.ascii_pattern.search(folded)
+            if match is not None:
+                return True, f"lexicon:{match.group(1)}"
+
+        normalized = normalize(text)
+        for term in self.risk_terms:
+            if term in normalized:
+                return True, f"lexicon:{term}"
+
+        if normalized in self.benign_terms:
+            return False, "benign"
+        return True, "other"
+
+    def needs_llm(self, text: str) -> bool:
+        """LLM でリスクレベルを推定する必要があれば True を返す（判定結果を集計する）"""
+        start = time.perf_counter()
+        needed, reason = self.classify(text)
+        self.latency_stats.add(time.perf_counter() - start)
+
+        with self.lock:
+            self.counts["checked"] += 1
+            if needed:
+                self.counts[reason.split(":")[0]] += 1
+            else:
+                self.counts["skipped"] += 1
+        if needed and reason != "other":
+            logger.debug(f"[Risk Prescreen] リスク語を検出しました（{reason}）: {text}")
+        return needed
+
+    def metrics(self) -> dict:
+        with self.lock:
+            counts = dict(self.counts)
+        counts["enabled"] = PRESCREEN_ENABLED
+        counts["skip_rate"] = counts["skipped"] / counts["checked"] if counts["checked"] else 0.0
+        counts["latency_seconds"] = self.latency_stats.snapshot()
+        return counts
+
+
+prescreen = RiskPrescreen(RISK_TERMS, BENIGN_TERMS)
+register_metrics("risk_prescreen", prescreen.metrics)
@@ -0,0 +1,166 @@
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+SCHEDULER_CONF = conf.get("TIMER_SCHEDULER", {})
+
+
+class ScheduledTask:
+    """
+    DeadlineScheduler に登録された1つの予定．cancel / reschedule はこのオブジェクトを渡して行う
+    """
+    __slots__ = ("deadline", "function", "args", "entry", "done")
+
+    def __init__(self, deadline, function, args):
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.entry = None    # ヒープ内のエントリ [deadline, seq, task]
+        self.done = False    # 実行済み，またはキャンセル済み
+
+
+class DeadlineScheduler:
+    """
+    多数のタイマーを1つのスレッドで管理するスケジューラ
+    予定は期限（time.monotonic）の順にヒープで管理し，期限が来たものをワーカースレッドのプールで実行する
+    登録・期限の変更は O(log n)，キャンセルは O(1)（ヒープからは遅延削除し，削除済みが半分を超えたら作り直す）
+
+    Parameters:
+        max_workers: 期限が来た関数を実行するスレッド数
+        name: スレッド名とログに使う名前
+    """
+    def __init__(self, max_workers: int = 4, name: str = "Deadline"):
+        self.name = name
+        self.heap = []
+        self.counter = itertools.count()
+        self.removed = 0   # ヒープに残っている削除済みエントリの数
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}Worker")
+        self.thread = None
+
+        self.fired = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.lag_stats = LatencyStats()   # 期限から実際に実行されるまでの遅れ
+
+    def _ensure_started(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=f"{self.name}Scheduler", daemon=True)
+            self.thread.start()
+
+    def _push(self, task):
+        entry = [task.deadline, next(self.counter), task]
+        task.entry = entry
+        heapq.heappush(self.heap, entry)
+        # 新しい予定が先頭になった場合は，待機中のスレッドを起こして待ち時間を計算し直す
+        if self.heap[0] is entry:
+            self.condition.notify()
+
+    def _remove(self, task):
+        if task.entry is not None:
+            task.entry[2] = None
+            task.entry = None
+            self.removed += 1
+            if self.removed > len(self.heap) // 2:
+                self.heap = [entry for entry in self.heap if entry[2] is not None]
+                heapq.heapify(self.heap)
+                self.removed = 0
+
+    def schedule(self, delay: float, function, args=()) -> ScheduledTask:
+        """
+        delay 秒後に function(*args) を実行する
+        """
+        task = ScheduledTask(time.monotonic() + max(0.0, delay), function, list(args))
+        with self.condition:
+            self._ensure_started()
+            self._push(task)
+        return task
+
+    def cancel(self, task: ScheduledTask) -> bool:
+        """
+        予定をキャンセルする．まだ実行されていなかった場合は True を返す
+        """
+        with self.condition:
+            if task.done:
+                return False
+            task.done = True
+            self._remove(task)
+            self.cancelled += 1
+            return True
+
+    def reschedule(self, task: ScheduledTask, deadline: float) -> bool:
+        """
+        予定の期限（time.monotonic）を変更する．すでに実行・キャンセルされていた場合は False を返す
+        """
+        with self.condition:
+            if task.done:
+                return False
+            self._remove(task)
+            task.deadline = deadline
+            self._push(task)
+            return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    # 先頭の削除済みエントリを取り除く
+                    while self.heap and self.heap[0][2] is None:
+                        heapq.heappop(self.heap)
+                        self.removed -= 1
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    timeout = self.heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+
+                deadline, _, task = heapq.heappop(self.heap)
+                task.entry = None
+                task.done = True
+                self.fired += 1
+
+            self.lag_stats.add(time.monotonic() - deadline)
+            self.executor.submit(self._execute, task)
+
+    def _execute(self, task):
+        try:
+            task.function(*task.args)
+        except Exception as e:
+            with self.condition:
+                self.failed += 1
+            logger.error(f"[{self.name} Scheduler Error] {getattr(task.function, '__name__', task.function)}: {repr(e)}")
+
+    def active(self) -> int:
+        with self.condition:
+            return len(self.heap) - self.removed
+
+    def metrics(self) -> dict:
+        with self.condition:
+            active = len(self.heap) - self.removed
+            fired, cancelled, failed = self.fired, self.cancelled, self.failed
+        return {
+            "active": active,
+            "fired": fired,
+            "cancelled": cancelled,
+            "failed": failed,
+            "lag_seconds": self.lag_stats.snapshot(),
+        }
+
+
+# カウンセリング時間のタイマーなどで共有するスケジューラ
+scheduler = DeadlineScheduler(max_workers=SCHEDULER_CONF.get("MAX_WORKERS", 4), name="Timer")
+register_metrics("timer_scheduler", scheduler.metrics)
@@ -0,0 +1,160 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from django.db import close_old_connections
+from counseling_linebot.utils.async_llm import OPENAI_MODEL, SPEAKER_LABELS, load_prompt, get_openai_client
+from counseling_linebot.utils.context_cache import get_context
+from counseling_linebot.utils.db_handler import get_summary, save_summary
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+SUMMARY_CONF = conf.get("SUMMARY", {})
+SUMMARY_ENABLED = SUMMARY_CONF.get("ENABLED", False)
+SUMMARY_INTERVAL = SUMMARY_CONF.get("INTERVAL", 6)        # 要約に含まれていない発話がこの数だけたまったら要約を更新する
+SUMMARY_KEEP_RECENT = SUMMARY_CONF.get("KEEP_RECENT", 6)  # 要約せずにそのまま送る，最新の発話の数
+SUMMARY_PROMPT_PATH = conf["PROMPT"].get("SUMMARY", "./counseling_linebot/prompts/summary.txt")
+
+
+def _unsummarized(rows, until_id: int):
+    """
+    要約に含まれていない発話（ChatHistory の id が until_id より大きい発話）を返す
+    要約の位置は id で持つので，rows が最新の一部だけ（get_context の上限）でも正しく分けられる
+    """
+    return [row for row in rows if row["id"] > until_id]
+
+
+class Summarizer:
+    """
+    セッションごとの対話の要約（Session.summary）をバックグラウンドで更新する
+    最新の KEEP_RECENT 発話より古い発話のうち，要約に含まれていないものが INTERVAL 発話たまったら，
+    これまでの要約とそれらの発話から要約を作り直す．同じユーザの更新は同時に1つだけ実行する
+    要約に含まれている最後の発話は Session.summary_until_id（ChatHistory の id）に保存する
+    """
+    def __init__(self, max_workers: int = 1):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Summarizer")
+        self.lock = threading.Lock()
+        self.scheduled = set()   # 実行待ち・実行中のユーザ
+        self.known_until = {}    # user_id -> (session_id, 要約に含まれている最後の発話の id（最後に確認した値）)
+
+        self.submitted = 0
+        self.updated = 0
+        self.failed = 0
+        self.latency_stats = LatencyStats()   # 要約の更新にかかった時間
+
+    def _pending_turns(self, rows, until_id) -> int:
+        return len(_unsummarized(rows, until_id)) - SUMMARY_KEEP_RECENT
+
+    def schedule(self, user_id: str, session_id: str) -> bool:
+        """
+        要約の更新が必要であれば，バックグラウンドでの更新を依頼する（依頼した場合は True）
+        """
+        rows = get_context(user_id, session_id=session_id)
+        with self.lock:
+            known = self.known_until.get(user_id)
+            if known is not None and known[0] == session_id and self._pending_turns(rows, known[1]) < SUMMARY_INTERVAL:
+                return False
+            if user_id in self.scheduled:
+                return False
+            self.scheduled.add(user_id)
+            self.submitted += 1
+        self.executor.submit(self._run, user_id, session_id)
+        return True
+
+    def _run(self, user_id: str, session_id: str):
+        close_old_connections()
+        try:
+            self.summarize(user_id, session_id)
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+            logger.error(f"[Summary] Failed to summarize dialogue for user {user_id}: {e}")
+        finally:
+            with self.lock:
+                self.scheduled.discard(user_id)
+            close_old_connections()
+
+    def summarize(self, user_id: str, session_id: str):
+        start = time.monotonic()
+        rows = get_context(user_id, session_id=session_id)
+        summary, prev_until_id = get_summary(user_id, session_id)
+        until_id = prev_until_id
+        if rows and until_id > rows[-1]["id"]:   # 履歴がリセットされた場合は最初から要約する
+            summary, until_id = "", 0
+
+        with self.lock:
+            self.known_until[user_id] = (session_id, until_id)
+        if self._pending_turns(rows, until_id) < SUMMARY_INTERVAL:
+            return
+
+        pending = _unsummarized(rows, until_id)
+        targets = pending[:len(pending) - SUMMARY_KEEP_RECENT]
+        new_until_id = targets[-1]["id"]
+        new_turns = "".join(
+            f"{SPEAKER_LABELS.get(row['speaker'], str(row['speaker']))}: {row['message']}\n" for row in targets
+        )
+        prompt = (
+            load_prompt(SUMMARY_PROMPT_PATH)
+            .replace("{{ summary }}", summary or "なし")
+            .replace("{{ new_turns }}", new_turns)
+        )
+        response = get_openai_client().chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0,
+        )
+        new_summary = (response.choices[0].message.content or "").strip()
+        if not new_summary:
+            return
+
+        if save_summary(user_id, session_id, new_summary, new_until_id, prev_until_id):
+            with self.lock:
+                self.known_until[user_id] = (session_id, new_until_id)
+                self.updated += 1
+            self.latency_stats.add(time.monotonic() - start)
+            logger.debug(f"[Summary] user: {user_id}, until id: {until_id} -> {new_until_id} ({len(targets)} turns)\n\tsummary: {new_summary}")
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": SUMMARY_ENABLED,
+                "users": len(self.known_until),
+                "scheduled": len(self.scheduled),
+                "submitted": self.submitted,
+                "updated": self.updated,
+                "failed": self.failed,
+                "latency_seconds": self.latency_stats.snapshot(),
+            }
+
+
+summarizer = Summarizer(max_workers=SUMMARY_CONF.get("MAX_WORKERS", 1))
+register_metrics("summary", summarizer.metrics)
+
+
+def schedule_summary(user_id: str, session_id: str) -> bool:
+    """
+    SUMMARY.ENABLED のとき，必要であれば対話の要約の更新をバックグラウンドで依頼する
+    """
+    if not SUMMARY_ENABLED or not session_id:
+        return False
+    return summarizer.schedule(user_id, session_id)
+
+
+def get_summarized_history(user_id: str, session_id: str, rows):
+    """
+    要約と，要約に含まれていない発話を返す（SUMMARY.ENABLED でない場合や要約がない場合は ("", rows)）
+    rows は get_context で取得したセッション開始以降の発話
+    """
+    if not SUMMARY_ENABLED or not session_id:
+        return "", rows
+    summary, until_id = get_summary(user_id, session_id)
+    if not summary or (rows and until_id > rows[-1]["id"]):
+        return "", rows
+    return summary, _unsummarized(rows, until_id)
@@ -1,14 +1,7 @@
-from linebot.v3.webhook import WebhookHandler
-from linebot.v3.messaging.models import BroadcastRequest
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    ReplyMessageRequest,
     ButtonsTemplate,
     MessageAction,
     TemplateMessage,
-    PushMessageRequest,
     TextMessage
 )
 
@@ -17,6 +10,9 @@ from logger.set_logger import start_logger
 from logger.ansi import *
 from django.conf import settings
 from counseling_linebot.utils.tool import split_message
+from counseling_linebot.utils.line_client import line_client
+from counseling_linebot.utils.message_quota import quota_tracker
+from counseling_linebot.utils.outbound_queue import send_reply, send_push
 
 # ロガーと設定の読み込み
 conf = settings.MAIN_CONFIG
@@ -28,28 +24,17 @@ NO = "2:" + conf["NO_ANSWER"]
 DEBUG_PUSH_MESSAGE = conf.get("DEBUG_PUSH_MESSAGE", False)
 DEBUG_USER_ID = conf.get("DEBUG_USER_ID", "")
 
-LINE_CHANNEL_SECRET = conf["LINE_CHANNEL_SECRET"]
-LINE_ACCESS_TOKEN = conf["LINE_ACCESS_TOKEN"]
 
-#mil-ai
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
-configuration = Configuration(access_token=LINE_ACCESS_TOKEN)
-
-def reply_to_line_user(reply_token, message):
-    
+def reply_to_line_user(reply_token, message, user_id=None, issued_at=None):
+    """
+    reply_token を使ってメッセージを返信する
+    user_id を指定すると，送信キューを使う場合に reply_token の期限が切れていたら push で送る
+    issued_at: reply_token を受け取った時刻（time.time()．省略時は現在時刻）
+    """
     msgs = split_message(message)
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-        # 返信リクエストを作成
-        reply_request = ReplyMessageRequest(
-            reply_token=reply_token,
-            messages=msgs
-        )
-
-        # 作成したリプライリクエストをLINE APIへ送信
-        line_bot_api.reply_message_with_http_info(reply_request)
+    # 作成したリプライリクエストをLINE APIへ送信（送信キューを使う場合はキューに積んですぐに戻る）
+    send_reply(reply_token, msgs, user_id=user_id, issued_at=issued_at)
 
 
 def push_to_line_user(user_id, message, split=True):
@@ -61,20 +46,8 @@ def push_to_line_user(user_id, message, split=True):
     else:
         msgs = [TextMessage(text=message)]
 
-    current_usage, quota = check_message_quota()
-
     logger.info(f"[Push Message] user_id: {user_id}")
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.push_message_with_http_info(
-            PushMessageRequest(
-                to=user_id,
-                messages=msgs
-            )
-        )
-
-    updated_usage, _ = check_message_quota()
-    logger.info(f'[Push Usage] {current_usage}/{quota} -> {updated_usage}/{quota}')
+    send_push(user_id, msgs)   # 送信数は送信時に quota_tracker で数える
 
 
 def send_yes_no_buttons(
@@ -83,70 +56,59 @@ def send_yes_no_buttons(
     question_text: str,
     alt_text: str = "",
     prepend_message: str = None,
-    split: bool = True
+    split: bool = True,
+    user_id: str = None
 ):
     """
     YES/NO ボタン付きのメッセージを送信する共通関数。
 
     Parameters:
-        configuration: LINE Messaging API の設定オブジェクト
+        configuration: LINE Messaging API の設定オブジェクト（使用しない．送信は共有のクライアントで行う）
         reply_token: イベントから取得した reply_token
         question_text: ボタンテンプレートに表示する質問文
         alt_text: テンプレートの代替テキスト
         prepend_message: 先頭に追加するテキスト（任意）
+        user_id: 送信先のユーザID（任意．送信キューを使う場合，reply_token の期限が切れていたら push で送る）
     """
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-        # prepend_message が指定されている場合は分割してメッセージリストに追加
-        if prepend_message: # prepend_message が '' でない場合
-            if split:
-                messages = split_message(prepend_message)
-            else:
-                messages = [TextMessage(text=prepend_message)]
+    # prepend_message が指定されている場合は分割してメッセージリストに追加
+    if prepend_message: # prepend_message が '' でない場合
+        if split:
+            messages = split_message(prepend_message)
         else:
-            messages = []
-
-        messages.append(
-            TemplateMessage(
-                alt_text=alt_text,
-                template=ButtonsTemplate(
-                    text=question_text,
-                    actions=[
-                        MessageAction(label=YES, text=YES),
-                        MessageAction(label=NO, text=NO)
-                    ]
-                )
+            messages = [TextMessage(text=prepend_message)]
+    else:
+        messages = []
+
+    messages.append(
+        TemplateMessage(
+            alt_text=alt_text,
+            template=ButtonsTemplate(
+                text=question_text,
+                actions=[
+                    MessageAction(label=YES, text=YES),
+                    MessageAction(label=NO, text=NO)
+                ]
             )
         )
+    )
 
-        # メッセージの数が5を超える場合は警告を出す
-        # LINE Messaging APIの仕様では、1回のリプライで送信できるメッセージは最大5つまで
-        if len(messages) > 5:
-            logger.warning(
-                f"[Too Many Message] num_msgs:{len(messages)}. Only the first 5 will be sent."
-            )
-            messages = messages[:5]
-
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=messages
-            )
+    # メッセージの数が5を超える場合は警告を出す
+    # LINE Messaging APIの仕様では、1回のリプライで送信できるメッセージは最大5つまで
+    if len(messages) > 5:
+        logger.warning(
+            f"[Too Many Message] num_msgs:{len(messages)}. Only the first 5 will be sent."
         )
+        messages = messages[:5]
+
+    send_reply(reply_token, messages, user_id=user_id)
 
 
 def check_message_quota():
     """
     メッセージ送信の可能回数を確認する関数
-    LINE Messaging APIのクォータ情報を取得し、現在の使用量を表示
+    (今月の送信数, 上限) を返す．送信数は quota_tracker が API から一定間隔で取得した値に，その後の送信数を加算した見積もり
     """
-    with ApiClient(configuration) as api_client:
-        messaging_api = MessagingApi(api_client)
-        quota = messaging_api.get_message_quota()
-        current_usage = messaging_api.get_message_quota_consumption()
-        
-        return current_usage.total_usage, quota.value
+    return quota_tracker.usage()
 
 
 def broadcast_message(message: str):
@@ -167,18 +129,14 @@ def broadcast_message(message: str):
         else:
             current_usage, quota = check_message_quota()
             logger.info(f"[Broadcast Message]")
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                text_message = TextMessage(text=message)
-                
-                # 一斉送信リクエストを作成
-                line_bot_api.broadcast_with_http_info(
-                    BroadcastRequest(
-                        messages=[text_message]
-                    )
-                )
-            updated_usage, _ = check_message_quota()
-            logger.info(f'[Push Usage] {current_usage}/{quota} -> {updated_usage}/{quota}')
+            text_message = TextMessage(text=message)
+            
+            # 一斉送信リクエストを送信
+            line_client.broadcast([text_message])
+
+            # 一斉送信の送信数は友だちの人数なので，API から取得し直す（バックグラウンドで行い，結果は quota_tracker がログに出す）
+            quota_tracker.record_broadcast()
+            logger.info(f'[Push Usage] {current_usage}/{quota} -> (broadcast)')
 
     except Exception as e:
         logger.error(f"[Broadcast Error] Failed to send broadcast message:\n  {repr(e)}")
@@ -0,0 +1,192 @@
+import threading
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:   # tiktoken がない場合は文字数から推定する
+    tiktoken = None
+
+# 自作モジュールのインポート
+from logger.set_logger import start_logger
+from logger.ansi import *
+from django.conf import settings
+from counseling_linebot.utils.metrics import LatencyStats, register_metrics
+
+# ロガーと設定の読み込み
+conf = settings.MAIN_CONFIG
+logger = start_logger(conf['LOGGER']['SYSTEM'])
+
+BUDGET_CONF = conf.get("CONTEXT_BUDGET", {})
+BUDGET_ENABLED = BUDGET_CONF.get("ENABLED", True)
+DEFAULT_BUDGET = BUDGET_CONF.get("DEFAULT", 16000)        # モデルごとの指定がない場合のプロンプトのトークン数の上限
+MODEL_BUDGETS = BUDGET_CONF.get("MODELS", {})             # モデル名 -> プロンプトのトークン数の上限
+KEEP_RECENT = BUDGET_CONF.get("KEEP_RECENT", 6)           # 上限を超えても必ずそのまま送る，最新の発話の数
+OLD_TURN_MAX_CHARS = BUDGET_CONF.get("OLD_TURN_MAX_CHARS", 400)   # 上限を超える場合，これより古い発話はこの文字数に切り詰める
+MESSAGE_OVERHEAD = 4   # 1メッセージあたりの役割などのトークン数
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _estimate(text: str) -> int:
+    """
+    tiktoken がない場合の推定．日本語（ASCII 以外）は1文字1トークン，ASCII は4文字1トークンとして数える
+    """
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str, model_name: str = "") -> int:
+    """
+    テキストのトークン数を数える（tiktoken がある場合はモデルのトークナイザ，ない場合は文字数からの推定）
+    """
+    encoding = _get_encoding(model_name) if model_name and not model_name.startswith("gemini") else None
+    if encoding is None:
+        return _estimate(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_messages(messages, model_name: str = "") -> int:
+    return sum(count_tokens(m["content"], model_name) + MESSAGE_OVERHEAD for m in messages)
+
+
+def get_budget(model_name: str) -> int:
+    return MODEL_BUDGETS.get(model_name, DEFAULT_BUDGET)
+
+
+class PromptStats:
+    """
+    送信したプロンプトのトークン数と，上限を超えたために省略・切り詰めた発話の数をモデルごとに集計する
+    API の応答に含まれるトークン数（プロンプトのキャッシュに一致したトークン数を含む）と応答時間も集計する
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}   # model_name -> {"tokens": LatencyStats, "trimmed_requests": int, "dropped": int, "truncated": int, ...}
+
+    def _get(self, model_name: str) -> dict:
+        stats = self.models.get(model_name)
+        if stats is None:
+            stats = {
+                "tokens": LatencyStats(), "trimmed_requests": 0, "dropped": 0, "truncated": 0,
+                "usage_requests": 0, "usage_prompt_tokens": 0, "cached_tokens": 0, "cache_hit_requests": 0,
+                "response_seconds": LatencyStats(), "first_token_seconds": LatencyStats(),
+            }
+            self.models[model_name] = stats
+        return stats
+
+    def add(self, model_name: str, tokens: int, dropped: int, truncated: int):
+        with self.lock:
+            stats = self._get(model_name)
+            if dropped or truncated:
+                stats["trimmed_requests"] += 1
+            stats["dropped"] += dropped
+            stats["truncated"] += truncated
+        stats["tokens"].add(tokens)
+
+    def add_usage(self, model_name: str, prompt_tokens: int, cached_tokens: int, response_seconds: float = None, first_token_seconds: float = None):
+        with self.lock:
+            stats = self._get(model_name)
+            stats["usage_requests"] += 1
+            stats["usage_prompt_tokens"] += prompt_tokens
+            stats["cached_tokens"] += cached_tokens
+            if cached_tokens:
+                stats["cache_hit_requests"] += 1
+        if response_seconds is not None:
+            stats["response_seconds"].add(response_seconds)
+        if first_token_seconds is not None:
+            stats["first_token_seconds"].add(first_token_seconds)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            models = {name: dict(stats) for name, stats in self.models.items()}
+        return {
+            "tokenizer": "tiktoken" if tiktoken is not None else "estimate",
+            "models": {
+                name: {
+                    "budget": get_budget(name),
+                    "prompt_tokens": stats["tokens"].snapshot(),
+                    "trimmed_requests": stats["trimmed_requests"],
+                    "dropped_turns": stats["dropped"],
+                    "truncated_turns": stats["truncated"],
+                    "usage_requests": stats["usage_requests"],
+                    "usage_prompt_tokens": stats["usage_prompt_tokens"],
+                    "cached_tokens": stats["cached_tokens"],
+                    "cached_ratio": round(stats["cached_tokens"] / stats["usage_prompt_tokens"], 4) if stats["usage_prompt_tokens"] else 0.0,
+                    "cache_hit_requests": stats["cache_hit_requests"],
+                    "response_seconds": stats["response_seconds"].snapshot(),
+                    "first_token_seconds": stats["first_token_seconds"].snapshot(),
+                }
+                for name, stats in models.items()
+            },
+        }
+
+
+prompt_stats = PromptStats()
+register_metrics("prompt_tokens", prompt_stats.metrics)
+
+
+def record_usage(model_name: str, usage, response_seconds: float = None, first_token_seconds: float = None):
+    """
+    API の応答の usage（OpenAI: prompt_tokens / prompt_tokens_details.cached_tokens，
+    Gemini: prompt_token_count / cached_content_token_count）を集計する
+    """
+    if usage is None:
+        return
+    if hasattr(usage, "prompt_token_count"):
+        prompt_tokens = usage.prompt_token_count or 0
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+    else:
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+    prompt_stats.add_usage(model_name, prompt_tokens, cached_tokens, response_seconds, first_token_seconds)
+
+
+def fit_to_budget(system_prompt: str, history, model_name: str, budget: int = None):
+    """
+    システムプロンプトと対話履歴をトークン数の上限に収める
+    システムプロンプトと最新の KEEP_RECENT 件はそのまま残し，それより古い発話は
+    OLD_TURN_MAX_CHARS 文字に切り詰めたうえで，新しいものから上限に収まるだけ残す
+
+    Returns:
+        (system を先頭に付けたメッセージのリスト, プロンプトのトークン数)
+    """
+    system_message = {"role": "system", "content": system_prompt}
+    if not BUDGET_ENABLED:
+        messages = [system_message] + list(history)
+        tokens = count_messages(messages, model_name)
+        prompt_stats.add(model_name, tokens, 0, 0)
+        return messages, tokens
+
+    budget = budget or get_budget(model_name)
+    recent = list(history[-KEEP_RECENT:]) if KEEP_RECENT > 0 else []
+    older = list(history[:len(history) - len(recent)])
+    tokens = count_messages([system_message] + recent, model_name)
+
+    kept = []
+    truncated = 0
+    for message in reversed(older):
+        cost = count_messages([message], model_name)
+        if tokens + cost > budget and len(message["content"]) > OLD_TURN_MAX_CHARS:
+            message = {"role": message["role"], "content": message["content"][:OLD_TURN_MAX_CHARS] + "…"}
+            cost = count_messages([message], model_name)
+            if tokens + cost <= budget:
+                truncated += 1
+        if tokens + cost > budget:
+            break
+        kept.append(message)
+        tokens += cost
+
+    dropped = len(older) - len(kept)
+    if dropped or truncated:
+        logger.debug(f"[Context Budget] model: {model_name}, budget: {budget}, tokens: {tokens}, dropped: {dropped}, truncated: {truncated}")
+    prompt_stats.add(model_name, tokens, dropped, truncated)
+    return [system_message] + kept[::-1] + recent, tokens
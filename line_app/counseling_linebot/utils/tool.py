@@ -1,6 +1,5 @@
 
 import time
-import threading
 import yaml
 import stripe
 import os
@@ -15,6 +14,7 @@ from django.conf import settings
 # 自作モジュールのインポート
 from logger.set_logger import start_logger
 from logger.ansi import *
+from counseling_linebot.utils.scheduler import scheduler
 
 
 # 設定の読み込み
@@ -98,30 +98,41 @@ def create_checkout_session(product_name: str, unit_amount: int, time_seconds: i
 
 
 class TrackableTimer:
+    """
+    残り時間を取得・延長できるタイマー
+    期限は共有の DeadlineScheduler で管理し，タイマーごとにスレッドは作らない
+    """
     def __init__(self, timeout, function, args=None):
         self.timeout = timeout
         self.function = function
         self.args = args if args else []
         self.start_time = None
-        self.timer = None
+        self.task = None
 
     def start(self):
         self.start_time = time.time()
-        self.timer = threading.Timer(self.timeout, self.function, args=self.args)
-        self.timer.start()
+        self.task = scheduler.schedule(self.timeout, self.function, args=self.args)
 
     def cancel(self):
-        if self.timer:
-            self.timer.cancel()
+        if self.task:
+            scheduler.cancel(self.task)
         
         # 残り時間をreturn
         return self.remaining_time()
 
+    def extend(self, seconds):
+        """
+        タイマーの期限を seconds 秒延長し，延長後の残り時間を返す
+        """
+        self.timeout += seconds
+        if self.task:
+            scheduler.reschedule(self.task, self.task.deadline + seconds)
+        return self.remaining_time()
+
     def remaining_time(self):
-        if self.start_time is None:
+        if self.task is None:
             return self.timeout
-        elapsed = time.time() - self.start_time
-        return max(0, self.timeout - elapsed)
+        return max(0, self.task.deadline - time.monotonic())
 
 
 # 辞書，リストなどのデータ構造を整形して文字列に変換する関数
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-import threading
 from pathlib import Path
 
 import stripe
@@ -11,9 +10,7 @@ from django.shortcuts import render, redirect
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.utils import timezone
-from linebot.v3.webhook import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import Configuration
 from linebot.v3.webhooks import MessageEvent, FollowEvent, PostbackEvent, StickerMessageContent, TextMessageContent
 
 # 既存実装の再利用（Flask版と同等機能）
@@ -25,33 +22,33 @@ from logger.set_logger import start_logger
 from logger.ansi import * 
 from counseling_linebot.models import ChatHistory
 from counseling_linebot.utils import richmenu 
-from counseling_linebot.utils.bot import CounselorBot
-from counseling_linebot.utils.async_llm import risk_level_detection_async
+from counseling_linebot.utils.async_llm import submit_risk_detection, COMBINED_RISK_DETECTION
+from counseling_linebot.utils.summarizer import schedule_summary
 from counseling_linebot.utils.maintenance import FileChangeHandler, maintenance_mode_on 
+from counseling_linebot.utils.event_queue import EventDispatcher
+from counseling_linebot.utils.locks import user_lock
+from counseling_linebot.utils.line_client import handler, configuration
+from counseling_linebot.utils.context_cache import record_message
+from counseling_linebot.utils.outbound_queue import QUEUE_ENABLED as OUTBOUND_QUEUE_ENABLED, outbound_queue
 from counseling_linebot.utils.db_handler import (
 	set_maintenance_mode,
 	get_maintenance_mode,
 	register_user,
 	get_all_users,
 	get_session,
-	save_session,
+	SessionState,
 	reset_all_sessions,
-	get_flag,
 	save_flag,
-	reset_flag,
 	reset_all_flags,
 	get_time,
 	increment_time,
-	set_time,
 	init_survey,
 	save_survey_results,
 	check_and_reset_session,
  	save_dialogue_history,
 	add_reply_token,
-	reset_risk_level,
 )
 from counseling_linebot.utils.tool import (
-	TrackableTimer,
 	format_structure,
 	extract_event_info,
 	load_config,
@@ -61,11 +58,14 @@ from counseling_linebot.utils.tool import (
 )
 from counseling_linebot.utils.main_message import (
 	shop,
+	get_bot,
 	reply,
 	start_chat,
-	send_end_message,
 	survey,
 	timers,
+	start_timer,
+	get_remaining_time,
+	recover_timers,
 )
 from counseling_linebot.utils.template_message import (
 	reply_to_line_user,
@@ -105,12 +105,12 @@ NO = "2:" + conf["NO_ANSWER"]
 SESSIONS_DB = conf["SESSIONS_DB"]
 LINEBOT_DB = conf["LINEBOT_DB"]
 
-LINE_CHANNEL_SECRET = conf["LINE_CHANNEL_SECRET"]
-LINE_ACCESS_TOKEN = conf["LINE_ACCESS_TOKEN"]
-
 stripe.api_key = conf["STRIPE_SECRET"]
 endpoint_secret = conf["STRIPE_WEBHOOK"]
 
+# Webhookの非同期処理の設定（有効な場合，イベントをキューに積んで即座に200を返す）
+ASYNC_WEBHOOK = conf.get("ASYNC_WEBHOOK", {})
+
 # PORT番ポートのHTTPトンネルを開設する
 PORT = conf["PORT"]
 
@@ -136,11 +136,6 @@ with open(conf["RICHMENU_PATH"], "w", encoding="utf-8") as f:  # 書き戻し（
 	yaml.dump(richmenu_ids, f)
 
 
-# mil-ai
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
-configuration = Configuration(access_token=LINE_ACCESS_TOKEN)
-
-
 # LINE Messaging APIのコールバックエンドポイント（ユーザからデータを受信したら最初にこの関数が呼ばれる）
 @csrf_exempt
 def callback(request):
@@ -156,6 +151,20 @@ def callback(request):
 	signature = request.headers.get("X-Line-Signature", "")
 	body = request.body.decode("utf-8")
 
+	# 非同期モード：署名を検証してイベントをキューに積み，処理を待たずに応答する
+	if event_dispatcher is not None:
+		try:
+			events = handler.parser.parse(body, signature)
+		except InvalidSignatureError:
+			logger.debug("Invalid signature. Please check your channel access token/channel secret.")
+			return HttpResponse(status=400)
+
+		# 全てのイベントを追加できない場合は1件も追加しない（再送されたときに同じイベントを2回処理しない）
+		if not event_dispatcher.submit_batch(events):
+			logger.error(f"[Event Queue Full] {len(events)} 件のイベントを追加できませんでした。queue_depth: {event_dispatcher.queue_depth()}")
+			return HttpResponse(status=503)  # LINEプラットフォームに再送してもらう
+		return HttpResponse("OK")
+
 	try:
 		handler.handle(body, signature)
 	except InvalidSignatureError:
@@ -165,11 +174,48 @@ def callback(request):
 	return HttpResponse("OK")
 
 
+def dispatch_event(event):
+	"""
+	キューから取り出したイベントを対応するハンドラに振り分ける
+	"""
+	if isinstance(event, FollowEvent):
+		handle_follow(event)
+	elif isinstance(event, PostbackEvent):
+		handle_postback(event)
+	elif isinstance(event, MessageEvent):
+		handle_message(event)
+	else:
+		logger.debug(f"[Unhandled Event] {type(event).__name__}")
+
+
+if ASYNC_WEBHOOK.get("ENABLED", False):
+	event_dispatcher = EventDispatcher(
+		dispatch_event,
+		num_workers=ASYNC_WEBHOOK.get("NUM_WORKERS", 4),
+		queue_size=ASYNC_WEBHOOK.get("QUEUE_SIZE", 1000),
+		enqueue_timeout=ASYNC_WEBHOOK.get("ENQUEUE_TIMEOUT", 1.0),
+	)
+	event_dispatcher.start()
+else:
+	event_dispatcher = None
+
+# 再起動前から続いているカウンセリングのタイマーを，DBの終了予定日時から復元し，送信待ちのメッセージを送り直す（migrate などの管理コマンドの実行時は行わない）
+if "runserver" in sys.argv or not sys.argv[0].endswith("manage.py"):
+	recover_timers()
+	if OUTBOUND_QUEUE_ENABLED:
+		outbound_queue.start()  # 前回の起動中に送信できなかったメッセージを送り直す
+
+
 # --- Followイベントハンドラ（友達追加時） ---
 @handler.add(FollowEvent)
 def handle_follow(event):
 	logger.info(f"[Follow Event] user: {event.source.user_id}")
 
+	with user_lock(event.source.user_id):
+		_handle_follow(event)
+
+
+def _handle_follow(event):
 	# ユーザのユーザIDを取得
 	user_id = event.source.user_id
 	session = get_session(user_id, tabs=1)
@@ -191,7 +237,7 @@ def handle_follow(event):
 				"友達登録ありがとうございます。\n\n現在、メンテナンス中のため、操作を受け付けていません。"
 				"\n\nしばらく時間をおいてから再度お試しください。"
 			)
-			reply_to_line_user(event.reply_token, msg)
+			reply_to_line_user(event.reply_token, msg, user_id=user_id)
 			richmenu.apply_richmenu(
 				richmenu_ids["MAINTENANCE"], user_id
 			)  # メンテナンス用のリッチメニューを適用
@@ -204,6 +250,7 @@ def handle_follow(event):
 		send_yes_no_buttons(
 			configuration,
 			reply_token=event.reply_token,
+			user_id=user_id,
 			question_text="同意しますか？",
 			alt_text="同意の確認",
 			prepend_message="友達登録ありがとうございます！\n\n" + KEYWORD_MESSAGE,
@@ -218,7 +265,7 @@ def handle_follow(event):
 
 		msg = "友達登録ありがとうございます！\n\n対話を開始するには、下のメニューを開き、操作を行ってください。"
 		logger.debug(f"\t[Send Message] user: {user_id}\n\t  {repr(msg)}")
-		reply_to_line_user(event.reply_token, msg)
+		reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 	init_survey(user_id)  # アンケートを初期化
 
@@ -234,16 +281,26 @@ def handle_postback(event):
 			f"\t[Maintenance Mode] user: {event.source.user_id} tried to postback during maintenance mode."
 		)
 		msg = "現在、メンテナンス中のため、操作を受け付けていません。\n\nしばらく時間をおいてから再度お試しください。"
-		reply_to_line_user(event.reply_token, msg)
+		reply_to_line_user(event.reply_token, msg, user_id=user_id)
 		if event.postback.data != "maintenance":
 			richmenu.apply_richmenu(
 				richmenu_ids["MAINTENANCE"], user_id, tabs=1
 			)  # メンテナンス用のリッチメニューを適用
 		return
 
-	session = get_session(user_id, tabs=1)
+	with user_lock(user_id):
+		state = SessionState(user_id, tabs=1)
+		try:
+			_handle_postback(event, state)
+		finally:
+			state.flush()
+
+
+def _handle_postback(event, state):
+	user_id = state.user_id
+	session = state.session
 	logger.debug(
-		f"\t[Postback Session] user: {user_id}\n{format_structure(session, indent=2)}\n\t\tflag: {get_flag(user_id)}\n\t\ttime: {get_time(user_id)}"
+		f"\t[Postback Session] user: {user_id}\n{format_structure(session, indent=2)}\n\t\tflag: {state.flag}\n\t\ttime: {state.time}"
 	)
 
 	# 送信されたデータをチェック
@@ -258,6 +315,7 @@ def handle_postback(event):
 		send_yes_no_buttons(
 			configuration,
 			reply_token=event.reply_token,
+			user_id=user_id,
 			question_text="同意しますか？",
 			alt_text="同意の確認",
 			prepend_message=KEYWORD_MESSAGE,
@@ -265,12 +323,12 @@ def handle_postback(event):
 		)
 
 		logger.debug(f"[Save Flag] flag: consent, user: {user_id}")
-		save_flag(user_id, flag="consent")  # フラグを保存
+		state.save_flag("consent")  # フラグを保存
 
 	elif event.postback.data == "no_consent":
 		msg = "ご同意いただけない場合は、カウンセリング対話を開始できません。"
 		logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-		reply_to_line_user(event.reply_token, msg)
+		reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 	elif event.postback.data == "shop":
 		shop(event, tunnel)
@@ -280,30 +338,31 @@ def handle_postback(event):
 		send_yes_no_buttons(
 			configuration,
 			reply_token=event.reply_token,
+			user_id=user_id,
 			question_text="本当に対話履歴をリセットしますか？\n\nリセットすると、これまでの対話履歴がすべて消去されます。",
 			alt_text="対話履歴のリセットの確認",
 		)
 
-		save_flag(user_id, flag="reset_history")  # フラグを保存
+		state.save_flag("reset_history")  # フラグを保存
 		logger.debug(f"\t[Save Flag] flag: reset_history, user: {user_id}")
 	elif event.postback.data == "start_chat":
 		if NEED_START_KEYWORD and session["keyword_accepted"] == False:
 			msg = "カウンセリング対話を開始する前に、同意が必要です。\n\n下のメニューから同意を行ってください。"
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-			reply_to_line_user(event.reply_token, msg)
+			reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 		elif session["counseling_mode"] == True:
 			msg = "すでにカウンセリング対話が開始されています。"
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-			reply_to_line_user(event.reply_token, msg)
+			reply_to_line_user(event.reply_token, msg, user_id=user_id)
 			richmenu.apply_richmenu(richmenu_ids["COUNSELING"], user_id, tabs=1)
 
 		else:
-			session_time = get_time(user_id)
+			session_time = state.time
 			if session_time == 0:
 				msg = "メニューからご希望の時間を選択してください。"
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-				reply_to_line_user(event.reply_token, msg)
+				reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 			else:
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\tカウンセリング対話の開始確認メッセージを送信")
@@ -312,32 +371,34 @@ def handle_postback(event):
 				send_yes_no_buttons(
 					configuration,
 					reply_token=event.reply_token,
+					user_id=user_id,
 					question_text=f"現在のカウンセリング時間は{minutes}分{seconds:02d}秒です。カウンセリング対話を開始しますか？",
 					alt_text="カウンセリング対話の開始確認",
 				)
-				save_flag(user_id, flag="start_chat")  # フラグを保存
+				state.save_flag("start_chat")  # フラグを保存
 				logger.debug(f"\t[Save Flag] flag: start_chat, user: {user_id}")
 	elif event.postback.data == "end_chat":
-		if check_and_reset_session(user_id, richmenu_ids, tabs=1):
+		if check_and_reset_session(user_id, richmenu_ids, tabs=1, state=state):
 			return
 
 		logger.debug(f"\t[Send Message] user: {user_id}\n\t\tカウンセリング対話の終了確認メッセージを送信")
 		send_yes_no_buttons(
 			configuration,
 			reply_token=event.reply_token,
+			user_id=user_id,
 			question_text="本当にカウンセリング対話を終了しますか？\n\n終了しても、残った時間は保持されます。",
 			alt_text="カウンセリング対話の終了確認",
 		)
 
-		save_flag(user_id, flag="end_chat")  # フラグを保存
+		state.save_flag("end_chat")  # フラグを保存
 		logger.debug(f"\t[Save Flag] flag: end_chat, user: {user_id}")
 	elif event.postback.data == "check_time":
-		if check_and_reset_session(user_id, richmenu_ids, tabs=1):
+		if check_and_reset_session(user_id, richmenu_ids, tabs=1, state=state):
 			return
 		logger.debug(f"\t[Checking Remaining Time] user {user_id}")
 		try:
-			with threading.Lock():
-				remaining_time = timers[user_id].remaining_time()
+			with user_lock(user_id):
+				remaining_time = get_remaining_time(user_id, state.remaining_time())
 				remaining_time = remaining_time // 60
 				if remaining_time > 60:
 					time_richmenu_id = richmenu_ids["REMAINING_TIME"]["60over"]
@@ -350,21 +411,21 @@ def handle_postback(event):
 			if session["counseling_mode"] == True:
 				logger.warning(f"\t[Warning] ユーザ'{user_id}'はカウンセリングモードですが、タイマーが見つかりませんでした。セッションをリセットします。")
 				session["counseling_mode"] = False
-				save_session(user_id, session)
+				state.save_session(session)
 
 	elif event.postback.data == "back_to_menu":
-		if check_and_reset_session(user_id, richmenu_ids, tabs=1):
+		if check_and_reset_session(user_id, richmenu_ids, tabs=1, state=state):
 			return
 		logger.debug(f"\t[Back to Menu] user {user_id}")
 		richmenu.apply_richmenu(richmenu_ids["COUNSELING"], user_id, tabs=1)
 
 	elif event.postback.data == "update_time":
-		if check_and_reset_session(user_id, richmenu_ids, tabs=1):
+		if check_and_reset_session(user_id, richmenu_ids, tabs=1, state=state):
 			return
 		logger.debug(f"\t[Update Remaining Time] user {user_id}")
 		try:
-			with threading.Lock():
-				remaining_time = timers[user_id].remaining_time()
+			with user_lock(user_id):
+				remaining_time = get_remaining_time(user_id, state.remaining_time())
 				remaining_time = remaining_time // 60
 		except KeyError:
 			logger.warning(f"\t[Warning] ユーザ'{user_id}'のタイマーが見つかりませんでした。")
@@ -372,22 +433,23 @@ def handle_postback(event):
 			if session["counseling_mode"] == True:
 				logger.warning(f"\t[Warning] ユーザ'{user_id}'はカウンセリングモードですが、タイマーが見つかりませんでした。セッションをリセットします。")
 				session["counseling_mode"] = False
-				save_session(user_id, session)
+				state.save_session(session)
 				return
 		richmenu.apply_richmenu(richmenu_ids["REMAINING_TIME"][remaining_time], user_id, tabs=1)
 
 	elif event.postback.data == "end_survey":
-		if check_and_reset_session(user_id, richmenu_ids, tabs=1):
+		if check_and_reset_session(user_id, richmenu_ids, tabs=1, state=state):
 			return
 		logger.debug(f"\t[Send Message] user: {user_id}\n\t\tアンケートの終了確認メッセージを送信")
 		send_yes_no_buttons(
 			configuration,
 			reply_token=event.reply_token,
+			user_id=user_id,
 			question_text="アンケートを終了しますか？",
 			alt_text="アンケートの終了確認",
 		)
 
-		save_flag(user_id, flag="end_survey")
+		state.save_flag("end_survey")
 		logger.debug(f"\t[Save Flag] flag: end_survey, user: {user_id}")
 	elif event.postback.data == "maintenance":
 		logger.warning(
@@ -409,155 +471,152 @@ def handle_message(event):
 			f"\t[Maintenance Mode] user: {event.source.user_id} tried to send a message during maintenance mode."
 		)
 		msg = "現在、メンテナンス中のため、メッセージを受け付けていません。\n\nしばらく時間をおいてから再度お試しください。"
-		reply_to_line_user(event.reply_token, msg)
+		reply_to_line_user(event.reply_token, msg, user_id=event.source.user_id)
 		return
 
-	user_id = event.source.user_id
-	session = get_session(user_id, tabs=1)
-	flag = get_flag(user_id)
+	with user_lock(event.source.user_id):
+		state = SessionState(event.source.user_id, tabs=1)
+		try:
+			_handle_message(event, state)
+		finally:
+			state.flush()
+
+
+def _handle_message(event, state):
+	user_id = state.user_id
+	session = state.session
+	flag = state.flag
 
 	logger.debug(
-		f"\t[Message Session] user: {user_id}\n{format_structure(session, indent=2)}\n\t\tflag: {flag}\n\t\ttime: {get_time(user_id)}"
+		f"\t[Message Session] user: {user_id}\n{format_structure(session, indent=2)}\n\t\tflag: {flag}\n\t\ttime: {state.time}"
 	)
 
 	if NEED_START_KEYWORD and flag == "consent" and session["keyword_accepted"] == False:
 		if event.message.text == YES:
 			session["keyword_accepted"] = True
-			save_session(user_id, session)
+			state.save_session(session)
 			logger.debug(f"\t[Save Session] user: {user_id}\n\t\tkeyword_accepted: {session['keyword_accepted']}")
 
 			msg = "ご同意ありがとうございます。メニューのShopからご希望の時間を選択してください。"
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-			reply_to_line_user(event.reply_token, msg)
+			reply_to_line_user(event.reply_token, msg, user_id=user_id)
 			richmenu.apply_richmenu(richmenu_ids["START"], user_id, tabs=1)
 
 		else:
 			session["keyword_accepted"] = False
-			save_session(user_id, session)
+			state.save_session(session)
 			logger.debug(f"\t[Save Session] user: {user_id}\n\t\tkeyword_accepted: {session['keyword_accepted']}")
 
 			msg = "ご同意いただけない場合は、カウンセリング対話を開始できません。\n\n同意はいつでも下のメニューから行えます。"
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-			reply_to_line_user(event.reply_token, msg)
+			reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 	elif NEED_START_KEYWORD and session["keyword_accepted"] == False:
 		msg = "下のメニューから同意を行うことで、カウンセリング対話を開始できます。"
 		logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-		reply_to_line_user(event.reply_token, msg)
+		reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 	elif flag == "start_chat":
 		if event.message.text == YES:
-			session_time = get_time(user_id)
-			timer = TrackableTimer(session_time, send_end_message, args=[user_id])
-			timer.start()
-			with threading.Lock():
-				timers[user_id] = timer
+			session_time = state.time
+			with user_lock(user_id):
+				start_timer(user_id, session_time)
 				logger.info(f"\t[Start Timer] user: {user_id}, time: {session_time} seconds")
+			state.start_clock(session_time)
 
 			session["counseling_mode"] = True
 			# session["session_id"] = generate_session_id(n=10)
-			save_session(user_id, session)
+			state.save_session(session)
 			logger.debug(
 				f"\t[Save Session] user: {user_id}\n\t\tcounseling_mode: {session['counseling_mode']}\n\t\tsessionID: {session['session_id']}"
 			)
 
 			richmenu.apply_richmenu(richmenu_ids["COUNSELING"], user_id, tabs=1)
 
-			reset_risk_level(user_id, tabs=1)
+			state.reset_risk_level()
 			if session["finished"] == True:
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\tカウンセリング対話の開始メッセージを送信")
+				state.flush()
 				start_chat(event)
 				session["finished"] = False
-				save_session(user_id, session)
+				state.save_session(session)
 				logger.debug(f"\t[Save Session] user: {user_id}\n\t\tfinished: {session['finished']}")
 			else:
 				msg = "カウンセリング対話を再開します。\n\n新しく会話を始める場合は、メニューから“Reset”ボタンを押してください。"
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-				reply_to_line_user(event.reply_token, msg)
+				reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 			logger.info(f"\t[Counseling Start] user: {user_id}, session_time: {session_time} seconds")
 
 		else:
 			msg = "カウンセリング対話を開始したい場合、もう一度メニューから“Start Chat”を選択して下さい。"
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-			reply_to_line_user(event.reply_token, msg)
+			reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 	elif flag == "reset_history":
 		if event.message.text == YES:
-			bot = CounselorBot(
-				LINEBOT_DB,
-				INIT_MESSAGE,
-				api_key=os.environ["OPENAI_API_KEY"],
-				model_name=OPENAI_MODEL,
-				system_prompt_path="./counseling_linebot/prompts/system_prompt.txt",
-				example_files=[
-					"./counseling_linebot/prompts/case1_0.txt",
-					"./counseling_linebot/prompts/case2_0.txt",
-					"./counseling_linebot/prompts/case3_0.txt",
-					"./counseling_linebot/prompts/case4_0.txt",
-					"./counseling_linebot/prompts/case5_0.txt",
-					"./counseling_linebot/prompts/case6_1.txt",
-				],
-			)
+			state.flush()
+			bot = get_bot()
 			bot.finish_dialogue(user_id)
-			reset_risk_level(user_id, tabs=1)
+			state.reset_risk_level()
 			session["session_id"] = generate_session_id(n=10)
 			if session["counseling_mode"] == True:
-				save_session(user_id, session)
+				state.save_session(session)
 				logger.debug(f"\t[Save Session] user: {user_id}\n\t\tfinished: {session['finished']}\n\t\tsession_id: {session['session_id']}")
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\t対話履歴をリセットし，カウンセリング対話を開始")
+				state.flush()
 				start_chat(event, reset=True)
 			else:
 				session["finished"] = True
-				save_session(user_id, session)
+				state.save_session(session)
 				logger.debug(f"\t[Save Session] user: {user_id}\n\t\tfinished: {session['finished']}\n\t\tsession_id: {session['session_id']}")
 				msg = "対話履歴をリセットしました。"
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-				reply_to_line_user(event.reply_token, msg)
+				reply_to_line_user(event.reply_token, msg, user_id=user_id)
 		else:
 			msg = "対話履歴のリセットをキャンセルしました。"
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-			reply_to_line_user(event.reply_token, msg)
+			reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 	elif session["keyword_accepted"] == True and session["counseling_mode"] == False and not session["survey_mode"] == True:
 		msg = "カウンセリング対話を開始するには、メニューからご希望の時間を選択してください。"
 		logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-		reply_to_line_user(event.reply_token, msg)
+		reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 	elif session["counseling_mode"] == True:
 		if flag == "end_chat":
 			if event.message.text == YES:
 				session["counseling_mode"] = False
 				session["survey_mode"] = True
-				save_session(user_id, session)
+				state.save_session(session)
 				logger.debug(
 					f"\t[Save Session] user: {user_id}\n\t\tcounseling_mode: {session['counseling_mode']}\n\t\tsurvey_mode: {session['survey_mode']}"
 				)
 
-				try:
-					with threading.Lock():
-						remaining_time = timers[user_id].cancel()
-						del timers[user_id]
-				except KeyError:
+				with user_lock(user_id):
+					timer = timers.pop(user_id, None)
+				timer_remaining = timer.cancel() if timer is not None else None
+				remaining_time = state.stop_clock(timer_remaining)  # 終了予定日時から残り時間を計算し，セッション時間を更新
+				if remaining_time is None:
 					logger.warning(f"\t[Warning] ユーザ'{user_id}'のタイマーが見つかりませんでした。")
 					if session["counseling_mode"] == True:
 						logger.warning(f"\t[Warning] ユーザ'{user_id}'はカウンセリングモードですが、タイマーが見つかりませんでした。セッションをリセットします。")
 						session["counseling_mode"] = False
-						save_session(user_id, session)
+						state.save_session(session)
 					return
-				set_time(user_id, remaining_time)
 				logger.info(f"[Counseling End] user: {user_id}, remaining_time: {remaining_time} seconds")
 
 				richmenu.apply_richmenu(richmenu_ids["SURVEY"], user_id)
 
 				logger.debug(f"[Send Message] user: {user_id}\n\t\tカウンセリング対話を終了し，アンケートの開始確認メッセージを送信")
+				state.flush()
 				survey(event, tunnel)
 				return
 
 			else:
 				msg = "対話を続けます。"
 				logger.debug(f"[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-				reply_to_line_user(event.reply_token, msg)
+				reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 		else:
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\tカウンセリング対話のメッセージを送信")
@@ -573,21 +632,18 @@ def handle_message(event):
 				logger.warning(f"\t[Warning] 非対応のメッセージタイプ: {type(event.message)}")
 				return
    
-			# 非同期でリスクレベルの検出を行うスレッドを起動
-			logger.info(f"\t[Risk Detection] 非同期でリスクレベルの検出を行うスレッドを起動")
-			risk_thread = threading.Thread(
-				target=risk_level_detection_async,
-				args=(user_id, session.get("session_id", ""), msg),
-				daemon=True,
-			)
-			risk_thread.start()
+			# 非同期でリスクレベルの検出を依頼（同じユーザの実行待ちの依頼は最新のものにまとめる）
+			# COMBINED のとき，AIモードでは応答の生成と同時に推定するため依頼しない
+			if session['response_mode'] == 'Human' or not COMBINED_RISK_DETECTION:
+				logger.info(f"\t[Risk Detection] 非同期でリスクレベルの検出を依頼")
+				submit_risk_detection(user_id, session.get("session_id", ""), msg)
    
 			if session['response_mode'] == 'Human':
 				
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\t人間が対応中のため、メッセージを送信せずに終了")
 				post_time = timezone.now()
 				logger.debug(f"\t[Save Dialogue History] message: {msg}")
-				ChatHistory.objects.create(
+				row = ChatHistory.objects.create(
 					user_id=user_id,
 					speaker="user",
 					message=msg,
@@ -595,10 +651,13 @@ def handle_message(event):
 					finished=0,
 					session_id=session["session_id"],
 				)
+				record_message(user_id, "user", msg, 0, session["session_id"], row_id=row.id)
 				save_dialogue_history(user_id, 'user', msg, session["session_id"], post_time)
+				schedule_summary(user_id, session["session_id"])
 				return
 
 			else:     # response_mode == 'AI'
+				state.flush()
 				reply(event, tunnel)
 
 	elif session["survey_mode"] == True:
@@ -606,16 +665,17 @@ def handle_message(event):
 			if event.message.text == YES:
 				session["survey_progress"] = 1
 				session["survey_mode"] = True
-				save_session(user_id, session)
+				state.save_session(session)
 				logger.debug(
 					f"\t[Save Session] user: {user_id}\n\t\tsurvey_progress: {session['survey_progress']}\n\t\tsurvey_mode: {session['survey_mode']}"
 				)
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\tアンケートを送信")
+				state.flush()
 				survey(event, tunnel)
 			else:
 				session["survey_mode"] = False
 				session["survey_progress"] = 0
-				save_session(user_id, session)
+				state.save_session(session)
 				logger.debug(
 					f"\t[Save Session] user: {user_id}\n\t\tsurvey_mode: {session['survey_mode']}\n\t\tsurvey_progress: {session['survey_progress']}"
 				)
@@ -623,37 +683,40 @@ def handle_message(event):
 				richmenu.apply_richmenu(richmenu_ids["START"], user_id)
 				msg = "ご利用ありがとうございました。"
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-				reply_to_line_user(event.reply_token, msg)
+				reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 		elif flag == "end_survey":
 			if event.message.text == NO:
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\tアンケートを継続し，アンケートを再度送信")
+				state.flush()
 				survey(event, tunnel)
 			else:
 				session["survey_progress"] = 0
 				session["survey_mode"] = False
-				save_session(user_id, session)
+				state.save_session(session)
 				logger.debug(
 					f"\t[Save Session] user: {user_id}\n\t\tsurvey_progress: {session['survey_progress']}\n\t\tsurvey_mode: {session['survey_mode']}"
 				)
 
+				state.flush()
 				save_survey_results(user_id)
 
 				init_survey(user_id)
 				richmenu.apply_richmenu(richmenu_ids["START"], user_id)
 				msg = "ご利用ありがとうございました。"
 				logger.debug(f"\t[Send Message] user: {user_id}\n\t\t{repr(msg)}")
-				reply_to_line_user(event.reply_token, msg)
+				reply_to_line_user(event.reply_token, msg, user_id=user_id)
 
 		else:
 			logger.debug(f"\t[Send Message] user: {user_id}\n\t\tアンケートの送信")
+			state.flush()
 			survey(event, tunnel)
 			return
 
 	else:
 		logger.error("[Unexpected Session]")
 
-	reset_flag(user_id)
+	state.reset_flag()
 
 
 @csrf_exempt
@@ -686,7 +749,10 @@ def stripe_webhook(request):
 		if payment_intent:
 			user_id = payment_intent.metadata.get("user_id")
 			purchased_time = payment_intent.metadata.get("time")
-			increment_time(user_id, purchased_time)
+			with user_lock(user_id):   # 時間切れの処理と同時に残り時間を更新しない
+				increment_time(user_id, purchased_time)
+				if user_id in timers:
+					timers[user_id].extend(int(purchased_time))  # カウンセリング中に購入した場合は，タイマーも延長する
 
 			try:
 				msg = "ご購入ありがとうございました！\nメニューから“Start Chat”を押すとカウンセリング対話を開始できます。"
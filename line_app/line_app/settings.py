@@ -166,6 +166,11 @@ _log_group("LOG", [
     ("LOGGER.ASYNC_LLM", MAIN_CONFIG.get("LOGGER", {}).get("ASYNC_LLM")),
 ])
 
+# Webhookの非同期処理
+_log_group("ASYNC_WEBHOOK", [
+    ("ASYNC_WEBHOOK", MAIN_CONFIG.get("ASYNC_WEBHOOK")),
+])
+
 # PORT
 _log_group("PORT", [
     ("PORT", MAIN_CONFIG.get("PORT")),
@@ -195,6 +200,11 @@ _log_group("LINE", [
     ("LINE_CHANNEL_SECRET", _mask(MAIN_CONFIG.get("LINE_CHANNEL_SECRET"))),
     ("LINE_ACCESS_TOKEN", _mask(MAIN_CONFIG.get("LINE_ACCESS_TOKEN"))),
     ("STAMP", MAIN_CONFIG.get("STAMP")),
+    ("LINE_CLIENT", MAIN_CONFIG.get("LINE_CLIENT")),
+    ("MESSAGE_QUOTA", MAIN_CONFIG.get("MESSAGE_QUOTA")),
+    ("OUTBOUND_QUEUE", MAIN_CONFIG.get("OUTBOUND_QUEUE")),
+    ("REPLY_DEADLINE", MAIN_CONFIG.get("REPLY_DEADLINE")),
+    ("MESSAGE_COALESCE", MAIN_CONFIG.get("MESSAGE_COALESCE")),
 ])
 
 # Stripe
@@ -210,11 +220,31 @@ _log_group("MODEL", [
     ("GEMINI_MODEL", MAIN_CONFIG.get("GEMINI_MODEL")),
     ("TEMPERATURE", MAIN_CONFIG.get("TEMPERATURE")),
     ("MAX_TOKENS", MAIN_CONFIG.get("MAX_TOKENS")),
+    ("RESPONSE_GENERATION", MAIN_CONFIG.get("RESPONSE_GENERATION")),
+    ("CONTEXT_BUDGET", MAIN_CONFIG.get("CONTEXT_BUDGET")),
+])
+
+# タイマー
+_log_group("TIMER_SCHEDULER", [
+    ("TIMER_SCHEDULER", MAIN_CONFIG.get("TIMER_SCHEDULER")),
+    ("USER_LOCK", MAIN_CONFIG.get("USER_LOCK")),
 ])
 
 # PROMPT
 _log_group("PROMPT", [
     ("RISK_LEVEL_DETECTION", MAIN_CONFIG.get("PROMPT", {}).get("RISK_LEVEL_DETECTION")),
+    ("RISK_LEVEL_DETECTION_INCREMENTAL", MAIN_CONFIG.get("PROMPT", {}).get("RISK_LEVEL_DETECTION_INCREMENTAL")),
+    ("RISK_ENVELOPE", MAIN_CONFIG.get("PROMPT", {}).get("RISK_ENVELOPE")),
+    ("SUMMARY_PROMPT", MAIN_CONFIG.get("PROMPT", {}).get("SUMMARY")),
+    ("SUMMARY", MAIN_CONFIG.get("SUMMARY")),
+    ("RISK_DETECTION", MAIN_CONFIG.get("RISK_DETECTION")),
+    ("RISK_PRESCREEN", MAIN_CONFIG.get("RISK_PRESCREEN")),
+])
+
+# キャッシュ
+_log_group("CACHE", [
+    ("CONTEXT_CACHE", MAIN_CONFIG.get("CONTEXT_CACHE")),
+    ("SETTING_CACHE_TTL", MAIN_CONFIG.get("SETTING_CACHE_TTL")),
 ])
 
 # データベースpath
@@ -226,6 +256,8 @@ _log_group("DATABASE_PATHS", [
 # リッチメニューID path
 _log_group("RICHMENU", [
     ("RICHMENU_PATH", MAIN_CONFIG.get("RICHMENU_PATH")),
+    ("RICHMENU_HTTP", MAIN_CONFIG.get("RICHMENU_HTTP")),
+    ("RICHMENU_BULK", MAIN_CONFIG.get("RICHMENU_BULK")),
 ])
 
 # 同意設定
@@ -9,6 +9,7 @@ urlpatterns = [
     path('session/history-status/<str:user_id>/', views.chat_history_status, name='chat_history_status'),
     path('session/stop/<str:user_id>/', views.session_stop, name='session_stop'),
     path('session/reply/<str:user_id>/', views.send_reply, name='send_reply'),
+    path('metrics/', views.metrics, name='metrics'),
     path('sample/', views.sample_view, name='sample'),
     path('sample/log/', views.sample_log, name='sample_log'),
 ]
@@ -15,6 +15,9 @@ from django.utils import timezone
 from counseling_linebot.models import Session, ChatHistory, ReplyToken
 from counseling_linebot.utils.template_message import reply_to_line_user
 from counseling_linebot.utils.db_handler import save_dialogue_history
+from counseling_linebot.utils.metrics import collect_metrics
+from counseling_linebot.utils.context_cache import record_message
+from counseling_linebot.utils.locks import user_lock
 
 from logger.set_logger import start_logger
 from logger.ansi import * 
@@ -61,14 +64,23 @@ def session_detail(request, user_id):
     """
     セッションの対話ログ詳細
     """
+    # セッション情報を取得(返答モードが"AI"か"Human"かを知るため)
+    try:
+        session = Session.objects.get(user_id=user_id)
+    except Session.DoesNotExist:
+        session = None
+
     # user_idに紐づくChatHistoryを取得
     logs = ChatHistory.objects.filter(user_id=user_id).order_by("post_time")
-    last_start = ChatHistory.objects.filter(
-        user_id=user_id,
-        message="[START]",
-    ).order_by("post_time").last()   # 最後の[START]を取得（セッション開始の目印）
-    if last_start:
-        logs = logs.filter(post_time__gt=last_start.post_time)   # 最後の[START]以降のログに絞る
+    if session is not None and session.last_start_id is not None:
+        logs = logs.filter(id__gt=session.last_start_id)   # 最後の[START]以降のログに絞る
+    else:
+        last_start = ChatHistory.objects.filter(
+            user_id=user_id,
+            message="[START]",
+        ).order_by("post_time").last()   # 最後の[START]を取得（セッション開始の目印）
+        if last_start:
+            logs = logs.filter(post_time__gt=last_start.post_time)   # 最後の[START]以降のログに絞る
     
     # 最新のログIDを取得
     user_logs = ChatHistory.objects.filter(user_id=user_id)
@@ -85,12 +97,6 @@ def session_detail(request, user_id):
         if log.speaker == 'assistant':
             log.message = re.sub(r'^\[[^\]]*\]\s*', '', log.message)
     
-    # セッション情報を取得(返答モードが"AI"か"Human"かを知るため)
-    try:
-        session = Session.objects.get(user_id=user_id)
-    except Session.DoesNotExist:
-        session = None
-    
     context = {
         "user_id": user_id,
         "logs": logs,
@@ -114,6 +120,14 @@ def chat_history_status(request, user_id):
     return JsonResponse({"latest_id": latest_id})
 
 
+@login_required
+def metrics(request):
+    """
+    キューの深さや処理時間などのメトリクスをJSONで返す
+    """
+    return JsonResponse(collect_metrics())
+
+
 def login_view(request):
     """
     簡易ログイン画面
@@ -155,9 +169,10 @@ def session_stop(request, user_id):
     operator = request.user.username
     logger.info(f"[Change Mode] User: {user_id}, New Mode: {response_mode}, Operator: {operator}")
     try:
-        session = Session.objects.get(user_id=user_id)
-        session.session_data['response_mode'] = response_mode
-        session.save()
+        with user_lock(user_id):
+            session = Session.objects.get(user_id=user_id)
+            session.session_data['response_mode'] = response_mode
+            session.save(update_fields=['session_data'])
         return redirect('monitor:session_detail', user_id=user_id)
     except Session.DoesNotExist:
         return redirect('monitor:session_detail', user_id=user_id)
@@ -174,12 +189,14 @@ def send_reply(request, user_id):
     session_id = session.session_data.get('session_id', '') if session and session.session_data else ''
     logger.info(f"[Monitor Reply] User: {user_id}, Message: {message}")
     
-    reply_token = ReplyToken.objects.filter(user_id=user_id).order_by("-created_at").values_list("token", flat=True).first()
+    reply_token, token_created_at = ReplyToken.objects.filter(user_id=user_id).order_by("-created_at").values_list("token", "created_at").first() or (None, None)
     logger.info(f"[Reply Token] {reply_token}")
     try:
-        reply_to_line_user(reply_token, message)
+        # 送信キューを使う場合，reply_token の期限が切れていれば push で送る
+        issued_at = token_created_at.timestamp() if token_created_at is not None else None
+        reply_to_line_user(reply_token, message, user_id=user_id, issued_at=issued_at)
         post_time = timezone.now()
-        ChatHistory.objects.create(
+        row = ChatHistory.objects.create(
             user_id=user_id,
             speaker="counselor",
             message=message,
@@ -187,6 +204,7 @@ def send_reply(request, user_id):
             finished=0,
             session_id=session_id,
         )
+        record_message(user_id, "counselor", message, 0, session_id, row_id=row.id)
         save_dialogue_history(user_id, 'counselor', message, session_id, post_time)
         
     except ApiException as e: